@@ -0,0 +1,15 @@
+from app.data import config
+
+from .fleet import Fleet, Node
+
+registry = (
+    Fleet.from_file(
+        config.controller_nodes_file,
+        timeout=config.controller_timeout,
+        concurrency=config.controller_concurrency,
+    )
+    if config.controller_nodes_file
+    else None
+)
+
+__all__ = ["registry", "Fleet", "Node"]
@@ -0,0 +1,136 @@
+import asyncio
+import itertools
+import json
+from dataclasses import asdict, dataclass
+
+import httpx
+from loguru import logger
+
+# Заголовки ответа ноды, которые контроллер отдаёт клиенту как есть
+FORWARDED_HEADERS = ("Retry-After", "ETag", "Last-Modified", "Cache-Control", "Idempotency-Replayed")
+
+
+@dataclass
+class Node:
+    """Node API registered in the controller"""
+
+    name: str
+    url: str
+    country: str = ""
+    timeout: float | None = None
+
+
+class Fleet:
+    """Registry of node APIs with one pooled HTTP client.
+
+    Requests to nodes run concurrently, at most `concurrency` at a time,
+    each with the node's own timeout. Fan-out never raises: every node
+    gets its own result so partial failures can be reported.
+    """
+
+    def __init__(
+        self,
+        nodes: list[Node],
+        timeout: float = 10,
+        concurrency: int = 16,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.nodes = nodes
+        self._timeout = timeout
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+        self._round_robin = itertools.count()
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "Fleet":
+        """Nodes file: [{"name": ..., "url": ..., "country": ..., "timeout": ...}]"""
+        with open(path) as f:
+            return cls([Node(**node) for node in json.load(f)], **kwargs)
+
+    def describe(self) -> list[dict]:
+        return [asdict(node) for node in self.nodes]
+
+    def select(self, target: str) -> list[Node]:
+        """Nodes addressed by target: "all", a node name or a country code"""
+        if target == "all":
+            return list(self.nodes)
+        by_name = [node for node in self.nodes if node.name == target]
+        if by_name:
+            return by_name
+        return [node for node in self.nodes if node.country.lower() == target.lower()]
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                transport=self._transport,
+                limits=httpx.Limits(
+                    max_connections=self._concurrency,
+                    max_keepalive_connections=self._concurrency,
+                ),
+            )
+        return self._client
+
+    async def request(self, node: Node, method: str, path: str, **kwargs) -> dict:
+        """Call one node: {"node", "ok", "status_code", "headers", "response" | "error"}"""
+        result = {"node": node.name, "ok": False, "status_code": None}
+        async with self._semaphore:
+            try:
+                response = await self._get_client().request(
+                    method,
+                    f"{node.url.rstrip('/')}{path}",
+                    timeout=node.timeout or self._timeout,
+                    **kwargs,
+                )
+            except httpx.HTTPError as e:
+                logger.warning(f"Node {node.name} {method} {path} failed: {e!r}")
+                result["error"] = repr(e)
+                result["connect_failed"] = isinstance(e, httpx.ConnectError)
+                return result
+        result["status_code"] = response.status_code
+        result["ok"] = response.is_success
+        result["headers"] = {name: response.headers[name] for name in FORWARDED_HEADERS if name in response.headers}
+        try:
+            result["response"] = response.json()
+        except ValueError:
+            result["response"] = response.text
+        return result
+
+    async def fan_out(self, nodes: list[Node], method: str, path: str, **kwargs) -> dict:
+        """Same request to every node concurrently, per-node results"""
+        results = await asyncio.gather(
+            *(self.request(node, method, path.format(node=node.name), **kwargs) for node in nodes)
+        )
+        failed = [result["node"] for result in results if not result["ok"]]
+        if not failed:
+            status = "success"
+        elif len(failed) < len(results):
+            status = "partial"
+        else:
+            status = "error"
+        return {
+            "status": status,
+            "failed": failed,
+            "nodes": {result["node"]: result for result in results},
+        }
+
+    async def forward(self, nodes: list[Node], method: str, path: str, **kwargs) -> dict:
+        """Request to one of the nodes (round robin).
+
+        Falls over to the next node only if the connection could not be
+        established, so a request is never executed twice.
+        """
+        start = next(self._round_robin)
+        result = {}
+        for n in range(len(nodes)):
+            node = nodes[(start + n) % len(nodes)]
+            result = await self.request(node, method, path.format(node=node.name), **kwargs)
+            if not result.get("connect_failed"):
+                break
+        return result
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,145 @@
+import json
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from . import registry
+from .fleet import Node
+
+router = APIRouter()
+
+
+def _nodes(target: str) -> list[Node]:
+    nodes = registry.select(target)
+    if not nodes:
+        raise HTTPException(status_code=404, detail=f"Нет нод для {target}")
+    return nodes
+
+
+async def _body(request: Request):
+    raw = await request.body()
+    try:
+        return json.loads(raw) if raw else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Тело запроса - не JSON")
+
+
+def _headers(request: Request) -> dict:
+    """Idempotency-Key клиента уходит на ноду: повтор после обрыва не закоммитит дважды"""
+    key = request.headers.get("idempotency-key")
+    return {"Idempotency-Key": key} if key else {}
+
+
+def _forwarded(result: dict) -> JSONResponse:
+    """Ответ ноды как есть, с именем ноды"""
+    if result["status_code"] is None:
+        return JSONResponse({"detail": result["error"], "node": result["node"]}, status_code=502)
+    body = result["response"]
+    if isinstance(body, dict):
+        body = {**body, "node": result["node"]}
+    return JSONResponse(body, status_code=result["status_code"], headers=result["headers"])
+
+
+def _fanned_out(result: dict) -> JSONResponse:
+    # Клиенту - самый долгий Retry-After среди нод, чтобы повтор не попал в ту же перегрузку
+    retry_after = [
+        int(node["headers"]["Retry-After"])
+        for node in result["nodes"].values()
+        if node.get("headers", {}).get("Retry-After", "").isdigit()
+    ]
+    headers = {"Retry-After": str(max(retry_after))} if retry_after else None
+    return JSONResponse(result, status_code=502 if result["status"] == "error" else 200, headers=headers)
+
+
+@router.get("/nodes")
+async def list_nodes():
+    """
+    Реестр нод контроллера.
+    """
+    return {"nodes": registry.describe()}
+
+
+@router.post("/add_user/{country}/")
+async def add_user(request: Request, country: str):
+    """
+    Создаёт пользователя на одной из нод страны (по кругу).
+    """
+    result = await registry.forward(
+        _nodes(country), "POST", f"/add_user/{country}/",
+        params=dict(request.query_params), headers=_headers(request),
+    )
+    return _forwarded(result)
+
+
+@router.post("/add_users/{country}/")
+async def add_users(request: Request, country: str):
+    """
+    Массовое добавление на одну из нод страны.
+    """
+    result = await registry.forward(
+        _nodes(country), "POST", f"/add_users/{country}/",
+        json=await _body(request), headers=_headers(request),
+    )
+    return _forwarded(result)
+
+
+@router.post("/reactivate_configs/{target_server}/")
+async def reactivate_configs(request: Request, target_server: str):
+    """
+    Восстановление конфигов на выбранных нодах.
+    """
+    result = await registry.fan_out(
+        _nodes(target_server), "POST", "/reactivate_configs/{node}/",
+        json=await _body(request), headers=_headers(request),
+    )
+    return _fanned_out(result)
+
+
+@router.delete("/delete_config/{target_server}/")
+async def delete_config(request: Request, target_server: str):
+    """
+    Удаление конфига на выбранных нодах (all - на всех).
+    """
+    result = await registry.fan_out(
+        _nodes(target_server), "DELETE", "/delete_config/{node}/",
+        params=dict(request.query_params), headers=_headers(request),
+    )
+    return _fanned_out(result)
+
+
+@router.delete("/deactivate_configs/{target_server}/")
+async def deactivate_configs(request: Request, target_server: str):
+    """
+    Деактивация конфигов сразу на всех выбранных нодах одним вызовом.
+    """
+    result = await registry.fan_out(
+        _nodes(target_server), "DELETE", "/deactivate_configs/{node}/",
+        json=await _body(request), headers=_headers(request),
+    )
+    return _fanned_out(result)
+
+
+@router.delete("/cleanup_configs/{target_server}/")
+async def cleanup_configs(request: Request, target_server: str):
+    """
+    Очистка устаревших конфигов на выбранных нодах.
+    """
+    result = await registry.fan_out(
+        _nodes(target_server), "DELETE", "/cleanup_configs/{node}/",
+        json=await _body(request), headers=_headers(request),
+    )
+    return _fanned_out(result)
+
+
+@router.get("/server_stats/{target_server}/")
+async def get_server_stats(target_server: str):
+    """
+    Статистика выбранных нод и суммарное число активных клиентов.
+    """
+    result = await registry.fan_out(_nodes(target_server), "GET", "/server_stats/")
+    result["active_clients"] = sum(
+        node["response"].get("active_clients", 0)
+        for node in result["nodes"].values()
+        if node["ok"] and isinstance(node["response"], dict)
+    )
+    return _fanned_out(result)
@@ -1,6 +1,11 @@
+import asyncio
+import json
+import os
+import time
 from os import getenv
 from dotenv import load_dotenv
-from app.utils.ip_info import IPInfo
+from loguru import logger
+from app.utils.ip_info import IPInfo, IPInfoError
 
 
 class DotEnvVariableNotFound(Exception):
@@ -16,9 +21,17 @@ class Configuration:
         load_dotenv()
         self._user_config_prefix: str = self._get_user_config_prefix()
         self._xray_config_path: str = self._get_xray_config_path()
-        self._server_ip: str = self._get_server_ip()
-        self._server_country: str = self._get_server_country()
-        self._server_country_code: str = self._get_server_country_code()
+        self._xray_confdir: str | None = self._get_xray_confdir()
+        # IP и страна определяются лениво: env > кэш на диске > сеть в фоне
+        self._server_ip: str | None = self._get_server_ip()
+        self._server_country: str | None = self._get_server_country()
+        self._server_country_code: str | None = self._get_server_country_code()
+        self._server_info_cache_path: str = self._get_server_info_cache_path()
+        self._server_info_ttl: int = self._get_server_info_ttl()
+        self._server_info_timeout: float = self._get_server_info_timeout()
+        self._server_info: dict = self._load_server_info_cache()
+        self._server_info_lock = asyncio.Lock()
+        self._server_info_failed_at: float = 0
         self._xray_sni: str = self._get_xray_sni()
         self._xray_privatekey: str = self._get_xray_privatekey()
         self._xray_publickey: str = self._get_xray_publickey()
@@ -29,6 +42,65 @@ class Configuration:
         self._xray_network: str = self._get_xray_network()
         self._xray_path: str = self._get_xray_path()
         self._xray_link_port: str = self._get_xray_link_port()
+        self._xray_link_ports: dict[str, str] = self._get_xray_link_ports()
+        self._xray_placement: str = self._get_xray_placement()
+        self._xray_placement_weights: dict[str, float] = self._get_xray_placement_weights()
+
+        # --- Живое применение изменений через Xray API ---
+        self._xray_apply_mode: str = self._get_xray_apply_mode()
+        self._xray_api_address: str = self._get_xray_api_address()
+        self._xray_api_timeout: float = self._get_xray_api_timeout()
+        self._xray_batch_window: float = self._get_xray_batch_window()
+        self._xray_changelog_size: int = self._get_xray_changelog_size()
+        self._xray_stats_interval: float = self._get_xray_stats_interval()
+        self._metrics_enabled: bool = self._get_metrics_enabled()
+
+        # --- Супервизор xray ---
+        self._xray_restart_command: str = self._get_xray_restart_command()
+        self._xray_test_command: str | None = self._get_xray_test_command()
+        self._xray_command_timeout: float = self._get_xray_command_timeout()
+        self._xray_ready_timeout: float = self._get_xray_ready_timeout()
+        self._xray_restart_min_interval: float = self._get_xray_restart_min_interval()
+
+        # --- Снапшоты конфига ---
+        self._xray_snapshot_dir: str = self._get_xray_snapshot_dir()
+        self._xray_snapshot_keep: int = self._get_xray_snapshot_keep()
+
+        # --- Истечение срока конфигов ---
+        self._xray_expiry_path: str = self._get_xray_expiry_path()
+        self._xray_expiry_interval: float = self._get_xray_expiry_interval()
+        self._xray_expiry_batch: int = self._get_xray_expiry_batch()
+
+        # --- Пул заранее созданных слотов ---
+        self._xray_pool_size: int = self._get_xray_pool_size()
+        self._xray_pool_low_watermark: int = self._get_xray_pool_low_watermark()
+        self._xray_pool_path: str = self._get_xray_pool_path()
+
+        # --- Онлайн по access-логу xray ---
+        self._xray_access_log: str | None = self._get_xray_access_log()
+        self._xray_access_log_state_path: str = self._get_xray_access_log_state_path()
+        self._xray_presence_interval: float = self._get_xray_presence_interval()
+        self._xray_presence_window: float = self._get_xray_presence_window()
+        self._xray_presence_retention: float = self._get_xray_presence_retention()
+
+        # --- Хранилище клиентов в SQLite (несколько воркеров) ---
+        self._xray_store_path: str | None = self._get_xray_store_path()
+
+        # --- Контроль допуска мутаций ---
+        self._xray_bulk_chunk: int = self._get_xray_bulk_chunk()
+        self._admission_interactive_limit: int = self._get_admission_interactive_limit()
+        self._admission_bulk_limit: int = self._get_admission_bulk_limit()
+        self._admission_per_caller: int = self._get_admission_per_caller()
+
+        # --- Идемпотентность мутаций ---
+        self._idempotency_store_path: str = self._get_idempotency_store_path()
+        self._idempotency_ttl: float = self._get_idempotency_ttl()
+        self._idempotency_max_keys: int = self._get_idempotency_max_keys()
+
+        # --- Режим контроллера: проксирование на ноды ---
+        self._controller_nodes_file: str | None = self._get_controller_nodes_file()
+        self._controller_timeout: float = self._get_controller_timeout()
+        self._controller_concurrency: int = self._get_controller_concurrency()
 
     def _get_user_config_prefix(self) -> str:
         return getenv("USER_CONFIGS_PREFIX", "VPNizator")
@@ -36,14 +108,90 @@ class Configuration:
     def _get_xray_config_path(self) -> str:
         return getenv("XRAY_CONFIG_PATH", "/usr/local/etc/xray/config.json")
 
-    def _get_server_ip(self) -> str:
-        return IPInfo().get_server_ip()
+    def _get_xray_confdir(self) -> str | None:
+        # Если задан - клиенты хранятся во фрагментах confdir, config.json не трогается
+        return getenv("XRAY_CONFDIR") or None
+
+    def _get_server_ip(self) -> str | None:
+        return getenv("SERVER_IP")
+
+    def _get_server_country(self) -> str | None:
+        return getenv("SERVER_COUNTRY")
+
+    def _get_server_country_code(self) -> str | None:
+        return getenv("SERVER_COUNTRY_CODE")
 
-    def _get_server_country(self) -> str:
-        return getenv("SERVER_COUNTRY", "Unknown")
+    def _get_server_info_cache_path(self) -> str:
+        default_path = os.path.join(os.path.dirname(__file__), ".server_info.json")
+        return getenv("SERVER_INFO_CACHE_PATH", default_path)
 
-    def _get_server_country_code(self) -> str:
-        return getenv("SERVER_COUNTRY_CODE", "UN")
+    def _get_server_info_ttl(self) -> int:
+        return int(getenv("SERVER_INFO_TTL", "86400"))
+
+    def _get_server_info_timeout(self) -> float:
+        return float(getenv("SERVER_INFO_TIMEOUT", "3"))
+
+    def _load_server_info_cache(self) -> dict:
+        try:
+            with open(self._server_info_cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_server_info_cache(self):
+        tmp_path = f"{self._server_info_cache_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self._server_info, f)
+            os.replace(tmp_path, self._server_info_cache_path)
+        except OSError as e:
+            logger.warning(f"Could not save server info cache: {e}")
+
+    def _server_info_is_fresh(self) -> bool:
+        if self._server_ip and self._server_country and self._server_country_code:
+            return True
+        # Без страны (неудачный поиск локации) кэш не считается свежим
+        if not (self._server_info.get("ip") and self._server_info.get("country")):
+            return False
+        return time.time() - self._server_info.get("updated_at", 0) < self._server_info_ttl
+
+    async def refresh_server_info(self, force: bool = False):
+        """Discover server ip and location, result goes to the on-disk cache"""
+        async with self._server_info_lock:
+            if not force and self._server_info_is_fresh():
+                return
+            # После неудачи не долбим сеть на каждом запросе
+            if not force and time.time() - self._server_info_failed_at < 60:
+                return
+            ip_info = IPInfo(timeout=self._server_info_timeout)
+            server_info = dict(self._server_info)
+            try:
+                server_info["ip"] = self._server_ip or await ip_info.get_server_ip()
+                server_info.update(await ip_info.get_server_location(server_info["ip"]))
+            except IPInfoError as e:
+                logger.warning(f"Server info discovery failed: {e}")
+                self._server_info_failed_at = time.time()
+                if server_info.get("ip") == self._server_info.get("ip"):
+                    return
+                # Новый ip без локации: старая страна ему не принадлежит, срок не продлеваем
+                server_info = {"ip": server_info["ip"]} if server_info.get("ip") else {}
+            else:
+                server_info["updated_at"] = time.time()
+            self._server_info = server_info
+            self._save_server_info_cache()
+            logger.info(f"Server info refreshed: {server_info}")
+
+    async def run_server_info_refresher(self):
+        """Rediscover server info whenever the cache goes stale or a lookup failed"""
+        while True:
+            await self.refresh_server_info()
+            await asyncio.sleep(min(60, self._server_info_ttl))
+
+    async def resolve_server_ip(self) -> str:
+        """Known server ip, waits for discovery only if nothing is known yet"""
+        if not self.server_ip:
+            await self.refresh_server_info()
+        return self.server_ip or self.domain_name
 
     def _get_xray_sni(self) -> str:
         return getenv("XRAY_SNI", "www.microsoft.com")
@@ -77,12 +225,163 @@ class Configuration:
         # По умолчанию 443, но скрипт миграции задаст 4433
         return getenv("XRAY_LINK_PORT", "443")
 
+    def _get_xray_link_ports(self) -> dict[str, str]:
+        # Публичные порты дополнительных инбаундов, если они за NAT/балансировщиком
+        # Формат: "vless_xhttp_2=8443,vless_grpc=2053"
+        ports = {}
+        for item in getenv("XRAY_LINK_PORTS", "").split(","):
+            if item.strip():
+                tag, _, port = item.partition("=")
+                ports[tag.strip()] = port.strip()
+        return ports
+
+    def _get_xray_placement(self) -> str:
+        # least_clients | hash | weighted - по какому инбаунду раскладывать новых клиентов
+        return getenv("XRAY_PLACEMENT", "least_clients")
+
+    def _get_xray_placement_weights(self) -> dict[str, float]:
+        # Формат: "vless_xhttp=2,vless_xhttp_2=1"
+        weights = {}
+        for item in getenv("XRAY_PLACEMENT_WEIGHTS", "").split(","):
+            if item.strip():
+                tag, _, weight = item.partition("=")
+                weights[tag.strip()] = float(weight)
+        return weights
+
+    def _get_xray_apply_mode(self) -> str:
+        # "restart" - systemctl restart xray, "api" - HandlerService.AlterInbound
+        return getenv("XRAY_APPLY_MODE", "restart")
+
+    def _get_xray_api_address(self) -> str:
+        return getenv("XRAY_API_ADDRESS", "127.0.0.1:10085")
+
+    def _get_xray_api_timeout(self) -> float:
+        return float(getenv("XRAY_API_TIMEOUT", "5"))
+
+    def _get_xray_batch_window(self) -> float:
+        # Окно склейки изменений конфига в одну запись, в миллисекундах
+        return int(getenv("XRAY_BATCH_WINDOW_MS", "50")) / 1000
+
+    def _get_xray_changelog_size(self) -> int:
+        # Сколько изменений uuid хранить для дельта-синхронизации
+        return int(getenv("XRAY_CHANGELOG_SIZE", "100000"))
+
+    def _get_xray_stats_interval(self) -> float:
+        # Период опроса StatsService в секундах, 0 - опрос выключен
+        return float(getenv("XRAY_STATS_INTERVAL", "0"))
+
+    def _get_metrics_enabled(self) -> bool:
+        return getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+    def _get_xray_restart_command(self) -> str:
+        return getenv("XRAY_RESTART_COMMAND", "systemctl restart xray")
+
+    def _get_xray_test_command(self) -> str | None:
+        # {config} заменяется на путь к проверяемому файлу; пустая строка - без проверки
+        option = "-confdir" if self._xray_confdir else "-config"
+        return getenv("XRAY_TEST_COMMAND", f"/usr/local/bin/xray run -test -format json {option} {{config}}") or None
+
+    def _get_xray_command_timeout(self) -> float:
+        return float(getenv("XRAY_COMMAND_TIMEOUT", "30"))
+
+    def _get_xray_ready_timeout(self) -> float:
+        return float(getenv("XRAY_READY_TIMEOUT", "10"))
+
+    def _get_xray_restart_min_interval(self) -> float:
+        return float(getenv("XRAY_RESTART_MIN_INTERVAL", "2"))
+
+    def _get_xray_snapshot_dir(self) -> str:
+        default_dir = os.path.join(os.path.dirname(self._xray_config_path), "snapshots")
+        return getenv("XRAY_SNAPSHOT_DIR", default_dir)
+
+    def _get_xray_snapshot_keep(self) -> int:
+        return int(getenv("XRAY_SNAPSHOT_KEEP", "20"))
+
+    def _get_xray_expiry_path(self) -> str:
+        default_path = os.path.join(os.path.dirname(self._xray_config_path), "expiry.jsonl")
+        return getenv("XRAY_EXPIRY_PATH", default_path)
+
+    def _get_xray_expiry_interval(self) -> float:
+        return float(getenv("XRAY_EXPIRY_INTERVAL", "30"))
+
+    def _get_xray_expiry_batch(self) -> int:
+        # Не больше стольких удалений за один тик - без лавины в одну секунду
+        return int(getenv("XRAY_EXPIRY_BATCH", "1000"))
+
+    def _get_xray_pool_size(self) -> int:
+        # 0 - пул выключен, каждый новый пользователь ждёт коммита
+        return int(getenv("XRAY_POOL_SIZE", "0"))
+
+    def _get_xray_pool_low_watermark(self) -> int:
+        return int(getenv("XRAY_POOL_LOW_WATERMARK", str(self._xray_pool_size // 2)))
+
+    def _get_xray_pool_path(self) -> str:
+        default_path = os.path.join(os.path.dirname(self._xray_config_path), "pool.json")
+        return getenv("XRAY_POOL_PATH", default_path)
+
+    def _get_xray_access_log(self) -> str | None:
+        # Путь к access-логу xray; пусто - онлайн не отслеживается
+        return getenv("XRAY_ACCESS_LOG") or None
+
+    def _get_xray_access_log_state_path(self) -> str:
+        default_path = os.path.join(os.path.dirname(__file__), ".access_log_state.json")
+        return getenv("XRAY_ACCESS_LOG_STATE_PATH", default_path)
+
+    def _get_xray_presence_interval(self) -> float:
+        return float(getenv("XRAY_PRESENCE_INTERVAL", "5"))
+
+    def _get_xray_presence_window(self) -> float:
+        # Клиент онлайн, если подключался за последние N секунд
+        return float(getenv("XRAY_PRESENCE_WINDOW", "300"))
+
+    def _get_xray_presence_retention(self) -> float:
+        return float(getenv("XRAY_PRESENCE_RETENTION", "86400"))
+
+    def _get_xray_store_path(self) -> str | None:
+        # Если задан - клиенты живут в SQLite, config.json генерируется из неё под файловой блокировкой
+        return getenv("XRAY_STORE_PATH") or None
+
+    def _get_xray_bulk_chunk(self) -> int:
+        # Массовые списки uuid коммитятся кусками такого размера
+        return max(1, int(getenv("XRAY_BULK_CHUNK", "2000")))
+
+    def _get_admission_interactive_limit(self) -> int:
+        # Сколько регистраций может ждать одновременно, дальше 429
+        return int(getenv("ADMISSION_INTERACTIVE_LIMIT", "1000"))
+
+    def _get_admission_bulk_limit(self) -> int:
+        return int(getenv("ADMISSION_BULK_LIMIT", "4"))
+
+    def _get_admission_per_caller(self) -> int:
+        # 0 - без ограничения на вызывающего
+        return int(getenv("ADMISSION_PER_CALLER", "32"))
+
+    def _get_idempotency_store_path(self) -> str:
+        default_path = os.path.join(os.path.dirname(__file__), ".idempotency.jsonl")
+        return getenv("IDEMPOTENCY_STORE_PATH", default_path)
+
+    def _get_idempotency_ttl(self) -> float:
+        return float(getenv("IDEMPOTENCY_TTL", "86400"))
+
+    def _get_idempotency_max_keys(self) -> int:
+        return int(getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+
+    def _get_controller_nodes_file(self) -> str | None:
+        # JSON-список нод; если задан - включаются маршруты /fleet/...
+        return getenv("CONTROLLER_NODES_FILE") or None
+
+    def _get_controller_timeout(self) -> float:
+        return float(getenv("CONTROLLER_TIMEOUT", "10"))
+
+    def _get_controller_concurrency(self) -> int:
+        return int(getenv("CONTROLLER_CONCURRENCY", "16"))
+
     @property
     def user_config_prefix(self) -> str: return self._user_config_prefix
     @property
     def xray_config_path(self) -> str: return self._xray_config_path
     @property
-    def server_ip(self) -> str: return self._server_ip
+    def server_ip(self) -> str: return self._server_ip or self._server_info.get("ip", "")
     @property
     def xray_sni(self) -> str: return self._xray_sni
     @property
@@ -94,13 +393,93 @@ class Configuration:
     @property
     def domain_name(self) -> str: return self._domain_name
     @property
-    def server_country(self) -> str: return self._server_country
+    def server_country(self) -> str: return self._server_country or self._server_info.get("country", "Unknown")
     @property
-    def server_country_code(self) -> str: return self._server_country_code
+    def server_country_code(self) -> str: return self._server_country_code or self._server_info.get("country_code", "UN")
     
     @property
     def xray_network(self) -> str: return self._xray_network
     @property
     def xray_path(self) -> str: return self._xray_path
     @property
-    def xray_link_port(self) -> str: return self._xray_link_port
\ No newline at end of file
+    def xray_link_port(self) -> str: return self._xray_link_port
+    @property
+    def xray_link_ports(self) -> dict[str, str]: return self._xray_link_ports
+    @property
+    def xray_apply_mode(self) -> str: return self._xray_apply_mode
+    @property
+    def xray_api_address(self) -> str: return self._xray_api_address
+    @property
+    def xray_api_timeout(self) -> float: return self._xray_api_timeout
+    @property
+    def xray_batch_window(self) -> float: return self._xray_batch_window
+    @property
+    def xray_changelog_size(self) -> int: return self._xray_changelog_size
+    @property
+    def xray_stats_interval(self) -> float: return self._xray_stats_interval
+    @property
+    def metrics_enabled(self) -> bool: return self._metrics_enabled
+    @property
+    def xray_restart_command(self) -> str: return self._xray_restart_command
+    @property
+    def xray_test_command(self) -> str | None: return self._xray_test_command
+    @property
+    def xray_command_timeout(self) -> float: return self._xray_command_timeout
+    @property
+    def xray_ready_timeout(self) -> float: return self._xray_ready_timeout
+    @property
+    def xray_restart_min_interval(self) -> float: return self._xray_restart_min_interval
+    @property
+    def xray_snapshot_dir(self) -> str: return self._xray_snapshot_dir
+    @property
+    def xray_snapshot_keep(self) -> int: return self._xray_snapshot_keep
+    @property
+    def xray_confdir(self) -> str | None: return self._xray_confdir
+    @property
+    def xray_placement(self) -> str: return self._xray_placement
+    @property
+    def xray_placement_weights(self) -> dict[str, float]: return self._xray_placement_weights
+    @property
+    def controller_nodes_file(self) -> str | None: return self._controller_nodes_file
+    @property
+    def controller_timeout(self) -> float: return self._controller_timeout
+    @property
+    def controller_concurrency(self) -> int: return self._controller_concurrency
+    @property
+    def idempotency_store_path(self) -> str: return self._idempotency_store_path
+    @property
+    def idempotency_ttl(self) -> float: return self._idempotency_ttl
+    @property
+    def idempotency_max_keys(self) -> int: return self._idempotency_max_keys
+    @property
+    def xray_expiry_path(self) -> str: return self._xray_expiry_path
+    @property
+    def xray_expiry_interval(self) -> float: return self._xray_expiry_interval
+    @property
+    def xray_expiry_batch(self) -> int: return self._xray_expiry_batch
+    @property
+    def xray_pool_size(self) -> int: return self._xray_pool_size
+    @property
+    def xray_pool_low_watermark(self) -> int: return self._xray_pool_low_watermark
+    @property
+    def xray_pool_path(self) -> str: return self._xray_pool_path
+    @property
+    def xray_access_log(self) -> str | None: return self._xray_access_log
+    @property
+    def xray_access_log_state_path(self) -> str: return self._xray_access_log_state_path
+    @property
+    def xray_presence_interval(self) -> float: return self._xray_presence_interval
+    @property
+    def xray_presence_window(self) -> float: return self._xray_presence_window
+    @property
+    def xray_presence_retention(self) -> float: return self._xray_presence_retention
+    @property
+    def xray_store_path(self) -> str | None: return self._xray_store_path
+    @property
+    def xray_bulk_chunk(self) -> int: return self._xray_bulk_chunk
+    @property
+    def admission_interactive_limit(self) -> int: return self._admission_interactive_limit
+    @property
+    def admission_bulk_limit(self) -> int: return self._admission_bulk_limit
+    @property
+    def admission_per_caller(self) -> int: return self._admission_per_caller
\ No newline at end of file
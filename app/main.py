@@ -1,23 +1,204 @@
-from fastapi import FastAPI, HTTPException, Body
+import asyncio
+import hashlib
+import time
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, Body, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from starlette.routing import Match
 from typing import Dict
 from loguru import logger
 from app.data import config
+from app.utils.admission import AdmissionRejected, admission
+from app.utils.idempotency import IdempotencyKeyReused, idempotency_store
+from app.utils.metrics import metrics, monitor_event_loop_lag
+
+from app.controller import registry
+from app.xray import presence, traffic_stats, xray_config
+from app.xray.mutation_queue import PartialCommitError
+from app.xray.snapshots import SnapshotNotFound
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # IP/страна: стартуем из кэша сразу, обновляем в фоне по истечении TTL
+    background_tasks = [asyncio.create_task(config.run_server_info_refresher())]
+    if config.xray_stats_interval > 0:
+        background_tasks.append(asyncio.create_task(traffic_stats.run()))
+    if metrics.enabled:
+        background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+    if config.xray_access_log:
+        background_tasks.append(asyncio.create_task(presence.run(config.xray_presence_interval)))
+    if config.xray_pool_size > 0:
+        background_tasks.append(asyncio.create_task(xray_config.run_pool_refiller()))
+    if config.xray_expiry_interval > 0:
+        background_tasks.append(asyncio.create_task(xray_config.run_expiry_scheduler()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    if registry is not None:
+        await registry.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+if registry is not None:
+    # Режим контроллера: те же операции, разосланные по нодам из реестра
+    from app.controller.routes import router as controller_router
+
+    app.include_router(controller_router, prefix="/fleet")
 
-from app.xray import xray_config
 
-app = FastAPI()
+logger.add("logs/app_{time}.log", rotation="10 MB", compression="zip")
 
+# Классы допуска: регистрация пользователей не ждёт массовое обслуживание
+INTERACTIVE_ROUTES = ("/add_user/", "/add_users/", "/delete_config/")
+BULK_ROUTES = ("/deactivate_configs/", "/reactivate_configs/", "/cleanup_configs/", "/reconcile_configs/")
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """Ограничивает очередь мутаций: при перегрузке сразу 429 с Retry-After.
+
+    Объявлен первым, поэтому самый внутренний: повторы из хранилища
+    идемпотентности не занимают слотов, а отказы попадают в метрики латентности.
+    """
+    path = request.url.path
+    if request.method not in ("POST", "DELETE"):
+        return await call_next(request)
+    if path.startswith(INTERACTIVE_ROUTES):
+        kind = "interactive"
+    elif path.startswith(BULK_ROUTES):
+        kind = "bulk"
+    else:
+        return await call_next(request)
+
+    caller = request.headers.get("x-caller-id") or (request.client.host if request.client else "unknown")
+    try:
+        with admission.admit(kind, caller):
+            return await call_next(request)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            {"detail": str(e), "reason": e.reason}, status_code=429, headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status")
+)
+
+
+def _route_template(request: Request) -> str:
+    """Шаблон маршрута, а не сырой путь - иначе uuid раздуют кардинальность"""
+    route = request.scope.get("route")
+    if route is None:
+        # Отказ контроля допуска (429) вернулся раньше роутинга: ищем маршрут сами
+        for candidate in request.app.router.routes:
+            if candidate.matches(request.scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return route.path if route else "unmatched"
+
+
+@app.middleware("http")
+async def measure_request_latency(request: Request, call_next):
+    if not metrics.enabled:
+        return await call_next(request)
+    started = time.perf_counter()
+    response = await call_next(request)
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=_route_template(request),
+        status=response.status_code,
+    )
+    return response
+
+
+# Мутации, которые можно безопасно повторять с тем же Idempotency-Key
+IDEMPOTENT_ROUTES = (
+    "/add_user/",
+    "/add_users/",
+    "/reactivate_configs/",
+    "/deactivate_configs/",
+    "/delete_config/",
+    "/cleanup_configs/",
+    "/reconcile_configs/",
+)
+
+
+@app.middleware("http")
+async def idempotent_mutations(request: Request, call_next):
+    """Повтор с тем же Idempotency-Key получает исходный ответ, а не второй коммит"""
+    key = request.headers.get("idempotency-key")
+    path = request.url.path.removeprefix("/fleet")
+    if key is None or request.method not in ("POST", "DELETE") or not path.startswith(IDEMPOTENT_ROUTES):
+        return await call_next(request)
+
+    body = await request.body()
+    fingerprint = hashlib.sha256(
+        b"\n".join([request.method.encode(), request.url.path.encode(), request.url.query.encode(), body])
+    ).hexdigest()
+
+    retry_after = None
+
+    async def execute():
+        nonlocal retry_after
+        response = await call_next(request)
+        retry_after = response.headers.get("retry-after")  # 429 от контроля допуска
+        content = b"".join([chunk async for chunk in response.body_iterator])
+        return response.status_code, response.headers.get("content-type"), content
+
+    try:
+        status_code, media_type, content, replayed = await idempotency_store.run(key, fingerprint, execute)
+    except IdempotencyKeyReused as e:
+        return JSONResponse({"detail": str(e)}, status_code=422)
+    headers = {"Idempotency-Replayed": "true"} if replayed else None
+    if retry_after is not None and not replayed:
+        headers = {"Retry-After": retry_after}
+    return Response(content, status_code=status_code, media_type=media_type, headers=headers)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Метрики в текстовом формате Prometheus.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def _not_modified(request: Request, etag: str) -> Response | None:
+    """304, если у клиента уже есть актуальная версия (If-None-Match)"""
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match == "*":
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+class NewUser(BaseModel):
+    user_id: int
+    config_name: str
+    seed: str | None = None
+    expires_at: float | None = None  # unix time, после которого конфиг удаляется
+
+
+class ConfigLink(BaseModel):
+    config_uuid: str
+    config_name: str
 
-logger.add("logs/app_{time}.log", rotation="10 MB", compression="zip")
 
 @app.post("/add_user/{country}/")
-async def add_user(country: str, user_id: int, config_name: str):
+async def add_user(
+    country: str, user_id: int, config_name: str, seed: str | None = None, expires_at: float | None = None
+):
     logger.info(f"Received request for {country} with user_id={user_id} and config_name={config_name}")
     
     try:
         # Вызов функции для добавления нового пользователя
-        user_link, config_uuid = await xray_config.add_new_user(config_name=config_name, user_telegram_id=user_id)
+        user_link, config_uuid = await xray_config.add_new_user(
+            config_name=config_name, user_telegram_id=user_id, seed=seed, expires_at=expires_at
+        )
         server_domain = config.domain_name
         server_country = config.server_country  # Название страны
         server_country_code = config.server_country_code  # Код страны
@@ -31,29 +212,77 @@ async def add_user(country: str, user_id: int, config_name: str):
             "server_country_code": server_country_code  # Отправляем код страны
         }
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to add user: {str(e)}")
 
 
+@app.post("/add_users/{country}/")
+async def add_users(country: str, users: list[NewUser] = Body(..., embed=True)):
+    """
+    Массовое добавление пользователей одним коммитом конфига.
+    """
+    if not users:
+        raise HTTPException(status_code=400, detail="Список users не может быть пустым.")
+    logger.info(f"Received bulk request for {country} with {len(users)} users")
+
+    try:
+        results = await xray_config.add_new_users(
+            [(user.user_id, user.config_name, user.seed, user.expires_at) for user in users]
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to add users: {str(e)}")
+
+    return {
+        "users": [
+            {"user_id": user.user_id, "link": link, "config_uuid": config_uuid}
+            for user, (link, config_uuid) in zip(users, results)
+        ],
+        "server_domain": config.domain_name,
+        "server_country": config.server_country,
+        "server_country_code": config.server_country_code,
+    }
+
+
+
+def _partial_failure(e: PartialCommitError) -> HTTPException:
+    """Часть кусков массовой операции закоммичена: говорим, какие UUID не применены"""
+    return HTTPException(
+        status_code=500, detail={"message": str(e), "applied": len(e.applied), "failed": e.failed}
+    )
+
 
 @app.post("/reactivate_configs/{target_server}/")
 async def reactivate_configs(
     target_server: str, 
-    config_uuids: list[str] = Body(..., embed=True)
+    config_uuids: list[str] = Body(..., embed=True),
+    expires_at: float | None = Body(None, embed=True)
 ):
     """
     Эндпоинт для восстановления конфигов пользователей по их UUID.
     Принимаем список UUID и передаем в функцию восстановления.
+    expires_at (unix time) - когда конфиги снова удалить; без него бессрочно.
+    В ответе ссылки по UUID (без имени конфига): без хранилища клиентов
+    конфиг может вернуться на другой инбаунд, и старая ссылка устареет.
     """
     try:
         # Вызов функции восстановления
-        success = await xray_config.reactivate_user_configs_in_xray(config_uuids=config_uuids)
+        success = await xray_config.reactivate_user_configs_in_xray(
+            config_uuids=config_uuids, expires_at=expires_at
+        )
 
         if success:
-            return {"status": "success", "message": "Конфиги успешно восстановлены."}
+            uuids = list(dict.fromkeys(config_uuids))
+            links = await xray_config.create_links([(uuid, "") for uuid in uuids])
+            return {"status": "success", "message": "Конфиги успешно восстановлены.", "links": dict(zip(uuids, links))}
         else:
             raise HTTPException(status_code=500, detail="Не удалось восстановить конфиги.")
     
+    except PartialCommitError as e:
+        raise _partial_failure(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка: {str(e)}")
 
@@ -76,6 +305,44 @@ async def show_specified_config(target_server: str, config_uuid: str, config_nam
         raise HTTPException(status_code=500, detail="Не удалось создать ссылку конфигурации")
 
 
+@app.post("/links")
+async def create_links(configs: list[ConfigLink] = Body(..., embed=True)):
+    """
+    Пакетная генерация ссылок за один запрос.
+    """
+    links = await xray_config.create_links(
+        [(item.config_uuid, item.config_name) for item in configs]
+    )
+    return {"links": [
+        {"config_uuid": item.config_uuid, "config_link": link}
+        for item, link in zip(configs, links)
+    ]}
+
+
+@app.get("/subscription/{config_uuid}")
+async def get_subscription(request: Request, config_uuid: str, config_name: str):
+    """
+    Подписка для клиентских приложений: base64 со ссылкой пользователя.
+    Поддерживает ETag/If-None-Match и Last-Modified/If-Modified-Since.
+    """
+    subscription = await xray_config.get_subscription(config_uuid, config_name)
+    if subscription is None:
+        raise HTTPException(status_code=404, detail="Конфиг не найден.")
+
+    blob, etag, modified_at = subscription
+    headers = {"ETag": etag, "Last-Modified": formatdate(modified_at, usegmt=True)}
+    if not_modified := _not_modified(request, etag):
+        return not_modified
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "if-none-match" not in request.headers:
+        try:
+            if int(modified_at) <= parsedate_to_datetime(if_modified_since).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    return Response(content=blob, media_type="text/plain", headers=headers)
+
+
 @app.delete("/delete_config/{target_server}/")
 async def delete_config(target_server: str, config_uuid: str):
     """
@@ -106,11 +373,15 @@ async def deactivate_configs(
     
     try:
         # Асинхронно вызываем функцию деактивации конфигов
-        await xray_config.deactivate_user_configs_in_xray(
+        success = await xray_config.deactivate_user_configs_in_xray(
             uuids=config_uuids
         )
+        if not success:
+            raise HTTPException(status_code=500, detail="Не удалось деактивировать конфиги.")
         return {"message": f"Configs deactivated successfully."}
     
+    except PartialCommitError as e:
+        raise _partial_failure(e)
     except Exception as e:
         # Обрабатываем возможные ошибки и возвращаем сообщение об ошибке
         raise HTTPException(
@@ -130,13 +401,20 @@ async def get_server_stats():
     try:
         # Читаем количество активных клиентов
         active_clients = await xray_config.get_active_client_count()  # Функция для подсчета клиентов
+        inbounds = await xray_config.get_inbound_stats()  # Клиенты по каждому инбаунду
 
         # Возвращаем статистику
         return {
             "server_domain": config.domain_name,  # Домен сервера
             "server_country": config.server_country,  # Название страны
             "server_country_code": config.server_country_code,  # Код страны
-            "active_clients": active_clients  # Количество активных клиентов
+            "active_clients": active_clients,  # Количество активных клиентов
+            "restarts_avoided": xray_config.restarts_avoided,  # Изменения, применённые без рестарта
+            "inbounds": inbounds,
+            "pool": xray_config.get_pool_stats(),  # Заполненность пула слотов
+            "online_clients": presence.online_count() if config.xray_access_log else None,  # Подключались за окно
+            "admission": admission.summary(),  # Занятые слоты допуска и отказы по классам
+            "mutation_queue": xray_config.get_queue_stats(),  # Очередь коммитов и ожидание по приоритетам
         }
 
     except Exception as e:
@@ -155,24 +433,181 @@ async def cleanup_configs(target_server: str, valid_uuids: dict):
         if not valid_uuids_list:
             raise HTTPException(status_code=400, detail="Список валидных UUID пуст")
 
-        # Получаем все текущие UUID с сервера
-        all_uuids = await xray_config.get_all_uuids()
+        # Удаляем невалидные UUID (те, которых нет в списке валидных) одним проходом
+        delta = await xray_config.reconcile_clients(valid_uuids_list, add_missing=False)
 
-        # Находим невалидные (те, которых нет в списке валидных)
-        invalid_uuids = list(set(all_uuids) - set(valid_uuids_list))
-
-        if not invalid_uuids:
-            return {"status": "success", "message": "Нет невалидных конфигов для удаления"}
-
-        # Удаляем невалидные UUID
-        success = await xray_config.disconnect_many_uuids(invalid_uuids)
-
-        if success:
-            return {"status": "success", "removed_count": len(invalid_uuids)}
-        else:
+        if delta is None:
             raise HTTPException(status_code=500, detail="Ошибка при удалении конфигов")
+        if not delta["removed"]:
+            return {"status": "success", "message": "Нет невалидных конфигов для удаления"}
+        return {"status": "success", "removed_count": delta["removed"]}
 
+    except PartialCommitError as e:
+        raise _partial_failure(e)
     except Exception as e:
         logger.error(f"Ошибка при очистке конфигов: {e}")
         raise HTTPException(status_code=500, detail="Не удалось очистить конфигурацию")
 
+
+
+@app.post("/reconcile_configs/{target_server}/")
+async def reconcile_configs(
+    target_server: str,
+    config_uuids: list[str] = Body(..., embed=True)
+):
+    """
+    Полная синхронизация: принимаем полный список активных UUID,
+    добавляем недостающие и удаляем лишние конфиги одним коммитом.
+    """
+    if not config_uuids:
+        raise HTTPException(status_code=400, detail="Список config_uuids не может быть пустым.")
+
+    delta = await xray_config.reconcile_clients(config_uuids)
+    if delta is None:
+        raise HTTPException(status_code=500, detail="Не удалось синхронизировать конфиги.")
+
+    return {"status": "success", **delta, "total": len(set(config_uuids))}
+
+
+@app.get("/changes")
+async def get_changes(request: Request, since: int, epoch: str | None = None):
+    """
+    Дельта-синхронизация: uuid, добавленные и удалённые после поколения since.
+    Если история уже вытеснена (или сменилась эпоха) - resync=true,
+    и нужно забрать полный список через /uuids.
+    """
+    await xray_config.get_generation()
+    changelog = xray_config.changelog
+    etag = f'"{changelog.epoch}-{changelog.generation}-{since}"'
+    if not_modified := _not_modified(request, etag):
+        return not_modified
+    return JSONResponse(await xray_config.get_changes(since, epoch=epoch), headers={"ETag": etag})
+
+
+@app.get("/uuids")
+async def get_uuids(request: Request):
+    """
+    Полный список uuid вместе с текущим поколением для полной ресинхронизации.
+    """
+    generation = await xray_config.get_generation()
+    changelog = xray_config.changelog
+    etag = f'"{changelog.epoch}-{generation}"'
+    if not_modified := _not_modified(request, etag):
+        return not_modified
+    return JSONResponse({
+        "epoch": changelog.epoch,
+        "generation": generation,
+        "uuids": await xray_config.get_all_uuids(),
+    }, headers={"ETag": etag})
+
+
+@app.get("/expiries")
+async def get_expiries(limit: int = 100):
+    """
+    Ближайшие истечения сроков конфигов и их общее число.
+    """
+    if not 0 < limit <= 1000:
+        raise HTTPException(status_code=400, detail="0 < limit <= 1000")
+    return xray_config.get_upcoming_expiries(limit)
+
+
+@app.get("/snapshots")
+async def list_snapshots():
+    """
+    Последние сохранённые версии config.json, новые первыми.
+    """
+    return {"snapshots": xray_config.list_snapshots()}
+
+
+@app.post("/snapshots/{snapshot_id}/restore")
+async def restore_snapshot(snapshot_id: str):
+    """
+    Откатывает config.json к указанному снапшоту и перезапускает Xray.
+    """
+    try:
+        restored = await xray_config.restore_snapshot(snapshot_id)
+    except SnapshotNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not restored:
+        raise HTTPException(status_code=500, detail="Не удалось восстановить конфиг из снапшота")
+    return {"status": "success", "snapshot_id": snapshot_id}
+
+
+@app.get("/clients")
+async def list_clients(
+    cursor: str | None = None,
+    limit: int = 1000,
+    network: str | None = None,
+    tag: str | None = None,
+    uuid_prefix: str | None = None,
+):
+    """
+    Клиенты с инбаундом и flow, постранично по uuid.
+    Следующая страница - с cursor=next_cursor, пока он не станет null.
+    """
+    if not 0 < limit <= 10000:
+        raise HTTPException(status_code=400, detail="0 < limit <= 10000")
+    return await xray_config.list_clients(
+        cursor=cursor, limit=limit, network=network, tag=tag, uuid_prefix=uuid_prefix
+    )
+
+
+@app.get("/clients.ndjson")
+async def export_clients(network: str | None = None, tag: str | None = None, uuid_prefix: str | None = None):
+    """
+    Потоковая выгрузка всех клиентов в NDJSON (по строке на клиента).
+    """
+    return StreamingResponse(
+        xray_config.iter_clients_ndjson(network=network, tag=tag, uuid_prefix=uuid_prefix),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.get("/users/{user_id}/configs")
+async def get_user_configs(user_id: int):
+    """
+    Конфиги пользователя по telegram id из SQLite-хранилища (индексный поиск).
+    Деактивированные тоже возвращаются, с active=false и без ссылки.
+    """
+    configs = await xray_config.get_user_configs(user_id)
+    if configs is None:
+        raise HTTPException(status_code=404, detail="XRAY_STORE_PATH не задан")
+    return {"user_id": user_id, "configs": configs}
+
+
+@app.get("/stats/users")
+async def get_users_traffic(offset: int = 0, limit: int = 100):
+    """
+    Трафик пользователей из памяти, отсортирован по объёму (top-N с пагинацией).
+    """
+    if offset < 0 or not 0 < limit <= 1000:
+        raise HTTPException(status_code=400, detail="offset >= 0, 0 < limit <= 1000")
+    return {"users": traffic_stats.top_users(offset=offset, limit=limit)}
+
+
+@app.get("/stats/online")
+async def get_online_users(limit: int = 100, config_uuid: str | None = None):
+    """
+    Кто онлайн по access-логу xray: число за окно и последние подключения.
+    С config_uuid - время последнего подключения конкретного пользователя.
+    """
+    if not config.xray_access_log:
+        raise HTTPException(status_code=404, detail="XRAY_ACCESS_LOG не задан")
+    if config_uuid is not None:
+        return {"config_uuid": config_uuid, "last_seen": presence.last_seen(config_uuid)}
+    if not 0 < limit <= 1000:
+        raise HTTPException(status_code=400, detail="0 < limit <= 1000")
+    return {
+        **presence.summary(),
+        "users": [{"config_uuid": uuid, "last_seen": seen_at} for uuid, seen_at in presence.online(limit)],
+    }
+
+
+@app.get("/stats/summary")
+async def get_traffic_summary():
+    """
+    Суммарный трафик сервера и по инбаундам.
+    """
+    return traffic_stats.summary()
@@ -0,0 +1,93 @@
+"""Admission control for mutating requests.
+
+Every request of a kind holds a slot until it is answered. When a kind
+has no free slot, or the caller already holds `per_caller` slots, the
+request is rejected at once with a Retry-After hint instead of joining an
+unbounded backlog. The hint is the smoothed latency of the kind, i.e.
+about when a slot frees up.
+"""
+
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from app.data import config
+from app.utils.metrics import metrics
+
+ADMISSION_REJECTED = metrics.counter(
+    "admission_rejected_total", "Mutating requests rejected with 429", ("kind", "reason")
+)
+ADMISSION_SECONDS = metrics.histogram(
+    "admission_request_duration_seconds", "Latency of admitted mutating requests", ("kind",)
+)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, kind: str, reason: str, retry_after: int):
+        self.kind = kind
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def __str__(self):
+        if self.reason == "caller_limit":
+            return "Too many concurrent requests from this caller"
+        return f"Server is busy with {self.kind} requests, retry later"
+
+
+class AdmissionController:
+    def __init__(self, limits: dict[str, int], per_caller: int = 0):
+        self._limits = limits
+        self._per_caller = per_caller
+        self._inflight: dict[str, int] = dict.fromkeys(limits, 0)
+        self._callers: defaultdict[str, int] = defaultdict(int)
+        self._latency: dict[str, float] = dict.fromkeys(limits, 0.0)
+        self._rejected: dict[str, int] = dict.fromkeys(limits, 0)
+        metrics.gauge(
+            "admission_inflight", "Admitted mutating requests not yet answered", ("kind",),
+            callback=lambda: {(name,): count for name, count in self._inflight.items()},
+        )
+
+    def _reject(self, kind: str, reason: str):
+        self._rejected[kind] += 1
+        ADMISSION_REJECTED.inc(kind=kind, reason=reason)
+        raise AdmissionRejected(kind, reason, max(1, math.ceil(self._latency[kind])))
+
+    @contextmanager
+    def admit(self, kind: str, caller: str):
+        """Hold a slot of the kind for the caller, raises AdmissionRejected when full"""
+        if self._inflight[kind] >= self._limits[kind]:
+            self._reject(kind, "overloaded")
+        if self._per_caller and self._callers[caller] >= self._per_caller:
+            self._reject(kind, "caller_limit")
+
+        self._inflight[kind] += 1
+        self._callers[caller] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            ADMISSION_SECONDS.observe(elapsed, kind=kind)
+            self._latency[kind] += 0.2 * (elapsed - self._latency[kind])
+            self._inflight[kind] -= 1
+            self._callers[caller] -= 1
+            if not self._callers[caller]:
+                del self._callers[caller]
+
+    def summary(self) -> dict:
+        return {
+            name: {
+                "inflight": self._inflight[name],
+                "limit": limit,
+                "latency_seconds": round(self._latency[name], 4),
+                "rejected": self._rejected[name],
+            }
+            for name, limit in self._limits.items()
+        }
+
+
+admission = AdmissionController(
+    {"interactive": config.admission_interactive_limit, "bulk": config.admission_bulk_limit},
+    per_caller=config.admission_per_caller,
+)
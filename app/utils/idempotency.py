@@ -0,0 +1,286 @@
+"""Results of mutating requests by Idempotency-Key.
+
+Completed responses are kept for `ttl` seconds (at most `max_items`, oldest
+evicted first), so a retry after an API restart still gets the original
+answer. A duplicate arriving while the first request is still running
+waits for it instead of executing again. A single API process journals
+keys to a JSON-lines file; with the SQLite client store (several worker
+processes) they live in the store, so a retry reaching another worker is
+deduplicated too.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from app.data import config
+from app.utils.metrics import metrics
+
+IDEMPOTENT_REPLAYS = metrics.counter(
+    "idempotent_replays_total", "Requests answered from the idempotency store", ("source",)
+)
+
+
+class IdempotencyKeyReused(Exception):
+    def __init__(self, key: str):
+        self.key = key
+
+    def __str__(self):
+        return f"Idempotency-Key {self.key} was used for a different request"
+
+
+class IdempotencyStore:
+    """In-memory keys with a JSON-lines journal, for a single API process"""
+
+    def __init__(self, path: str, ttl: float = 86400, max_items: int = 100000):
+        self._path = path
+        self._ttl = ttl
+        self._max_items = max_items
+        # key -> (expires_at, fingerprint, status_code, media_type, body)
+        self._results: OrderedDict[str, tuple] = OrderedDict()
+        self._inflight: dict[str, tuple[str, asyncio.Future]] = {}
+        self._journal_lines = 0
+        self._loaded = False
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    self._journal_lines += 1
+                    try:
+                        key, *entry = json.loads(line)
+                    except ValueError:
+                        continue  # Недописанная строка после падения
+                    self._results[key] = tuple(entry)
+                    self._results.move_to_end(key)
+        except FileNotFoundError:
+            return
+        self._evict()
+        logger.info(f"Loaded {len(self._results)} idempotency keys")
+
+    def _evict(self):
+        now = time.time()
+        while self._results:
+            key, entry = next(iter(self._results.items()))
+            if entry[0] > now and len(self._results) <= self._max_items:
+                break
+            self._results.popitem(last=False)
+
+    def _append(self, key: str, entry: tuple):
+        try:
+            with open(self._path, "a") as f:
+                f.write(json.dumps([key, *entry]) + "\n")
+            self._journal_lines += 1
+            if self._journal_lines > 2 * max(len(self._results), 1000):
+                self._compact()
+        except OSError as e:
+            logger.warning(f"Could not persist idempotency key: {e}")
+
+    def _compact(self):
+        """Rewrite the journal with live entries only"""
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            for key, entry in self._results.items():
+                f.write(json.dumps([key, *entry]) + "\n")
+        os.replace(tmp_path, self._path)
+        self._journal_lines = len(self._results)
+
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        execute: Callable[[], Awaitable[tuple[int, str, bytes]]],
+    ) -> tuple[int, str, bytes, bool]:
+        """Execute once per key: (status_code, media_type, body, replayed).
+
+        Raises IdempotencyKeyReused if the key came with another request.
+        Responses with status >= 500 or 429 (not admitted) are not stored,
+        so they can be retried.
+        """
+        if not self._loaded:
+            self._load()
+        self._evict()
+
+        entry = self._results.get(key)
+        if entry is not None:
+            if entry[1] != fingerprint:
+                raise IdempotencyKeyReused(key)
+            IDEMPOTENT_REPLAYS.inc(source="store")
+            _, _, status_code, media_type, body = entry
+            return status_code, media_type, body.encode(), True
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            if inflight[0] != fingerprint:
+                raise IdempotencyKeyReused(key)
+            try:
+                status_code, media_type, body = await asyncio.shield(inflight[1])
+            except asyncio.CancelledError:
+                if not inflight[1].cancelled():
+                    raise
+                # Первый запрос оборвали, выполняем сами
+                return await self.run(key, fingerprint, execute)
+            IDEMPOTENT_REPLAYS.inc(source="inflight")
+            return status_code, media_type, body, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (fingerprint, future)
+        try:
+            status_code, media_type, body = await execute()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Не логировать "exception was never retrieved"
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result((status_code, media_type, body))
+
+        if status_code < 500 and status_code != 429:
+            entry = (time.time() + self._ttl, fingerprint, status_code, media_type, body.decode())
+            self._results[key] = entry
+            self._append(key, entry)
+            self._evict()
+        return status_code, media_type, body, False
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    status_code INTEGER,
+    media_type TEXT,
+    body BLOB
+);
+CREATE INDEX IF NOT EXISTS idempotency_expires_at ON idempotency (expires_at);
+"""
+
+
+class SharedIdempotencyStore:
+    """Keys in the SQLite client store, shared by all worker processes.
+
+    The first request claims its key with a pending row (no status yet), a
+    duplicate on any worker polls until the row is completed instead of
+    executing again. A claim left pending for `claim_timeout` seconds
+    (its worker died) is taken over. SQLite calls run in a thread.
+    """
+
+    def __init__(self, path: str, ttl: float = 86400, max_items: int = 100000, claim_timeout: float = 600):
+        self._path = path
+        self._ttl = ttl
+        self._max_items = max_items
+        self._claim_timeout = claim_timeout
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._completed = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+    def _claim(self, key: str, fingerprint: str) -> tuple | None:
+        """None if the key is ours now, else (fingerprint, status_code, media_type, body)"""
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT fingerprint, status_code, media_type, body, expires_at FROM idempotency WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                # Истёкший результат или брошенная заявка - ключ свободен
+                if row is None or row[4] <= now:
+                    db.execute(
+                        "INSERT OR REPLACE INTO idempotency (key, fingerprint, expires_at) VALUES (?, ?, ?)",
+                        (key, fingerprint, now + self._claim_timeout),
+                    )
+                    row = None
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return row[:4] if row is not None else None
+
+    def _complete(self, key: str, status_code: int, media_type: str, body: bytes):
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                "UPDATE idempotency SET status_code = ?, media_type = ?, body = ?, expires_at = ? WHERE key = ?",
+                (status_code, media_type, body, now + self._ttl, key),
+            )
+            self._completed += 1
+            if self._completed % 100 == 0:
+                db.execute("DELETE FROM idempotency WHERE expires_at <= ?", (now,))
+                db.execute(
+                    "DELETE FROM idempotency WHERE key IN (SELECT key FROM idempotency WHERE status_code IS NOT NULL"
+                    " ORDER BY expires_at LIMIT max(0, (SELECT COUNT(*) FROM idempotency) - ?))",
+                    (self._max_items,),
+                )
+
+    def _release(self, key: str):
+        with self._lock:
+            self._connection().execute("DELETE FROM idempotency WHERE key = ? AND status_code IS NULL", (key,))
+
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        execute: Callable[[], Awaitable[tuple[int, str, bytes]]],
+    ) -> tuple[int, str, bytes, bool]:
+        """Same contract as IdempotencyStore.run"""
+        waited = False
+        delay = 0.01
+        while (row := await asyncio.to_thread(self._claim, key, fingerprint)) is not None:
+            stored_fingerprint, status_code, media_type, body = row
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyKeyReused(key)
+            if status_code is not None:
+                IDEMPOTENT_REPLAYS.inc(source="inflight" if waited else "store")
+                return status_code, media_type, body, True
+            # Первый запрос ещё выполняется, возможно в другом воркере
+            waited = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+        try:
+            status_code, media_type, body = await execute()
+        except BaseException:
+            # Синхронно: заявку снимаем и при отмене, повтор выполнится заново
+            self._release(key)
+            raise
+        if status_code < 500 and status_code != 429:
+            await asyncio.to_thread(self._complete, key, status_code, media_type, body)
+        else:
+            await asyncio.to_thread(self._release, key)
+        return status_code, media_type, body, False
+
+
+idempotency_store = (
+    SharedIdempotencyStore(
+        config.xray_store_path,
+        ttl=config.idempotency_ttl,
+        max_items=config.idempotency_max_keys,
+    )
+    if config.xray_store_path
+    else IdempotencyStore(
+        config.idempotency_store_path,
+        ttl=config.idempotency_ttl,
+        max_items=config.idempotency_max_keys,
+    )
+)
@@ -1,45 +1,93 @@
-import requests
+import ipaddress
+
+import httpx
+
+
+class IPInfoError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+
+    def __str__(self):
+        return self.message
 
 
 class IPInfo:
-    def __init__(self):
-        self._ipfy_url = "https://api.ipify.org?format=json"
+    def __init__(self, timeout: float = 3.0):
+        # Несколько источников: первый ответивший выигрывает
+        self._ip_urls = [
+            "https://api.ipify.org?format=json",
+            "https://ifconfig.me/ip",
+            "https://icanhazip.com",
+        ]
         self._ipapi_url = "http://ip-api.com"
+        self._timeout = timeout
+        self._location: dict[str, str] | None = None
 
-    def get_server_ip(self) -> str:
+    async def get_server_ip(self) -> str:
         """Get server ip
 
         Returns:
             str: server ip
         """
-        response = requests.get(self._ipfy_url)
-        return response.json()["ip"]
+        errors = []
+        async with httpx.AsyncClient(timeout=self._timeout) as client:
+            for url in self._ip_urls:
+                try:
+                    response = await client.get(url)
+                    response.raise_for_status()
+                    if "json" in response.headers.get("content-type", ""):
+                        server_ip = response.json()["ip"]
+                    else:
+                        server_ip = response.text.strip()
+                    return str(ipaddress.ip_address(server_ip))
+                except (httpx.HTTPError, KeyError, ValueError) as e:
+                    errors.append(f"{url}: {e!r}")
+        raise IPInfoError(f"Could not resolve server ip: {'; '.join(errors)}")
+
+    async def get_server_location(self, server_ip: str | None = None) -> dict[str, str]:
+        """Get server country name and code with a single lookup
 
-    def get_server_country_name(self) -> str:
+        Returns:
+            dict[str, str]: {"country": ..., "country_code": ...}
+        """
+        if self._location is None:
+            server_ip = server_ip or await self.get_server_ip()
+            try:
+                async with httpx.AsyncClient(timeout=self._timeout) as client:
+                    response = await client.get(f"{self._ipapi_url}/json/{server_ip}")
+                    data = response.json()
+                self._location = {
+                    "country": data["country"],
+                    "country_code": data["countryCode"],
+                }
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                raise IPInfoError(f"Could not resolve server location: {e!r}")
+        return self._location
+
+    async def get_server_country_name(self) -> str:
         """Get server ip country name
 
         Returns:
-            tuple[str, str]: tuple of country name and
+            str: server country name
         """
-        server_ip = self.get_server_ip()
-        response = requests.get(f"{self._ipapi_url}/json/{server_ip}")
-        return response.json()["country"]
+        return (await self.get_server_location())["country"]
 
-    def get_server_country_code(self) -> str:
+    async def get_server_country_code(self) -> str:
         """Get server ip country code
 
         Returns:
             str: server ip country code
         """
-        server_ip = self.get_server_ip()
-        response = requests.get(f"{self._ipapi_url}/json/{server_ip}")
-        return response.json()["countryCode"]
+        return (await self.get_server_location())["country_code"]
 
 
 if __name__ == "__main__":
     import asyncio
 
-    ip_info = IPInfo()
-    print(ip_info.get_server_country_name())
-    print(ip_info.get_server_country_code())
-    print(ip_info.get_server_ip())
+    async def main():
+        ip_info = IPInfo()
+        print(await ip_info.get_server_country_name())
+        print(await ip_info.get_server_country_code())
+        print(await ip_info.get_server_ip())
+
+    asyncio.run(main())
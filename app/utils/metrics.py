@@ -0,0 +1,183 @@
+"""Minimal Prometheus-style metrics without external dependencies.
+
+When metrics are disabled the `timed` decorator returns the function
+unchanged and every observe/inc returns immediately, so instrumented hot
+paths cost next to nothing.
+"""
+
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from app.data import config
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str, labelnames: tuple):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not self._registry.enabled:
+            return
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, callback: Callable[[], dict[tuple, float]] | None = None):
+        super().__init__(*args)
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        if not self._registry.enabled:
+            return
+        self._values[self._key(labels)] = value
+
+    def render(self) -> list[str]:
+        if self._callback is not None:
+            self._values = self._callback()
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(*args)
+        self._buckets = buckets
+
+    def observe(self, value: float, **labels):
+        if not self._registry.enabled:
+            return
+        key = self._key(labels)
+        # [счётчики по бакетам..., +Inf, сумма]
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * (len(self._buckets) + 2)
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        else:
+            state[len(self._buckets)] += 1
+        state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        if not self._registry.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self._buckets, "+Inf"), state):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            plain_labels = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain_labels} {state[-1]}")
+            lines.append(f"{self.name}_count{plain_labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = (), callback=None) -> Gauge:
+        return self._register(Gauge(self, name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labelnames, buckets=buckets))
+
+    def timed(self, histogram: Histogram, **labels):
+        """Decorator recording duration of a sync or async function"""
+
+        def decorator(func):
+            if not self.enabled:
+                return func
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with histogram.time(**labels):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(enabled=config.metrics_enabled)
+
+XRAY_OPERATION_SECONDS = metrics.histogram(
+    "xray_operation_duration_seconds",
+    "Duration of config load/save and xray restart",
+    ("operation",),
+)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Measure how late the event loop wakes up a sleeping task"""
+    lag = metrics.histogram("event_loop_lag_seconds", "Event loop wake-up delay")
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, time.perf_counter() - started - interval))
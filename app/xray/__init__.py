@@ -1,5 +1,34 @@
-from .xray_configuration import XrayConfiguration
+"""Shared Xray services, built on first access.
 
-xray_config = XrayConfiguration()
+Building them reads the .env, so importing a light submodule such as
+proto or fake_api does not need a configured server.
+"""
 
-__all__ = ["xray_config"]
+__all__ = ["xray_config", "traffic_stats", "presence"]
+
+
+def __getattr__(name: str):
+    if name not in __all__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from app.data import config
+
+    from .api_client import XrayApiClient
+    from .presence import AccessLogPresence
+    from .traffic_stats import TrafficStats
+    from .xray_configuration import XrayConfiguration
+
+    globals().update(
+        xray_config=XrayConfiguration(),
+        traffic_stats=TrafficStats(
+            XrayApiClient(config.xray_api_address, timeout=config.xray_api_timeout),
+            interval=config.xray_stats_interval,
+        ),
+        presence=AccessLogPresence(
+            config.xray_access_log,
+            state_path=config.xray_access_log_state_path,
+            window=config.xray_presence_window,
+            retention=config.xray_presence_retention,
+        ),
+    )
+    return globals()[name]
@@ -0,0 +1,74 @@
+from loguru import logger
+
+try:
+    import grpc
+except ImportError:  # grpcio нужен только живому применению и статистике, режим restart без него работает
+    grpc = None
+
+from . import proto
+
+
+class XrayApiError(Exception):
+    def __init__(self, operation: str, details: str):
+        self.operation = operation
+        self.details = details
+
+    def __str__(self):
+        return f"Xray API {self.operation} failed: {self.details}"
+
+    @property
+    def not_found(self) -> bool:
+        """Xray reports a missing user (or inbound) only in the message text"""
+        return "not found" in self.details.lower()
+
+
+class XrayApiClient:
+    """Thin async client for Xray's HandlerService (AlterInbound)"""
+
+    def __init__(self, address: str, timeout: float = 5.0):
+        self._address = address
+        self._timeout = timeout
+        self._channel: "grpc.aio.Channel | None" = None
+
+    def _get_channel(self) -> "grpc.aio.Channel":
+        if grpc is None:
+            raise XrayApiError("connect", "grpcio is not installed")
+        if self._channel is None:
+            self._channel = grpc.aio.insecure_channel(self._address)
+        return self._channel
+
+    async def _alter_inbound(self, operation: str, request: bytes):
+        method = self._get_channel().unary_unary(proto.ALTER_INBOUND_METHOD)
+        try:
+            await method(request, timeout=self._timeout)
+        except grpc.aio.AioRpcError as e:
+            raise XrayApiError(operation, f"{e.code().name}: {e.details()}") from e
+
+    async def add_user(self, inbound_tag: str, client: dict):
+        """Add client to running inbound without restart"""
+        await self._alter_inbound(
+            "add_user", proto.alter_inbound_add_user(inbound_tag, client)
+        )
+
+    async def remove_user(self, inbound_tag: str, email: str):
+        """Remove client from running inbound without restart"""
+        await self._alter_inbound(
+            "remove_user", proto.alter_inbound_remove_user(inbound_tag, email)
+        )
+
+    async def query_stats(self, pattern: str = "", reset: bool = False) -> dict[str, int]:
+        """All counters matching pattern in one StatsService.QueryStats call"""
+        method = self._get_channel().unary_unary(proto.QUERY_STATS_METHOD)
+        try:
+            response = await method(
+                proto.query_stats_request(pattern, reset), timeout=self._timeout
+            )
+        except grpc.aio.AioRpcError as e:
+            raise XrayApiError("query_stats", f"{e.code().name}: {e.details()}") from e
+        return proto.decode_query_stats_response(response)
+
+    async def close(self):
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+            logger.debug(f"Closed Xray API channel to {self._address}")
@@ -0,0 +1,175 @@
+import sqlite3
+import threading
+import uuid
+from collections import deque
+from typing import Iterable
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS changelog_head (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    epoch TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    oldest INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changelog (
+    generation INTEGER NOT NULL,
+    uuid TEXT NOT NULL,
+    present INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changelog_generation ON changelog (generation);
+"""
+
+
+def _net_changes(generation: int, epoch: str, changes: Iterable[tuple[str, bool]]) -> dict:
+    # Последняя операция над uuid определяет итог
+    state: dict[str, bool] = {}
+    for user_uuid, present in changes:
+        state[user_uuid] = present
+    return {
+        "epoch": epoch,
+        "generation": generation,
+        "resync": False,
+        "added": [u for u, present in state.items() if present],
+        "removed": [u for u, present in state.items() if not present],
+    }
+
+
+class ChangeLog:
+    """Generation counter with a bounded log of added/removed uuids.
+
+    Every committed batch bumps the generation. The log keeps at most
+    `max_changes` uuids; once older entries are evicted, callers that are
+    behind them have to resync fully. `epoch` changes on every API start
+    and on external config edits, so stale generations are never trusted.
+    """
+
+    def __init__(self, max_changes: int = 100000):
+        self._max_changes = max_changes
+        self._entries: deque[tuple[int, tuple, tuple]] = deque()
+        self._size = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.generation = 0
+        self._oldest = 0
+
+    def refresh(self):
+        """Pick up generations recorded elsewhere (no-op for the in-memory log)"""
+
+    def record(self, added: list[str], removed: list[str]) -> int:
+        self.generation += 1
+        self._entries.append((self.generation, tuple(added), tuple(removed)))
+        self._size += len(added) + len(removed)
+        while self._size > self._max_changes and self._entries:
+            generation, old_added, old_removed = self._entries.popleft()
+            self._size -= len(old_added) + len(old_removed)
+            self._oldest = generation
+        return self.generation
+
+    def reset(self):
+        """Forget history, e.g. after the config was edited outside the API"""
+        self._entries.clear()
+        self._size = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.generation += 1
+        self._oldest = self.generation
+
+    def _resync(self, generation: int, epoch: str | None) -> dict | None:
+        if (epoch is not None and epoch != self.epoch) or not (self._oldest <= generation <= self.generation):
+            return {"epoch": self.epoch, "generation": self.generation, "resync": True, "added": [], "removed": []}
+        return None
+
+    def since(self, generation: int, epoch: str | None = None) -> dict:
+        """Net changes after `generation`, or resync=True if history is gone"""
+        if resync := self._resync(generation, epoch):
+            return resync
+        changes = (
+            (user_uuid, present)
+            for entry_generation, added, removed in self._entries
+            if entry_generation > generation
+            for user_uuid, present in [*((u, False) for u in removed), *((u, True) for u in added)]
+        )
+        return _net_changes(self.generation, self.epoch, changes)
+
+
+class SharedChangeLog(ChangeLog):
+    """ChangeLog kept in the SQLite client store, shared by worker processes.
+
+    Whichever worker commits records the batch, so a generation means the
+    same on every worker and peer writes do not force a resync. The epoch
+    survives restarts and changes only on reset(). Methods block on
+    SQLite, run them in a thread.
+    """
+
+    def __init__(self, path: str, max_changes: int = 100000):
+        super().__init__(max_changes)
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def _head(self) -> tuple[str, int, int, int]:
+        row = self._db.execute("SELECT epoch, generation, oldest, size FROM changelog_head").fetchone()
+        if row is None:
+            self._db.execute("INSERT OR IGNORE INTO changelog_head VALUES (0, ?, 0, 0, 0)", (uuid.uuid4().hex[:12],))
+            row = self._db.execute("SELECT epoch, generation, oldest, size FROM changelog_head").fetchone()
+        return row
+
+    def _write(self, update):
+        """Run update(epoch, generation, oldest, size) -> new head in a write transaction"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                head = update(*self._head())
+                self._db.execute(
+                    "UPDATE changelog_head SET epoch = ?, generation = ?, oldest = ?, size = ?", head
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self.epoch, self.generation, self._oldest, self._size = head
+
+    def refresh(self):
+        with self._lock:
+            self.epoch, self.generation, self._oldest, self._size = self._head()
+
+    def record(self, added: list[str], removed: list[str]) -> int:
+        def update(epoch, generation, oldest, size):
+            generation += 1
+            rows = [(generation, u, 0) for u in removed] + [(generation, u, 1) for u in added]
+            self._db.executemany("INSERT INTO changelog VALUES (?, ?, ?)", rows)
+            size += len(rows)
+            if size > self._max_changes:
+                # Вытесняем старые поколения целиком, как и журнал в памяти
+                [oldest] = self._db.execute(
+                    "SELECT generation FROM changelog ORDER BY rowid LIMIT 1 OFFSET ?",
+                    (size - self._max_changes - 1,),
+                ).fetchone()
+                size -= self._db.execute("DELETE FROM changelog WHERE generation <= ?", (oldest,)).rowcount
+            return epoch, generation, oldest, size
+
+        self._write(update)
+        return self.generation
+
+    def reset(self):
+        def update(epoch, generation, oldest, size):
+            self._db.execute("DELETE FROM changelog")
+            return uuid.uuid4().hex[:12], generation + 1, generation + 1, 0
+
+        self._write(update)
+
+    def since(self, generation: int, epoch: str | None = None) -> dict:
+        with self._lock:
+            # Одна читающая транзакция: голова и записи из одного снимка
+            self._db.execute("BEGIN")
+            try:
+                self.epoch, self.generation, self._oldest, self._size = self._head()
+                if resync := self._resync(generation, epoch):
+                    return resync
+                rows = self._db.execute(
+                    "SELECT uuid, present FROM changelog WHERE generation > ? ORDER BY rowid", (generation,)
+                ).fetchall()
+            finally:
+                self._db.execute("COMMIT")
+        return _net_changes(self.generation, self.epoch, ((u, bool(present)) for u, present in rows))
@@ -0,0 +1,189 @@
+import asyncio
+import fcntl
+import os
+import sqlite3
+import time
+from typing import Iterable
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    uuid TEXT PRIMARY KEY,
+    inbound TEXT NOT NULL,
+    email TEXT,
+    flow TEXT NOT NULL DEFAULT '',
+    config_name TEXT,
+    telegram_id INTEGER,
+    active INTEGER NOT NULL DEFAULT 1,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS clients_telegram_id ON clients (telegram_id) WHERE telegram_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS clients_inbound ON clients (inbound) WHERE active = 1;
+"""
+
+# Владельца не затираем NULL-ом: реактивация и пул его не знают
+_UPSERT = """
+INSERT INTO clients (uuid, inbound, email, flow, config_name, telegram_id, active, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+ON CONFLICT (uuid) DO UPDATE SET
+    inbound = excluded.inbound,
+    email = excluded.email,
+    flow = excluded.flow,
+    config_name = COALESCE(excluded.config_name, clients.config_name),
+    telegram_id = COALESCE(excluded.telegram_id, clients.telegram_id),
+    active = 1,
+    updated_at = excluded.updated_at
+"""
+
+# (uuid, inbound, email, flow, config_name, telegram_id)
+ClientRow = tuple[str, str, str | None, str, str | None, int | None]
+
+
+class FileLock:
+    """Exclusive flock shared by all API worker processes.
+
+    Also serializes coroutines of one process: flock alone does not, the
+    lock belongs to the open file, not to the caller. Acquired by polling,
+    so a cancelled waiter never leaves the lock behind.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._fd: int | None = None
+        self._held = False
+        self._local = asyncio.Lock()
+
+    def try_acquire(self) -> bool:
+        if self._held:
+            return True
+        if self._fd is None:
+            self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self._held = True
+        return True
+
+    def release(self):
+        if self._held:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._held = False
+
+    async def __aenter__(self):
+        await self._local.acquire()
+        try:
+            delay = 0.001
+            while not self.try_acquire():
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        except BaseException:
+            self._local.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+        self._local.release()
+
+
+class ClientStore:
+    """Clients with their inbound, flow and owner in SQLite (WAL mode).
+
+    The source of truth when enabled: config client lists are generated
+    from the active rows. Removed clients stay as inactive rows, so a
+    telegram id keeps its configs after deactivation. Writes are made by
+    the committing process under the config file lock; readers in other
+    workers never block on them.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._connection: sqlite3.Connection | None = None
+        self._reader: sqlite3.Connection | None = None
+        self._in_transaction = False
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_SCHEMA)
+        return connection
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = self._connect()
+        return self._connection
+
+    @property
+    def _read_db(self) -> sqlite3.Connection:
+        """Separate connection, lookups never see a transaction staged mid-commit"""
+        if self._reader is None:
+            self._reader = self._connect()
+        return self._reader
+
+    def count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM clients WHERE active = 1").fetchone()[0]
+
+    def active_clients(self) -> Iterable[tuple[str, str, str | None, str]]:
+        """(uuid, inbound, email, flow) of every active client, in insertion order"""
+        return self._db.execute("SELECT uuid, inbound, email, flow FROM clients WHERE active = 1 ORDER BY rowid")
+
+    def begin(self, upserts: list[ClientRow], deactivated: Iterable[str], replace: bool = False):
+        """Stage changes in an open transaction, finished by commit() or rollback().
+
+        replace=True deactivates every other client first, the rows become
+        the complete active set.
+        """
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        self._in_transaction = True
+        try:
+            if replace:
+                self._db.execute("UPDATE clients SET active = 0, updated_at = ? WHERE active = 1", (now,))
+            self._db.executemany(
+                "UPDATE clients SET active = 0, updated_at = ? WHERE uuid = ? AND active = 1",
+                ((now, uuid) for uuid in deactivated),
+            )
+            self._db.executemany(_UPSERT, (row + (now,) for row in upserts))
+        except BaseException:
+            self.rollback()
+            raise
+
+    def commit(self):
+        if self._in_transaction:
+            self._db.execute("COMMIT")
+            self._in_transaction = False
+
+    def rollback(self):
+        if self._in_transaction:
+            self._db.execute("ROLLBACK")
+            self._in_transaction = False
+
+    def assign(self, owners: dict[str, tuple[int | None, str | None]]):
+        """Record owners of already configured clients (slots handed out from the pool)"""
+        self._db.executemany(
+            "UPDATE clients SET telegram_id = ?, config_name = ?, updated_at = ? WHERE uuid = ?",
+            ((telegram_id, config_name, time.time(), uuid) for uuid, (telegram_id, config_name) in owners.items()),
+        )
+
+    def inbounds(self, uuids: Iterable[str]) -> dict[str, str]:
+        """uuid -> inbound tag the client was last placed on, deactivated ones included"""
+        uuids = list(uuids)
+        found = {}
+        for start in range(0, len(uuids), 500):
+            chunk = uuids[start:start + 500]
+            found.update(self._read_db.execute(
+                f"SELECT uuid, inbound FROM clients WHERE uuid IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        return found
+
+    def by_telegram_id(self, telegram_id: int) -> list[dict]:
+        rows = self._read_db.execute(
+            "SELECT uuid, config_name, inbound, active, updated_at FROM clients WHERE telegram_id = ? ORDER BY rowid",
+            (telegram_id,),
+        )
+        return [
+            {"uuid": uuid, "config_name": config_name, "inbound": inbound, "active": bool(active), "updated_at": updated_at}
+            for uuid, config_name, inbound, active, updated_at in rows
+        ]
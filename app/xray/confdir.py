@@ -0,0 +1,58 @@
+"""Convert a monolithic xray config.json into the confdir layout.
+
+    python -m app.xray.confdir /usr/local/etc/xray/config.json /usr/local/etc/xray/confdir
+
+Every inbound with a clients list goes whole into its own fragment file,
+everything else (log, api, routing, outbounds, inbounds without clients)
+stays in 00_base.json, which the API never rewrites. The source file is
+left as is. Afterwards run xray with `-confdir` and set XRAY_CONFDIR.
+"""
+
+import json
+import os
+import sys
+
+from .config_cache import fragment_path
+from .snapshots import write_atomic
+
+BASE_FILE = "00_base.json"
+
+
+def migrate(config_path: str, confdir: str) -> list[str]:
+    """Split config_path into confdir, returns written files"""
+    with open(config_path) as f:
+        data = json.load(f)
+    if os.path.isdir(confdir) and os.listdir(confdir):
+        raise ValueError(f"{confdir} is not empty")
+    os.makedirs(confdir, exist_ok=True)
+
+    static_inbounds = []
+    fragments = {}
+    for i, inbound in enumerate(data.get("inbounds", [])):
+        if "clients" not in inbound.get("settings", {}):
+            static_inbounds.append(inbound)
+            continue
+        # По тегу xray сопоставляет инбаунды из разных файлов
+        inbound.setdefault("tag", f"inbound_{i}")
+        path = fragment_path(confdir, inbound["tag"])
+        if path in fragments:
+            raise ValueError(f"Duplicated inbound tag {inbound['tag']}")
+        fragments[path] = inbound
+
+    base_path = os.path.join(confdir, BASE_FILE)
+    write_atomic(base_path, json.dumps(dict(data, inbounds=static_inbounds), indent=4).encode())
+    for path, inbound in fragments.items():
+        write_atomic(path, json.dumps({"inbounds": [inbound]}, separators=(",", ":")).encode())
+    return [base_path, *fragments]
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+    for path in migrate(sys.argv[1], sys.argv[2]):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
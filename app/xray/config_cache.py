@@ -0,0 +1,319 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+
+import aiofiles
+from loguru import logger
+
+FRAGMENT_PREFIX = "50_clients_"
+
+
+def fragment_path(confdir: str, tag: str) -> str:
+    """Confdir file holding the inbound with given tag"""
+    name = re.sub(r"[^\w.-]", "_", tag)
+    return os.path.join(confdir, f"{FRAGMENT_PREFIX}{name}.json")
+
+
+class ConfigEdit:
+    """Client changes staged against a ConfigCache, invisible to its readers.
+
+    Touched inbounds get their own copy of the client list (copy on write),
+    the cache, its index and counts change only in ConfigCache.apply(), so
+    readers never see clients of a commit that may still fail.
+    clients()/inbound_tag()/inbound_network() show the edited state, e.g.
+    to placement. Removals are staged before additions.
+    """
+
+    def __init__(self, cache: "ConfigCache"):
+        self._cache = cache
+        self.reloads = cache.reloads
+        self.staged_clients: dict[int, list[dict]] = {}
+        # uuid -> новая позиция или None (удалён), поверх cache.index
+        self.index_changes: dict[str, tuple[int, int] | None] = {}
+        self.deduplicated: set[str] = set()
+        self.added: list[tuple[int, dict]] = []
+        self.removed: list[tuple[int, dict]] = []
+
+    @property
+    def positions(self) -> set[int]:
+        return set(self.staged_clients)
+
+    def inbound_network(self, i: int) -> str:
+        return self._cache.inbound_network(i)
+
+    def inbound_tag(self, i: int) -> str | None:
+        return self._cache.inbound_tag(i)
+
+    def clients(self, i: int) -> list[dict]:
+        if i in self.staged_clients:
+            return self.staged_clients[i]
+        return self._cache.clients(i)
+
+    def inbounds(self) -> list[dict]:
+        """Inbounds with staged client lists, for serializing the candidate"""
+        inbounds = list(self._cache.inbounds)
+        for i, clients in self.staged_clients.items():
+            inbound = inbounds[i]
+            inbounds[i] = {**inbound, "settings": {**inbound.get("settings", {}), "clients": clients}}
+        return inbounds
+
+    def _own(self, i: int) -> list[dict]:
+        if i not in self.staged_clients:
+            self.staged_clients[i] = list(self._cache.clients(i))
+        return self.staged_clients[i]
+
+    def lookup(self, uuid: str) -> tuple[int, int] | None:
+        if uuid in self.index_changes:
+            return self.index_changes[uuid]
+        return self._cache.index.get(uuid)
+
+    def add(self, i: int, client: dict):
+        clients = self._own(i)
+        clients.append(client)
+        self.index_changes[client["id"]] = (i, len(clients) - 1)
+        self.added.append((i, client))
+
+    def remove(self, uuid: str) -> list[tuple[int, dict]]:
+        """Remove client(s) with uuid, returns [(inbound position, client)]"""
+        if uuid in self._cache.duplicates and uuid not in self.deduplicated:
+            return self._remove_duplicated(uuid)
+        ref = self.lookup(uuid)
+        if ref is None:
+            return []
+        i, position = ref
+        self.index_changes[uuid] = None
+        clients = self._own(i)
+        # Порядок клиентов xray не важен: переносим последнего на место удалённого
+        last = clients.pop()
+        if position < len(clients):
+            removed, clients[position] = clients[position], last
+            self.index_changes[last["id"]] = (i, position)
+        else:
+            removed = last
+        self.removed.append((i, removed))
+        return [(i, removed)]
+
+    def _remove_duplicated(self, uuid: str) -> list[tuple[int, dict]]:
+        removed = []
+        for i in range(len(self._cache.inbounds)):
+            if not any(c.get("id") == uuid for c in self.clients(i)):
+                continue
+            clients = self._own(i)
+            removed.extend((i, c) for c in clients if c.get("id") == uuid)
+            clients[:] = [c for c in clients if c.get("id") != uuid]
+            for position, client in enumerate(clients):
+                self.index_changes[client.get("id")] = (i, position)
+        self.index_changes[uuid] = None
+        self.deduplicated.add(uuid)
+        self.removed.extend(removed)
+        return removed
+
+
+class ConfigCache:
+    """Parsed xray config kept in memory together with a client index.
+
+    The file is re-read only when its (mtime, size, inode) signature changes,
+    so external edits are still picked up. Mutations are staged in a
+    ConfigEdit and applied once committed, patching the index in place
+    instead of rebuilding it.
+
+    index: uuid -> (inbound position, client position)
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._signature: tuple | None = None
+        self.data: dict = {}
+        self.index: dict[str, tuple[int, int]] = {}
+        self.network_counts: Counter = Counter()
+        self.duplicates: set[str] = set()
+        self.reloads = 0
+        self._reload_lock = asyncio.Lock()
+
+    def _stat_signature(self) -> tuple:
+        st = os.stat(self._path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    async def load(self) -> "ConfigCache":
+        """Return self, re-parsing the file if it changed on disk"""
+        if self._stat_signature() == self._signature:
+            return self
+        # Параллельные читатели ждут одно перечитывание, а не парсят файл каждый
+        async with self._reload_lock:
+            signature = self._stat_signature()
+            if signature != self._signature:
+                await self._read()
+                self._signature = signature
+                self._rebuild_index()
+                self.reloads += 1
+        return self
+
+    async def _read(self):
+        async with aiofiles.open(self._path, "r") as f:
+            self.data = json.loads(await f.read())
+
+    def paths(self) -> list[str]:
+        """Files the cached config is assembled from"""
+        return [self._path]
+
+    def documents(
+        self, positions: set[int] | None = None, inbounds: list[dict] | None = None
+    ) -> list[tuple[str, dict]]:
+        """Files to rewrite after inbounds at `positions` changed: [(path, document)].
+
+        inbounds replaces the cached ones, e.g. those of a staged edit.
+        """
+        if inbounds is None:
+            return [(self._path, self.data)]
+        return [(self._path, {**self.data, "inbounds": inbounds})]
+
+    def document_path(self, document: dict) -> str:
+        """Where a previously written document (e.g. a snapshot) belongs"""
+        return self._path
+
+    @contextmanager
+    def candidate(self, replacements: dict[str, str]):
+        """Path for `xray run -test` with files swapped for temp files"""
+        # xray выбирает формат по расширению, config.json.tmp он не прочтёт
+        directory = tempfile.mkdtemp(prefix=".candidate_", dir=os.path.dirname(os.path.abspath(self._path)))
+        try:
+            path = os.path.join(directory, os.path.basename(self._path))
+            os.symlink(os.path.abspath(replacements[self._path]), path)
+            yield path
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def refresh_signature(self):
+        """Remember signature of a file we have just written ourselves"""
+        self._signature = self._stat_signature()
+
+    def invalidate(self):
+        self._signature = None
+
+    def _rebuild_index(self):
+        self.index = {}
+        self.network_counts = Counter()
+        self.duplicates = set()
+        for i in range(len(self.inbounds)):
+            clients = self.clients(i)
+            for position, client in enumerate(clients):
+                uuid = client.get("id")
+                if uuid in self.index:
+                    self.duplicates.add(uuid)
+                self.index[uuid] = (i, position)
+            self.network_counts[self.inbound_network(i)] += len(clients)
+        if self.duplicates:
+            logger.warning(f"{len(self.duplicates)} duplicated client ids in config")
+
+    @property
+    def inbounds(self) -> list[dict]:
+        return self.data.get("inbounds", [])
+
+    def inbound_network(self, i: int) -> str:
+        return self.inbounds[i].get("streamSettings", {}).get("network", "tcp")
+
+    def inbound_tag(self, i: int) -> str | None:
+        return self.inbounds[i].get("tag")
+
+    def clients(self, i: int) -> list[dict]:
+        return self.inbounds[i].get("settings", {}).get("clients", [])
+
+    def edit(self) -> ConfigEdit:
+        return ConfigEdit(self)
+
+    def apply(self, edit: ConfigEdit):
+        """Make a committed edit visible to readers"""
+        if edit.reloads != self.reloads:
+            # Конфиг перечитали с диска посреди коммита: позиции правки устарели
+            self.invalidate()
+            return
+        for i, clients in edit.staged_clients.items():
+            self.network_counts[self.inbound_network(i)] += len(clients) - len(self.clients(i))
+            self.inbounds[i].setdefault("settings", {})["clients"] = clients
+        for uuid, ref in edit.index_changes.items():
+            if ref is None:
+                self.index.pop(uuid, None)
+            else:
+                self.index[uuid] = ref
+        self.duplicates -= edit.deduplicated
+
+
+class ConfdirCache(ConfigCache):
+    """Clients kept in per-inbound fragments of an xray confdir.
+
+    Xray loads confdir files in name order and an inbound replaces an
+    earlier one with the same tag, so each inbound with clients lives whole
+    in its own fragment and a mutation rewrites only the fragments it
+    touched. Static parts (routing, outbounds, api) stay in other files that
+    are never written. data holds only the fragment inbounds.
+    """
+
+    def __init__(self, confdir: str):
+        super().__init__(confdir)
+        self._inbound_paths: list[str] = []
+
+    def paths(self) -> list[str]:
+        return sorted(
+            os.path.join(self._path, name)
+            for name in os.listdir(self._path)
+            if name.startswith(FRAGMENT_PREFIX) and name.endswith(".json")
+        )
+
+    def _stat_signature(self) -> tuple:
+        signature = []
+        for path in self.paths():
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size, st.st_ino))
+        return tuple(signature)
+
+    async def _read(self):
+        inbounds = []
+        self._inbound_paths = []
+        for path in self.paths():
+            async with aiofiles.open(path, "r") as f:
+                fragment = json.loads(await f.read())
+            for inbound in fragment.get("inbounds", []):
+                inbounds.append(inbound)
+                self._inbound_paths.append(path)
+        self.data = {"inbounds": inbounds}
+
+    def documents(
+        self, positions: set[int] | None = None, inbounds: list[dict] | None = None
+    ) -> list[tuple[str, dict]]:
+        if inbounds is None:
+            inbounds = self.inbounds
+        if positions is None:
+            positions = range(len(inbounds))
+        touched = {self._inbound_paths[i] for i in positions}
+        return [
+            (path, {"inbounds": [
+                inbound for inbound, inbound_path in zip(inbounds, self._inbound_paths)
+                if inbound_path == path
+            ]})
+            for path in sorted(touched)
+        ]
+
+    def document_path(self, document: dict) -> str:
+        try:
+            [tag] = {inbound["tag"] for inbound in document["inbounds"]}
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Not a confdir fragment: expected inbounds sharing one tag")
+        return fragment_path(self._path, tag)
+
+    @contextmanager
+    def candidate(self, replacements: dict[str, str]):
+        # Копия confdir из симлинков, где изменённые файлы подменены временными
+        directory = tempfile.mkdtemp(prefix=".candidate_", dir=os.path.dirname(os.path.abspath(self._path)))
+        try:
+            paths = {os.path.join(self._path, name) for name in os.listdir(self._path) if name.endswith(".json")}
+            for path in paths | set(replacements):
+                source = os.path.abspath(replacements.get(path, path))
+                os.symlink(source, os.path.join(directory, os.path.basename(path)))
+            yield directory
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
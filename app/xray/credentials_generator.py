@@ -1,17 +1,22 @@
-import os
+import uuid
 
 
 class CredentialsGenerator:
-    def __init__(self) -> None:
-        self._xray_executable_path = "/usr/local/bin/xray"
+    # Xray maps custom ids (1-30 bytes) to UUIDv5 in the zero namespace,
+    # same as `xray uuid -i <seed>`
+    _xray_custom_id_namespace = uuid.UUID(int=0)
 
-    def generate_uuid(self) -> str:
-        return os.popen(f"{self._xray_executable_path} uuid").read().strip()
+    def generate_uuid(self, seed: str | None = None) -> str:
+        if seed is None:
+            return str(uuid.uuid4())
+        if not 0 < len(seed.encode()) <= 30:
+            raise ValueError("Seed must be 1-30 bytes long")
+        return str(uuid.uuid5(self._xray_custom_id_namespace, seed))
 
-    def generate_new_person(self, user_telegram_id: int) -> dict[str, str]:
-        uuid = self.generate_uuid()
+    def generate_new_person(self, user_telegram_id: int, seed: str | None = None) -> dict[str, str]:
+        user_uuid = self.generate_uuid(seed)
         return {
-            "id": uuid,
-            "email": f"{uuid}@example.com",
+            "id": user_uuid,
+            "email": f"{user_uuid}@example.com",
             "flow": "xtls-rprx-vision",
         }
@@ -0,0 +1,122 @@
+import heapq
+import json
+import os
+
+from loguru import logger
+
+
+class ExpiryIndex:
+    """When clients expire: a heap for the next due, a dict for the truth.
+
+    Heap entries that no longer match the dict (expiry moved or cleared)
+    are skipped lazily. Changes are appended to a JSON-lines journal next
+    to the config, which is compacted when it grows twice as long as the
+    live set.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._expires: dict[str, float] = {}
+        self._heap: list[tuple[float, str]] = []
+        self._journal_lines = 0
+        self._offset = 0
+        self._inode: int | None = None
+        self._load()
+        logger.info(f"Loaded {len(self._expires)} client expiries")
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+    def __contains__(self, uuid: str) -> bool:
+        return uuid in self._expires
+
+    def _load(self):
+        try:
+            with open(self._path, "rb") as f:
+                self._inode = os.fstat(f.fileno()).st_ino
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Только целые строки: хвост может дописываться прямо сейчас
+        complete = data[: data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            self._journal_lines += 1
+            try:
+                uuid, expires_at = json.loads(line)
+            except ValueError:
+                continue  # Недописанная строка после падения
+            self._apply(uuid, expires_at)
+
+    def refresh(self):
+        """Pick up journal lines appended by other worker processes.
+
+        A compacted (replaced) journal is re-read from the start.
+        """
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._expires.clear()
+            self._heap.clear()
+            self._journal_lines = 0
+            self._offset = 0
+        self._load()
+
+    def _apply(self, uuid: str, expires_at: float | None):
+        if expires_at is None:
+            self._expires.pop(uuid, None)
+        else:
+            self._expires[uuid] = expires_at
+            heapq.heappush(self._heap, (expires_at, uuid))
+
+    def update(self, changes: dict[str, float | None]):
+        """Set (timestamp) or clear (None) expiries and journal them"""
+        if not changes:
+            return
+        for uuid, expires_at in changes.items():
+            self._apply(uuid, expires_at)
+        try:
+            with open(self._path, "ab") as f:
+                f.writelines((json.dumps([uuid, ts]) + "\n").encode() for uuid, ts in changes.items())
+                self._inode = os.fstat(f.fileno()).st_ino
+                self._offset = f.tell()
+            self._journal_lines += len(changes)
+            if self._journal_lines > 2 * len(self._expires) + 1000:
+                self._compact()
+        except OSError as e:
+            logger.error(f"Could not persist client expiries: {e}")
+        if len(self._heap) > 2 * len(self._expires) + 1000:
+            self._heap = [(ts, uuid) for uuid, ts in self._expires.items()]
+            heapq.heapify(self._heap)
+
+    def _compact(self):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps([uuid, ts]) + "\n" for uuid, ts in self._expires.items())
+        os.replace(tmp_path, self._path)
+        self._journal_lines = len(self._expires)
+        st = os.stat(self._path)
+        self._inode, self._offset = st.st_ino, st.st_size
+
+    def pop_due(self, now: float, limit: int) -> list[str]:
+        """Take up to `limit` uuids expired by `now`, earliest first.
+
+        Not journaled: the removal commit clears them, a crash before that
+        makes them due again after restart.
+        """
+        due = []
+        while self._heap and len(due) < limit and self._heap[0][0] <= now:
+            expires_at, uuid = heapq.heappop(self._heap)
+            if self._expires.get(uuid) == expires_at:
+                del self._expires[uuid]
+                due.append(uuid)
+        return due
+
+    def upcoming(self, limit: int) -> list[dict]:
+        return [
+            {"uuid": uuid, "expires_at": expires_at}
+            for uuid, expires_at in heapq.nsmallest(limit, self._expires.items(), key=lambda item: item[1])
+        ]
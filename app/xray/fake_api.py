@@ -0,0 +1,119 @@
+"""Local stand-in for Xray's gRPC API.
+
+Speaks the same wire protocol as the real HandlerService and StatsService
+so live-apply and traffic stats can be exercised without an Xray binary:
+
+    python -m app.xray.fake_api 127.0.0.1:10085
+"""
+
+import asyncio
+import sys
+
+import grpc
+from loguru import logger
+
+from . import proto
+
+
+class FakeXrayApiServer:
+    def __init__(self, address: str = "127.0.0.1:0"):
+        self._address = address
+        self._server: grpc.aio.Server | None = None
+        self.port: int | None = None
+        # tag -> email -> {"id", "flow", "email"}
+        self.users: dict[str, dict[str, dict]] = {}
+        # "user>>>email>>>traffic>>>uplink" -> bytes
+        self.stats: dict[str, int] = {}
+        self.calls: int = 0
+        self.fail_next: int = 0
+
+    @property
+    def address(self) -> str:
+        host = self._address.rsplit(":", 1)[0]
+        return f"{host}:{self.port}"
+
+    async def start(self):
+        self._server = grpc.aio.server()
+        self._server.add_generic_rpc_handlers(
+            (
+                grpc.method_handlers_generic_handler(
+                    proto.HANDLER_SERVICE,
+                    {"AlterInbound": grpc.unary_unary_rpc_method_handler(self._alter_inbound)},
+                ),
+                grpc.method_handlers_generic_handler(
+                    proto.STATS_SERVICE,
+                    {"QueryStats": grpc.unary_unary_rpc_method_handler(self._query_stats)},
+                ),
+            )
+        )
+        self.port = self._server.add_insecure_port(self._address)
+        await self._server.start()
+        logger.info(f"Fake Xray API listening on {self.address}")
+
+    async def stop(self):
+        if self._server is not None:
+            await self._server.stop(grace=None)
+            self._server = None
+
+    async def _alter_inbound(self, request: bytes, context) -> bytes:
+        self.calls += 1
+        if self.fail_next:
+            self.fail_next -= 1
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "injected failure")
+
+        fields = proto.decode_message(request)
+        tag = proto.first(fields, 1, b"").decode()
+        operation = proto.decode_message(proto.first(fields, 2, b""))
+        op_type = proto.first(operation, 1, b"").decode()
+        op_value = proto.decode_message(proto.first(operation, 2, b""))
+        inbound = self.users.setdefault(tag, {})
+
+        if op_type == proto.ADD_USER_OPERATION:
+            user = proto.decode_message(proto.first(op_value, 1, b""))
+            email = proto.first(user, 2, b"").decode()
+            account = proto.decode_message(proto.first(user, 3, b""))
+            account = proto.decode_message(proto.first(account, 2, b""))
+            if email in inbound:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} already exists.")
+            inbound[email] = {
+                "id": proto.first(account, 1, b"").decode(),
+                "flow": proto.first(account, 2, b"").decode(),
+                "email": email,
+            }
+        elif op_type == proto.REMOVE_USER_OPERATION:
+            email = proto.first(op_value, 1, b"").decode()
+            if inbound.pop(email, None) is None:
+                await context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+        else:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, f"Unknown operation {op_type}")
+        return b""
+
+    def add_traffic(self, email: str, uplink: int = 0, downlink: int = 0, inbound_tag: str | None = None):
+        """Simulate traffic of a user (and its inbound)"""
+        for direction, value in (("uplink", uplink), ("downlink", downlink)):
+            name = f"user>>>{email}>>>traffic>>>{direction}"
+            self.stats[name] = self.stats.get(name, 0) + value
+            if inbound_tag:
+                name = f"inbound>>>{inbound_tag}>>>traffic>>>{direction}"
+                self.stats[name] = self.stats.get(name, 0) + value
+
+    async def _query_stats(self, request: bytes, context) -> bytes:
+        self.calls += 1
+        fields = proto.decode_message(request)
+        pattern = proto.first(fields, 1, b"").decode()
+        reset = bool(proto.first(fields, 2, 0))
+        matched = {name: value for name, value in self.stats.items() if pattern in name}
+        if reset:
+            for name in matched:
+                self.stats[name] = 0
+        return proto.query_stats_response(matched)
+
+
+async def _serve(address: str):
+    server = FakeXrayApiServer(address)
+    await server.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(_serve(sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1:10085"))
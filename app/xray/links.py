@@ -0,0 +1,74 @@
+import base64
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class LinkTemplate:
+    """VLESS link with everything but uuid and name rendered once"""
+
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        network: str,
+        path: str,
+        sni: str,
+        public_key: str,
+        short_id: str,
+        prefix: str,
+    ):
+        self.host = host
+        self.compiled_at = time.time()
+        suffix = ""
+        if network == "xhttp":
+            suffix = f"&path={path}&mode=auto"
+        elif network == "tcp":
+            suffix = "&flow=xtls-rprx-vision"
+        elif network == "grpc":
+            suffix = f"&serviceName={path}"
+        self._tail = (
+            f"@{host}:{port}"
+            f"?security=reality"
+            f"&sni={sni}"
+            f"&fp=chrome"
+            f"&pbk={public_key}"
+            f"&sid={short_id}"
+            f"&encryption=none"
+            f"&type={network}"
+            f"{suffix}"
+            f"#{prefix}_"
+        )
+        self.key = hashlib.sha1(self._tail.encode()).hexdigest()[:12]
+
+    def render(self, uuid: str, config_name: str) -> str:
+        return f"vless://{uuid}{self._tail}{config_name}"
+
+
+class SubscriptionCache:
+    """LRU of rendered base64 subscription blobs with their ETag.
+
+    Keyed by template too, so a client moved to another inbound gets a
+    fresh link; still cleared whenever templates are recompiled.
+    """
+
+    def __init__(self, max_items: int = 10000):
+        self._max_items = max_items
+        self._items: OrderedDict[tuple, tuple[bytes, str]] = OrderedDict()
+
+    def get(self, template: LinkTemplate, uuid: str, config_name: str) -> tuple[bytes, str]:
+        key = (template.key, uuid, config_name)
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+            return item
+        link = template.render(uuid, config_name)
+        blob = base64.b64encode(f"{link}\n".encode())
+        item = (blob, f'"{hashlib.sha1(blob).hexdigest()}"')
+        self._items[key] = item
+        if len(self._items) > self._max_items:
+            self._items.popitem(last=False)
+        return item
+
+    def clear(self):
+        self._items.clear()
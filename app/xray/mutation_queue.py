@@ -0,0 +1,163 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from app.utils.metrics import metrics
+
+# Приоритеты мутаций: регистрация пользователей не ждёт массовое обслуживание
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = ("interactive", "bulk")
+
+MUTATION_WAIT_SECONDS = metrics.histogram(
+    "xray_mutation_wait_seconds", "Time from submit until the mutation is taken into a batch", ("priority",)
+)
+
+
+@dataclass
+class AddClients:
+    """Add clients to the target inbound, existing uuids are skipped.
+
+    expires: uuid -> unix time of expiry; clients not in it never expire.
+    owners: uuid -> (telegram id, config name), kept in the client store.
+    readd: clients existed before (reactivation), they go back to the
+    inbound their links point to instead of through placement.
+    """
+
+    clients: list[dict]
+    expires: dict[str, float] = field(default_factory=dict)
+    owners: dict[str, tuple[int, str]] = field(default_factory=dict)
+    readd: bool = False
+
+
+@dataclass
+class RemoveClients:
+    """Remove clients with given uuids from every inbound"""
+
+    uuids: set[str] = field(default_factory=set)
+
+
+@dataclass
+class SyncClients:
+    """Converge configured clients to the desired uuid set.
+
+    Missing uuids are added back to their previous inbound, clients not
+    in the set are removed.
+    """
+
+    uuids: set[str] = field(default_factory=set)
+
+
+Mutation = AddClients | RemoveClients | SyncClients
+
+
+class CommitError(Exception):
+    def __str__(self):
+        return "Failed to commit config changes"
+
+
+class PartialCommitError(Exception):
+    """Some chunks of a bulk operation were committed, the others failed.
+
+    Not a CommitError: callers must not report the applied part as
+    nothing done. results holds the results of the committed chunks.
+    """
+
+    def __init__(self, applied: list[str], failed: list[str], results: list):
+        self.applied = applied
+        self.failed = failed
+        self.results = results
+
+    def __str__(self):
+        return f"Committed {len(self.applied)} of {len(self.applied) + len(self.failed)} clients, the rest failed"
+
+
+class MutationQueue:
+    """Single-writer queue that folds concurrent mutations into one commit.
+
+    Every submit() waits for the batch it landed in. The worker sleeps for
+    the debounce window, takes everything pending and hands it to `commit`,
+    which must return one result per mutation (or raise for the whole batch).
+    While interactive mutations are pending, a batch carries at most
+    `bulk_per_batch` BULK ones, so interactive work gets a commit between
+    chunks of bulk work instead of queueing behind all of it. With nothing
+    interactive waiting, all pending bulk chunks fold into one commit.
+    """
+
+    def __init__(
+        self,
+        commit: Callable[[list[Mutation]], Awaitable[list]],
+        window: float = 0.05,
+        max_batch: int = 10000,
+        bulk_per_batch: int = 1,
+    ):
+        self._commit = commit
+        self._window = window
+        self._max_batch = max_batch
+        self._bulk_per_batch = bulk_per_batch
+        # (mutation, future, submitted_at) по приоритетам, FIFO внутри каждого
+        self._pending: tuple[list, list] = ([], [])
+        self._wait_ewma = [0.0, 0.0]
+        self._worker: asyncio.Task | None = None
+        self._commit_lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(pending) for pending in self._pending)
+
+    def stats(self) -> dict:
+        """Pending mutations and smoothed wait time (seconds) per priority"""
+        return {
+            name: {"pending": len(self._pending[priority]), "wait_seconds": round(self._wait_ewma[priority], 4)}
+            for priority, name in enumerate(PRIORITY_NAMES)
+        }
+
+    def exclusive(self) -> asyncio.Lock:
+        """Lock held while a batch commits, for writers outside the queue"""
+        return self._commit_lock
+
+    async def submit(self, mutation: Mutation, priority: int = INTERACTIVE):
+        future = asyncio.get_running_loop().create_future()
+        self._pending[priority].append((mutation, future, time.monotonic()))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+
+    def _take_batch(self) -> list[tuple]:
+        interactive, bulk = self._pending
+        batch = interactive[: self._max_batch]
+        del interactive[: len(batch)]
+        # Массовые придерживаем, только пока ждут интерактивные
+        bulk_limit = self._bulk_per_batch if batch else self._max_batch
+        taken = bulk[: min(bulk_limit, self._max_batch - len(batch))]
+        del bulk[: len(taken)]
+        batch.extend(taken)
+
+        now = time.monotonic()
+        for priority, entries in ((INTERACTIVE, batch[: len(batch) - len(taken)]), (BULK, taken)):
+            for _, _, submitted_at in entries:
+                waited = now - submitted_at
+                MUTATION_WAIT_SECONDS.observe(waited, priority=PRIORITY_NAMES[priority])
+                self._wait_ewma[priority] += 0.2 * (waited - self._wait_ewma[priority])
+        return batch
+
+    async def _run(self):
+        while self.pending:
+            if self._window > 0:
+                await asyncio.sleep(self._window)
+            batch = self._take_batch()
+            logger.debug(f"Committing batch of {len(batch)} mutations")
+            try:
+                async with self._commit_lock:
+                    results = await self._commit([mutation for mutation, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,53 @@
+import zlib
+from abc import ABC, abstractmethod
+
+from .config_cache import ConfigEdit
+
+
+class PlacementPolicy(ABC):
+    """Chooses the inbound a new client goes to.
+
+    candidates are positions of inbounds serving the target network; the
+    staged edit already contains clients added earlier in the same batch.
+    """
+
+    @abstractmethod
+    def choose(self, cache: ConfigEdit, candidates: list[int], uuid: str) -> int: ...
+
+
+class LeastClients(PlacementPolicy):
+    def choose(self, cache: ConfigEdit, candidates: list[int], uuid: str) -> int:
+        return min(candidates, key=lambda i: len(cache.clients(i)))
+
+
+class HashByUuid(PlacementPolicy):
+    """Stable choice: the same uuid lands on the same inbound"""
+
+    def choose(self, cache: ConfigEdit, candidates: list[int], uuid: str) -> int:
+        return candidates[zlib.crc32(uuid.encode()) % len(candidates)]
+
+
+class Weighted(PlacementPolicy):
+    """Least clients per unit of weight, weights by inbound tag (default 1)"""
+
+    def __init__(self, weights: dict[str, float]):
+        self._weights = weights
+
+    def _weight(self, cache: ConfigEdit, i: int) -> float:
+        return self._weights.get(cache.inbound_tag(i), 1.0)
+
+    def choose(self, cache: ConfigEdit, candidates: list[int], uuid: str) -> int:
+        weighted = [i for i in candidates if self._weight(cache, i) > 0]
+        if not weighted:
+            return candidates[0]
+        return min(weighted, key=lambda i: (len(cache.clients(i)) + 1) / self._weight(cache, i))
+
+
+def make_placement(name: str, weights: dict[str, float]) -> PlacementPolicy:
+    if name == "least_clients":
+        return LeastClients()
+    if name == "hash":
+        return HashByUuid()
+    if name == "weighted":
+        return Weighted(weights)
+    raise ValueError(f"Unknown placement policy {name}, expected least_clients, hash or weighted")
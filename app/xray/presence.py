@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+_EMAIL = b"email: "
+_ACCEPTED = b" accepted "
+
+
+class AccessLogPresence:
+    """Who is online, from xray's access log tailed incrementally.
+
+    Only lines appended since the previous poll are read, starting from an
+    offset saved across restarts. Rotation is detected by inode change
+    (the rest of the old file is drained first) or by truncation.
+    last_seen keeps uuid -> time of the latest accepted connection, ordered
+    by recency and pruned after `retention` seconds, so memory is bounded
+    by the number of recently active users, not by the log size.
+    """
+
+    def __init__(self, path: str | None, state_path: str, window: float = 300, retention: float = 86400):
+        self._path = path
+        self._state_path = state_path
+        self._window = window
+        self._retention = retention
+        self._file = None
+        self._partial = b""
+        self._last_seen: OrderedDict[str, float] = OrderedDict()
+        self._time_prefix = b""
+        self._time_value = 0.0
+        self.lines_parsed = 0
+        self.last_poll_at: float | None = None
+        self.last_error: str | None = None
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self._state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        tmp_path = f"{self._state_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"inode": os.fstat(self._file.fileno()).st_ino, "offset": self._file.tell()}, f)
+            os.replace(tmp_path, self._state_path)
+        except OSError as e:
+            logger.warning(f"Could not save access log offset: {e}")
+
+    def _open(self, resume: bool):
+        self._file = open(self._path, "rb")
+        self._partial = b""
+        st = os.fstat(self._file.fileno())
+        state = self._load_state() if resume else {}
+        if state.get("inode") == st.st_ino and state.get("offset", 0) <= st.st_size:
+            self._file.seek(state["offset"])
+        elif resume and not state:
+            # Первый запуск: историю не разбираем, только новые строки
+            self._file.seek(0, os.SEEK_END)
+
+    def _timestamp(self, line: bytes) -> float:
+        # "2024/01/31 12:00:00[.micro] ..." - время локальное, разбираем раз в секунду
+        prefix = line[:19]
+        if prefix != self._time_prefix:
+            try:
+                self._time_value = time.mktime(time.strptime(prefix.decode(), "%Y/%m/%d %H:%M:%S"))
+            except ValueError:
+                return time.time()
+            self._time_prefix = prefix
+        return self._time_value
+
+    def _parse(self, chunk: bytes, seen: dict[str, float]):
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            position = line.find(_EMAIL)
+            if position < 0 or _ACCEPTED not in line:
+                continue
+            email = line[position + len(_EMAIL):].split(None, 1)
+            if not email:
+                continue
+            uuid = email[0].partition(b"@")[0].decode(errors="replace")
+            seen.pop(uuid, None)
+            seen[uuid] = self._timestamp(line)
+        self.lines_parsed += len(lines)
+
+    def _drain(self, seen: dict[str, float], chunk_size: int = 1 << 20):
+        while chunk := self._file.read(chunk_size):
+            self._parse(chunk, seen)
+
+    def _read_new_lines(self) -> dict[str, float]:
+        """Runs in a thread: uuid -> last seen from the new lines, in log order"""
+        seen = {}
+        if self._file is None:
+            self._open(resume=True)
+        st = os.fstat(self._file.fileno())
+        if st.st_size < self._file.tell():
+            # copytruncate: файл обрезали, читаем с начала
+            self._file.seek(0)
+            self._partial = b""
+        self._drain(seen)
+        try:
+            rotated = os.stat(self._path).st_ino != st.st_ino
+        except FileNotFoundError:
+            rotated = False  # Новый файл ещё не создан
+        if rotated:
+            self._file.close()
+            self._open(resume=False)
+            self._drain(seen)
+        self._save_state()
+        return seen
+
+    def _prune(self):
+        deadline = time.time() - self._retention
+        while self._last_seen:
+            uuid, seen_at = next(iter(self._last_seen.items()))
+            if seen_at >= deadline:
+                break
+            self._last_seen.popitem(last=False)
+
+    async def poll_once(self):
+        seen = await asyncio.to_thread(self._read_new_lines)
+        # Сливаем в цикле событий, чтобы читатели не видели dict посреди изменения
+        deadline = time.time() - self._retention
+        for uuid, seen_at in seen.items():
+            if seen_at >= deadline:
+                self._last_seen[uuid] = seen_at
+                self._last_seen.move_to_end(uuid)
+        self._prune()
+        self.last_poll_at = time.time()
+
+    async def run(self, interval: float):
+        while True:
+            try:
+                await self.poll_once()
+                self.last_error = None
+            except OSError as e:
+                self.last_error = str(e)
+                logger.warning(f"Access log poll failed: {e}")
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+            await asyncio.sleep(interval)
+
+    def online(self, limit: int | None = None) -> list[tuple[str, float]]:
+        """Users seen within the window, most recent first"""
+        deadline = time.time() - self._window
+        users = []
+        for uuid in reversed(self._last_seen):
+            seen_at = self._last_seen[uuid]
+            if seen_at < deadline or (limit is not None and len(users) >= limit):
+                break
+            users.append((uuid, seen_at))
+        return users
+
+    def online_count(self) -> int:
+        return len(self.online())
+
+    def last_seen(self, uuid: str) -> float | None:
+        return self._last_seen.get(uuid)
+
+    def summary(self) -> dict:
+        return {
+            "online": self.online_count(),
+            "window": self._window,
+            "tracked": len(self._last_seen),
+            "last_poll_at": self.last_poll_at,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,154 @@
+"""Minimal protobuf wire-format helpers for the Xray gRPC API.
+
+Xray's API messages are small and stable, so instead of shipping generated
+stubs we encode/decode the handful of fields we need by hand and pass raw
+bytes through grpc.
+"""
+
+WIRE_VARINT = 0
+WIRE_LEN = 2
+
+# --- Полные имена protobuf-сообщений Xray ---
+ADD_USER_OPERATION = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER_OPERATION = "xray.app.proxyman.command.RemoveUserOperation"
+VLESS_ACCOUNT = "xray.proxy.vless.Account"
+
+HANDLER_SERVICE = "xray.app.proxyman.command.HandlerService"
+ALTER_INBOUND_METHOD = f"/{HANDLER_SERVICE}/AlterInbound"
+STATS_SERVICE = "xray.app.stats.command.StatsService"
+QUERY_STATS_METHOD = f"/{STATS_SERVICE}/QueryStats"
+
+
+def encode_varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return encode_varint((field << 3) | wire_type)
+
+
+def field_varint(field: int, value: int) -> bytes:
+    if not value:
+        return b""
+    return _key(field, WIRE_VARINT) + encode_varint(int(value))
+
+
+def field_bytes(field: int, value: bytes) -> bytes:
+    if not value:
+        return b""
+    return _key(field, WIRE_LEN) + encode_varint(len(value)) + value
+
+
+def field_string(field: int, value: str) -> bytes:
+    return field_bytes(field, value.encode())
+
+
+def decode_message(data: bytes) -> dict[int, list]:
+    """Decode a message into {field_number: [values]}.
+
+    Length-delimited values are returned as bytes, varints as int.
+    """
+    fields: dict[int, list] = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == WIRE_VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == WIRE_LEN:
+            length, pos = _read_varint(data, pos)
+            value = data[pos : pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = int.from_bytes(data[pos : pos + 8], "little")
+            pos += 8
+        elif wire_type == 5:
+            value = int.from_bytes(data[pos : pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def first(fields: dict[int, list], field: int, default=None):
+    values = fields.get(field)
+    return values[0] if values else default
+
+
+# --- Сообщения HandlerService ---
+def typed_message(type_name: str, value: bytes) -> bytes:
+    return field_string(1, type_name) + field_bytes(2, value)
+
+
+def vless_user(client: dict, level: int = 0) -> bytes:
+    account = (
+        field_string(1, client["id"])
+        + field_string(2, client.get("flow", ""))
+        + field_string(3, "none")
+    )
+    return (
+        field_varint(1, level)
+        + field_string(2, client["email"])
+        + field_bytes(3, typed_message(VLESS_ACCOUNT, account))
+    )
+
+
+def alter_inbound_add_user(tag: str, client: dict) -> bytes:
+    operation = field_bytes(1, vless_user(client))
+    return field_string(1, tag) + field_bytes(
+        2, typed_message(ADD_USER_OPERATION, operation)
+    )
+
+
+def alter_inbound_remove_user(tag: str, email: str) -> bytes:
+    operation = field_string(1, email)
+    return field_string(1, tag) + field_bytes(
+        2, typed_message(REMOVE_USER_OPERATION, operation)
+    )
+
+
+# --- Сообщения StatsService ---
+def query_stats_request(pattern: str, reset: bool = False) -> bytes:
+    return field_string(1, pattern) + field_varint(2, int(reset))
+
+
+def decode_query_stats_response(data: bytes) -> dict[str, int]:
+    stats = {}
+    for stat in decode_message(data).get(1, []):
+        fields = decode_message(stat)
+        value = first(fields, 2, 0)
+        # int64 приходит как varint в дополнительном коде
+        if value >= 1 << 63:
+            value -= 1 << 64
+        stats[first(fields, 1, b"").decode()] = value
+    return stats
+
+
+def query_stats_response(stats: dict[str, int]) -> bytes:
+    return b"".join(
+        field_bytes(1, field_string(1, name) + field_varint(2, value))
+        for name, value in stats.items()
+    )
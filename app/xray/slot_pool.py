@@ -0,0 +1,89 @@
+import json
+from collections import deque
+
+from loguru import logger
+
+from .snapshots import write_atomic
+
+
+class SlotPool:
+    """Pre-provisioned clients already present in config, waiting for users.
+
+    Slots are ordinary clients, so handing one out needs no config write or
+    xray reload. Until assigned their uuids are secret: callers must keep
+    them out of uuid lists, the changelog and reconciliation. The free list
+    is persisted after every change so a slot is never handed out twice.
+    """
+
+    def __init__(self, path: str, size: int, low_watermark: int):
+        self._path = path
+        self.size = size
+        self.low_watermark = low_watermark
+        self._free: deque[str] = deque()
+        self._members: set[str] = set()  # Свободные и ещё не закоммиченные слоты
+        self._reserved: set[str] = set()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._free)
+
+    def __contains__(self, uuid: str) -> bool:
+        return uuid in self._members
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                self._free = deque(json.load(f))
+        except FileNotFoundError:
+            self._free = deque()
+        except ValueError as e:
+            logger.error(f"Slot pool file is broken, starting empty: {e}")
+            self._free = deque()
+        self._members = set(self._free) | self._reserved
+
+    def reload(self):
+        """Re-read the free list, another worker process may have changed it"""
+        self._load()
+
+    def _save(self):
+        try:
+            write_atomic(self._path, json.dumps(list(self._free)).encode())
+        except OSError as e:
+            logger.error(f"Could not persist slot pool: {e}")
+
+    @property
+    def deficit(self) -> int:
+        """Slots to provision, 0 while the pool is above its low watermark"""
+        if len(self._members) > self.low_watermark:
+            return 0
+        return self.size - len(self._members)
+
+    def reserve(self, uuids: list[str]):
+        """Mark slots being committed, so they are treated as pool already"""
+        self._members.update(uuids)
+        self._reserved.update(uuids)
+
+    def commit(self, uuids: list[str]):
+        self._free.extend(uuids)
+        self._reserved.difference_update(uuids)
+        self._save()
+
+    def release(self, uuids: list[str]):
+        """Forget reserved slots whose commit failed"""
+        self._members.difference_update(uuids)
+        self._reserved.difference_update(uuids)
+
+    def reserved_count(self, is_present) -> int:
+        """Reserved slots already written to config (is_present(uuid))"""
+        return sum(1 for uuid in self._reserved if is_present(uuid))
+
+    def take(self, count: int, is_present) -> list[str]:
+        """Hand out up to count free slots still present in config (is_present(uuid))"""
+        taken = []
+        while self._free and len(taken) < count:
+            uuid = self._free.popleft()
+            self._members.discard(uuid)
+            if is_present(uuid):
+                taken.append(uuid)
+        self._save()
+        return taken
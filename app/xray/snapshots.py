@@ -0,0 +1,82 @@
+import hashlib
+import os
+
+
+def fsync_directory(path: str):
+    """Persist a rename: fsync the directory holding the file"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path: str, content: bytes):
+    """Write to a temp file, fsync it and rename over `path`"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+
+
+class SnapshotNotFound(Exception):
+    def __init__(self, snapshot_id: str):
+        self.snapshot_id = snapshot_id
+
+    def __str__(self):
+        return f"Snapshot {self.snapshot_id} not found"
+
+
+class SnapshotStore:
+    """Last N committed versions of config.json, de-duplicated by content.
+
+    A snapshot is named after the sha256 of its content; committing an
+    already known version only bumps its mtime, so flapping between the same
+    states does not push older versions out of the store.
+    """
+
+    def __init__(self, directory: str, keep: int = 20):
+        self._directory = directory
+        self._keep = keep
+
+    def _path(self, snapshot_id: str) -> str:
+        if not snapshot_id.isalnum():
+            raise SnapshotNotFound(snapshot_id)
+        return os.path.join(self._directory, f"{snapshot_id}.json")
+
+    def add(self, content: bytes) -> str:
+        snapshot_id = hashlib.sha256(content).hexdigest()[:16]
+        path = self._path(snapshot_id)
+        os.makedirs(self._directory, exist_ok=True)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            write_atomic(path, content)
+        self._prune()
+        return snapshot_id
+
+    def list(self) -> list[dict]:
+        """Snapshots, newest first"""
+        snapshots = []
+        if not os.path.isdir(self._directory):
+            return snapshots
+        for name in os.listdir(self._directory):
+            if not name.endswith(".json"):
+                continue
+            st = os.stat(os.path.join(self._directory, name))
+            snapshots.append({"id": name[:-5], "created_at": st.st_mtime, "size": st.st_size})
+        return sorted(snapshots, key=lambda s: s["created_at"], reverse=True)
+
+    def read(self, snapshot_id: str) -> bytes:
+        try:
+            with open(self._path(snapshot_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise SnapshotNotFound(snapshot_id)
+
+    def _prune(self):
+        for snapshot in self.list()[self._keep :]:
+            os.remove(self._path(snapshot["id"]))
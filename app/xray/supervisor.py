@@ -0,0 +1,99 @@
+import asyncio
+import shlex
+import time
+
+from loguru import logger
+
+
+class XraySupervisorError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class XrayConfigInvalid(XraySupervisorError):
+    """Candidate config rejected by `xray run -test`, nothing was applied"""
+
+
+class XraySupervisor:
+    """Runs xray reloads without blocking the event loop.
+
+    Commands are executed as asyncio subprocesses with timeouts and their
+    exit codes are checked. After a restart the supervisor waits until the
+    inbound ports accept connections, and restarts are spaced at least
+    `min_interval` seconds apart.
+    """
+
+    def __init__(
+        self,
+        restart_command: str,
+        test_command: str | None,
+        command_timeout: float = 30,
+        ready_timeout: float = 10,
+        min_interval: float = 2,
+    ):
+        self._restart_command = restart_command
+        self._test_command = test_command
+        self._command_timeout = command_timeout
+        self._ready_timeout = ready_timeout
+        self._min_interval = min_interval
+        self._last_restart_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _run(self, command: str) -> tuple[int, str]:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *shlex.split(command),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+        except OSError as e:
+            raise XraySupervisorError(f"Cannot run '{command}': {e}")
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), self._command_timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise XraySupervisorError(f"'{command}' timed out after {self._command_timeout}s")
+        return process.returncode, output.decode(errors="replace").strip()
+
+    async def validate(self, config_path: str):
+        """Check candidate config with xray itself before it goes live"""
+        if not self._test_command:
+            return
+        returncode, output = await self._run(self._test_command.format(config=config_path))
+        if returncode != 0:
+            raise XrayConfigInvalid(f"xray rejected config (exit {returncode}): {output[-500:]}")
+
+    async def restart(self, endpoints: list[tuple[str, int]] = ()):
+        async with self._lock:
+            wait = self._min_interval - (time.monotonic() - self._last_restart_at)
+            if wait > 0:
+                logger.info(f"Restart rate limited, waiting {wait:.2f}s")
+                await asyncio.sleep(wait)
+            self._last_restart_at = time.monotonic()
+            returncode, output = await self._run(self._restart_command)
+            if returncode != 0:
+                raise XraySupervisorError(f"Restart failed (exit {returncode}): {output[-500:]}")
+            await self._wait_ready(endpoints)
+
+    async def _wait_ready(self, endpoints: list[tuple[str, int]]):
+        """Wait until every inbound (host, port) accepts TCP connections"""
+        if not endpoints or self._ready_timeout <= 0:
+            return
+        deadline = time.monotonic() + self._ready_timeout
+        for host, port in endpoints:
+            while True:
+                try:
+                    _, writer = await asyncio.wait_for(
+                        asyncio.open_connection(host, port), timeout=1
+                    )
+                    writer.close()
+                    await writer.wait_closed()
+                    break
+                except (OSError, asyncio.TimeoutError):
+                    if time.monotonic() > deadline:
+                        raise XraySupervisorError(f"xray is not listening on port {port} after restart")
+                    await asyncio.sleep(0.1)
@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import time
+from array import array
+
+from loguru import logger
+
+from .api_client import XrayApiClient, XrayApiError
+
+
+class TrafficStats:
+    """Per-user and per-inbound traffic aggregated from Xray StatsService.
+
+    A background loop fetches every counter in one QueryStats call. Xray
+    counters are cumulative, so each poll adds the difference to the
+    previous value (a drop means xray was restarted and counts from zero).
+    Per-user numbers live in flat arrays indexed by a slot per email.
+    """
+
+    def __init__(self, api_client: XrayApiClient, interval: float = 60):
+        self._api_client = api_client
+        self._interval = interval
+        self._slots: dict[str, int] = {}
+        self._emails: list[str] = []
+        self._raw: dict[str, int] = {}
+        self._uplink = array("Q")
+        self._downlink = array("Q")
+        self._last_uplink = array("Q")
+        self._last_downlink = array("Q")
+        self._inbounds: dict[str, list[int]] = {}
+        self.last_poll_at: float | None = None
+        self.last_error: str | None = None
+
+    def _slot(self, email: str) -> int:
+        slot = self._slots.get(email)
+        if slot is None:
+            slot = self._slots[email] = len(self._emails)
+            self._emails.append(email)
+            for counters in (self._uplink, self._downlink, self._last_uplink, self._last_downlink):
+                counters.append(0)
+        return slot
+
+    def _delta(self, name: str, value: int) -> int:
+        previous = self._raw.get(name, 0)
+        self._raw[name] = value
+        return value - previous if value >= previous else value
+
+    async def poll_once(self):
+        stats = await self._api_client.query_stats("")
+        for i in range(len(self._emails)):
+            self._last_uplink[i] = 0
+            self._last_downlink[i] = 0
+
+        for name, value in stats.items():
+            # user>>>email>>>traffic>>>uplink, inbound>>>tag>>>traffic>>>downlink
+            parts = name.split(">>>")
+            if len(parts) != 4 or parts[2] != "traffic":
+                continue
+            kind, key, _, direction = parts
+            delta = self._delta(name, value)
+            if kind == "user":
+                slot = self._slot(key)
+                if direction == "uplink":
+                    self._uplink[slot] += delta
+                    self._last_uplink[slot] = delta
+                else:
+                    self._downlink[slot] += delta
+                    self._last_downlink[slot] = delta
+            elif kind == "inbound":
+                counters = self._inbounds.setdefault(key, [0, 0])
+                counters[0 if direction == "uplink" else 1] += delta
+        self.last_poll_at = time.time()
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll_once()
+                self.last_error = None
+            except XrayApiError as e:
+                self.last_error = str(e)
+                logger.warning(f"Traffic stats poll failed: {e}")
+            except Exception as e:
+                # Неожиданный ответ не должен навсегда останавливать сбор статистики
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.exception(f"Traffic stats poll crashed: {e}")
+            await asyncio.sleep(self._interval)
+
+    def _user(self, slot: int) -> dict:
+        email = self._emails[slot]
+        return {
+            "config_uuid": email.split("@", 1)[0],
+            "email": email,
+            "uplink": self._uplink[slot],
+            "downlink": self._downlink[slot],
+            "total": self._uplink[slot] + self._downlink[slot],
+            "last_interval": self._last_uplink[slot] + self._last_downlink[slot],
+        }
+
+    def top_users(self, offset: int = 0, limit: int = 100) -> list[dict]:
+        """Users sorted by total bytes, paginated"""
+        slots = heapq.nlargest(
+            offset + limit,
+            range(len(self._emails)),
+            key=lambda slot: self._uplink[slot] + self._downlink[slot],
+        )
+        return [self._user(slot) for slot in slots[offset:]]
+
+    def summary(self) -> dict:
+        return {
+            "users": len(self._emails),
+            "uplink": sum(self._uplink),
+            "downlink": sum(self._downlink),
+            "inbounds": {
+                tag: {"uplink": up, "downlink": down}
+                for tag, (up, down) in self._inbounds.items()
+            },
+            "interval": self._interval,
+            "last_poll_at": self.last_poll_at,
+            "last_error": self.last_error,
+        }
@@ -1,228 +1,1005 @@
 import asyncio
+import contextlib
+import heapq
 import json
 import os
-from copy import deepcopy
+import time
+from typing import AsyncIterator, Callable
 import aiofiles
 from loguru import logger
 from app.data import config
+from app.utils.metrics import SIZE_BUCKETS, XRAY_OPERATION_SECONDS, metrics
+from .api_client import XrayApiClient, XrayApiError
+from .changelog import ChangeLog, SharedChangeLog
+from .client_store import ClientRow, ClientStore, FileLock
+from .config_cache import ConfdirCache, ConfigCache, ConfigEdit
 from .credentials_generator import CredentialsGenerator
+from .expiry import ExpiryIndex
+from .links import LinkTemplate, SubscriptionCache
+from .placement import HashByUuid, make_placement
+from .slot_pool import SlotPool
+from .snapshots import SnapshotStore, fsync_directory
+from .supervisor import XrayConfigInvalid, XraySupervisor
+from .mutation_queue import (
+    BULK,
+    INTERACTIVE,
+    AddClients,
+    CommitError,
+    Mutation,
+    MutationQueue,
+    PartialCommitError,
+    RemoveClients,
+    SyncClients,
+)
+
+COMMIT_BATCH_SIZE = metrics.histogram(
+    "xray_commit_batch_size", "Mutations folded into one config commit", buckets=SIZE_BUCKETS
+)
+CONFIG_ROLLBACKS = metrics.counter("xray_config_rollbacks_total", "Failed commits rolled back")
+
+
+def _serialize(document: dict) -> bytes:
+    return json.dumps(document, separators=(",", ":")).encode()
+
+
+def _read_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
 
 class XrayConfiguration:
     def __init__(self):
         self._config_path = config.xray_config_path
-        self._server_ip_and_port = f"{config.server_ip}:443"
         self._config_prefix = config.user_config_prefix
+        self._cache = (
+            ConfdirCache(config.xray_confdir) if config.xray_confdir else ConfigCache(self._config_path)
+        )
+        self._cache_reloads_seen = 0
+        # С хранилищем журнал изменений общий: поколения одни и те же на всех воркерах
+        self._changelog = (
+            SharedChangeLog(config.xray_store_path, config.xray_changelog_size)
+            if config.xray_store_path
+            else ChangeLog(config.xray_changelog_size)
+        )
+        self._expiry = ExpiryIndex(config.xray_expiry_path)
+        self._pool = SlotPool(config.xray_pool_path, config.xray_pool_size, config.xray_pool_low_watermark)
+        self._pool_wanted = asyncio.Event()
+        self._placement = make_placement(config.xray_placement, config.xray_placement_weights)
+        self._sticky_placement = HashByUuid()
+        # С хранилищем коммиты всех воркеров идут по очереди под файловой блокировкой
+        self._store = ClientStore(config.xray_store_path) if config.xray_store_path else None
+        self._store_lock = FileLock(f"{config.xray_store_path}.lock") if self._store else None
+        self._leader_lock = FileLock(f"{config.xray_store_path}.leader") if self._store else None
+        self._store_synced_reloads: int | None = None
+        # Шаблоны ссылок по позиции инбаунда, сбрасываются при смене ip или перечитывании конфига
+        self._link_templates: dict[int | None, LinkTemplate] = {}
+        self._link_templates_for: tuple | None = None
+        self._subscriptions = SubscriptionCache()
+        self._api_client = (
+            XrayApiClient(config.xray_api_address, timeout=config.xray_api_timeout)
+            if config.xray_apply_mode == "api"
+            else None
+        )
+        self._snapshots = SnapshotStore(config.xray_snapshot_dir, keep=config.xray_snapshot_keep)
+        self._restarts_avoided = 0
+        self._supervisor = XraySupervisor(
+            restart_command=config.xray_restart_command,
+            test_command=config.xray_test_command,
+            command_timeout=config.xray_command_timeout,
+            ready_timeout=config.xray_ready_timeout,
+            min_interval=config.xray_restart_min_interval,
+        )
+        self._mutations = MutationQueue(self._commit_batch, window=config.xray_batch_window)
+        metrics.gauge(
+            "xray_config_file_bytes", "Size of xray config files holding clients",
+            callback=self._config_file_bytes,
+        )
+        metrics.gauge(
+            "xray_inbound_clients", "Configured clients per inbound", ("inbound",),
+            callback=self._clients_per_inbound,
+        )
+        metrics.gauge(
+            "xray_mutations_pending", "Mutations waiting for a commit", ("priority",),
+            callback=lambda: {
+                (name,): stats["pending"] for name, stats in self._mutations.stats().items()
+            },
+        )
+
+    def _config_file_bytes(self) -> dict[tuple, int]:
+        # Файл могут удалить или подменить между listdir и stat - такой пропускаем
+        total = 0
+        with contextlib.suppress(FileNotFoundError):
+            for path in self._cache.paths():
+                with contextlib.suppress(FileNotFoundError):
+                    total += os.path.getsize(path)
+        return {(): total}
+
+    def _clients_per_inbound(self) -> dict[tuple, int]:
+        cache = self._cache
+        return {
+            (cache.inbound_tag(i) or str(i),): len(cache.clients(i))
+            for i in range(len(cache.inbounds))
+        }
+
+    @property
+    def restarts_avoided(self) -> int:
+        """How many mutations were applied live instead of restarting xray"""
+        return self._restarts_avoided
+
+    @metrics.timed(XRAY_OPERATION_SECONDS, operation="load_config")
+    async def _load_cache(self) -> ConfigCache:
+        cache = await self._cache.load()
+        if cache.reloads != self._cache_reloads_seen:
+            # Конфиг правили мимо API: дельты больше не достоверны.
+            # С хранилищем перечитывание - обычно запись соседнего воркера, а ручные
+            # правки _sync_store откатывает к хранилищу и пишет в общий журнал
+            if self._cache_reloads_seen and self._store is None:
+                logger.warning("Config changed on disk, changelog reset.")
+                self._changelog.reset()
+            self._cache_reloads_seen = cache.reloads
+        return cache
 
     async def _load_server_config(self) -> dict:
-        """Load server config from file"""
-        async with aiofiles.open(self._config_path, "r") as f:
-            return json.loads(await f.read())
+        """Load server config (cached, re-read only when the file changed)"""
+        return (await self._load_cache()).data
+
+    @property
+    def changelog(self) -> ChangeLog:
+        return self._changelog
+
+    async def _record_changes(self, added: list[str], removed: list[str]):
+        if self._store is None:
+            self._changelog.record(added, removed)
+        else:
+            await asyncio.to_thread(self._changelog.record, added, removed)
+
+    async def get_changes(self, since: int, epoch: str | None = None) -> dict:
+        """Net changes after generation `since`, see ChangeLog.since"""
+        if self._store is None:
+            return self._changelog.since(since, epoch=epoch)
+        return await asyncio.to_thread(self._changelog.since, since, epoch)
+
+    @contextlib.asynccontextmanager
+    async def _shared_state(self):
+        """Cross-process critical section when clients live in the SQLite store.
+
+        Slot pool and expiry journal are re-read on entry, another worker
+        process may have changed them. Without the store a no-op.
+        """
+        if self._store_lock is None:
+            yield
+            return
+        async with self._store_lock:
+            self._pool.reload()
+            self._expiry.refresh()
+            yield
+
+    async def _wait_for_leadership(self):
+        """With several worker processes only one runs the background jobs"""
+        if self._leader_lock is None:
+            return
+        while not self._leader_lock.try_acquire():
+            await asyncio.sleep(5)
+
+    def _store_row(
+        self, cache: ConfigCache, i: int, client: dict, owner: tuple[int, str] | None = None
+    ) -> ClientRow:
+        telegram_id, config_name = owner or (None, None)
+        return (
+            client["id"], cache.inbound_tag(i) or str(i), client.get("email"), client.get("flow", ""),
+            config_name, telegram_id,
+        )
+
+    async def _replace_store(self, cache: ConfigCache):
+        """Make the store match the config read from disk (after a snapshot restore)"""
+        if self._store is None:
+            return
+        rows = [self._store_row(cache, i, client) for i in range(len(cache.inbounds)) for client in cache.clients(i)]
+
+        def replace():
+            self._store.begin(rows, (), replace=True)
+            self._store.commit()
+            # Замену целиком история дельт не описывает: потребители делают resync
+            self._changelog.reset()
 
-    async def _save_server_config(self, config_data: dict):
-        """Save server config to file"""
-        async with aiofiles.open(self._config_path, "w") as f:
-            await f.write(json.dumps(config_data, indent=4))
+        await asyncio.to_thread(replace)
+        self._store_synced_reloads = cache.reloads
 
+    async def _sync_store(self, cache: ConfigCache):
+        """Generate config clients from the store, or seed an empty store from config.
+
+        Checked once per config read from disk: at start, after writes by
+        other workers (then nothing differs) and after hand edits, which
+        the store overrides.
+        """
+        if self._store is None or self._store_synced_reloads == cache.reloads:
+            return
+        if not await asyncio.to_thread(self._store.count):
+            await self._replace_store(cache)
+            logger.info(f"Client store seeded with {len(cache.index)} clients from config")
+            return
+        positions = {cache.inbound_tag(i) or str(i): i for i in range(len(cache.inbounds))}
+        wanted = await asyncio.to_thread(
+            lambda: {uuid: (inbound, email, flow) for uuid, inbound, email, flow in self._store.active_clients()}
+        )
+        edit = cache.edit()
+        for uuid in [uuid for uuid in cache.index if uuid not in wanted]:
+            edit.remove(uuid)
+        candidates = self._candidate_inbounds(cache)
+        for uuid, (inbound, email, flow) in wanted.items():
+            if uuid in cache.index:
+                continue
+            i = positions.get(inbound)
+            if i is None:
+                if not candidates:
+                    continue
+                i = self._placement.choose(edit, candidates, uuid)
+            edit.add(i, {"id": uuid, "email": email, "flow": flow})
+        if edit.added or edit.removed:
+            logger.warning(
+                f"Config differs from client store, regenerating: +{len(edit.added)} -{len(edit.removed)}"
+            )
+            if not await self._apply_and_store(cache, edit):
+                raise CommitError()
+            cache.apply(edit)
+            await self._record_changes([c["id"] for _, c in edit.added], [c["id"] for _, c in edit.removed])
+        self._store_synced_reloads = cache.reloads
+
+    async def _apply_and_store(self, cache: ConfigCache, edit: ConfigEdit, owners: dict | None = None) -> bool:
+        """_apply_changes with the same delta staged in the store, committed only if applied"""
+        if self._store is None:
+            return await self._apply_changes(edit)
+        owners = owners or {}
+        await asyncio.to_thread(
+            self._store.begin,
+            [self._store_row(cache, i, client, owners.get(client["id"])) for i, client in edit.added],
+            [client["id"] for _, client in edit.removed],
+        )
+        applied = False
+        try:
+            applied = await self._apply_changes(edit)
+        finally:
+            if applied:
+                await asyncio.to_thread(self._store.commit)
+            else:
+                # Синхронно: откат нужен и при отмене задачи, соединение одно на процесс
+                self._store.rollback()
+        return applied
+
+    @metrics.timed(XRAY_OPERATION_SECONDS, operation="save_config")
+    async def _save_server_config(
+        self, documents: list[tuple[str, bytes]], validate: bool = False, cached: bool = True
+    ):
+        """Save config files (fsynced temp files, then atomic renames).
+
+        documents: [(path, content)], the whole config.json or only the
+        touched fragments in confdir layout. With validate=True the
+        candidate is checked by xray before the renames and
+        XrayConfigInvalid leaves the live files untouched. Every committed
+        file also goes to the snapshot store.
+
+        cached=True means the documents are the cached config itself: its
+        signature is taken right after the renames, before any await, so
+        readers never see our own write as an external change. Callers
+        writing anything else must invalidate the cache instead.
+        """
+        replacements = {}
+        try:
+            for path, content in documents:
+                tmp_path = replacements[path] = f"{path}.tmp"
+                async with aiofiles.open(tmp_path, "wb") as f:
+                    await f.write(content)
+                    await f.flush()
+                    await asyncio.to_thread(os.fsync, f.fileno())
+            if validate:
+                with self._cache.candidate(replacements) as candidate:
+                    await self._validate_config(candidate)
+        except Exception:
+            for tmp_path in replacements.values():
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        for path, tmp_path in replacements.items():
+            os.replace(tmp_path, path)
+        if cached:
+            self._cache.refresh_signature()
+        # Все фрагменты лежат в одном каталоге, fsync нужен по разу на каталог
+        for path in {os.path.dirname(os.path.abspath(p)): p for p in replacements}.values():
+            await asyncio.to_thread(fsync_directory, path)
+        for _, content in documents:
+            try:
+                await asyncio.to_thread(self._snapshots.add, content)
+            except OSError as e:
+                logger.warning(f"Could not save config snapshot: {e}")
+
+    def _dirty_documents(self, positions: set[int], inbounds: list[dict] | None = None) -> list[tuple[str, bytes]]:
+        return [(path, _serialize(document)) for path, document in self._cache.documents(positions, inbounds)]
+
+    @metrics.timed(XRAY_OPERATION_SECONDS, operation="validate_config")
+    async def _validate_config(self, path: str):
+        await self._supervisor.validate(path)
+
+    @metrics.timed(XRAY_OPERATION_SECONDS, operation="restart")
     async def _restart_xray(self):
-        """Restart xray service"""
-        os.system("systemctl restart xray")
+        """Restart xray service and wait until its inbounds listen again"""
+        endpoints = []
+        for inbound in self._cache.inbounds:
+            listen = inbound.get("listen") or "127.0.0.1"
+            if isinstance(inbound.get("port"), int) and not listen.startswith(("/", "@")):
+                host = "127.0.0.1" if listen in ("0.0.0.0", "::") else listen
+                endpoints.append((host, inbound["port"]))
+        await self._supervisor.restart(endpoints)
+
+    @metrics.timed(XRAY_OPERATION_SECONDS, operation="live_apply")
+    async def _apply_live(self, added: list[tuple], removed: list[tuple]) -> bool:
+        """Push client changes into running xray via HandlerService.
+
+        added: [(inbound_tag, client)], removed: [(inbound_tag, email)].
+        Returns False when live apply is disabled or impossible, so the
+        caller falls back to a full restart.
+        """
+        if self._api_client is None:
+            return False
+        if any(not tag for tag, _ in added) or any(not (tag and email) for tag, email in removed):
+            logger.warning("Inbound without tag or client without email, live apply impossible.")
+            return False
+        try:
+            for tag, email in removed:
+                try:
+                    await self._api_client.remove_user(tag, email)
+                except XrayApiError as e:
+                    # Клиента в работающем xray уже нет - удаление и так применено
+                    if not e.not_found:
+                        raise
+            for tag, client in added:
+                await self._api_client.add_user(tag, client)
+        except XrayApiError as e:
+            logger.warning(f"{e}. Falling back to restart.")
+            return False
+        self._restarts_avoided += 1
+        return True
 
     # --- ГЛАВНАЯ ЛОГИКА ДОБАВЛЕНИЯ ---
-    async def add_new_user(self, config_name: str, user_telegram_id: int) -> tuple:
-        credentials = CredentialsGenerator().generate_new_person(user_telegram_id=user_telegram_id)
-        
-        # 1. Настраиваем flow
+    async def add_new_user(
+        self,
+        config_name: str,
+        user_telegram_id: int,
+        seed: str | None = None,
+        expires_at: float | None = None,
+    ) -> tuple:
+        [(link, config_uuid)] = await self.add_new_users([(user_telegram_id, config_name, seed, expires_at)])
+        return link, config_uuid
+
+    async def add_new_users(self, users: list[tuple]) -> list[tuple]:
+        """Add many users in one config commit.
+
+        users: [(user_telegram_id, config_name, seed, expires_at)], seed and
+        expires_at (unix time) may be None. Returns [(link, uuid)] in the
+        same order.
+        """
+        generator = CredentialsGenerator()
+        current_flow = self._current_flow()
+        uuids = [generator.generate_uuid(seed) if seed is not None else None for _, _, seed, _ in users]
+
+        # Пользователи без seed получают готовые слоты из пула - без записи конфига
+        # С несколькими воркерами пул пополняет другой процесс, локальная копия может быть пустой
+        if len(self._pool) or (self._store is not None and self._pool.size):
+            async with self._shared_state():
+                cache = await self._load_cache()
+                unseeded = [n for n, uuid in enumerate(uuids) if uuid is None]
+                slots = self._pool.take(len(unseeded), lambda uuid: uuid in cache.index)
+                for n, slot in zip(unseeded, slots):
+                    uuids[n] = slot
+                await self._record_changes(slots, [])
+                self._expiry.update({
+                    slot: users[n][3] for n, slot in zip(unseeded, slots) if users[n][3] is not None
+                })
+                if self._store is not None and slots:
+                    await asyncio.to_thread(
+                        self._store.assign, {slot: users[n][:2] for n, slot in zip(unseeded, slots)}
+                    )
+            if self._pool.deficit:
+                self._pool_wanted.set()
+
+        credentials = []
+        expires = {}
+        owners = {}
+        for n, (user_telegram_id, config_name, seed, expires_at) in enumerate(users):
+            if uuids[n] is not None and seed is None:
+                continue
+            person = generator.generate_new_person(user_telegram_id=user_telegram_id, seed=seed)
+            person["flow"] = current_flow
+            uuids[n] = person["id"]
+            credentials.append(person)
+            owners[person["id"]] = (user_telegram_id, config_name)
+            if expires_at is not None:
+                expires[person["id"]] = expires_at
+
+        # Остальных ставим в очередь одной пачкой, ждём коммита
+        if credentials:
+            try:
+                await self._mutations.submit(AddClients(credentials, expires=expires, owners=owners))
+            except CommitError:
+                raise Exception("Failed to update server config")
+
+        template_for = await self._get_link_templates()
+        return [
+            (template_for(uuid).render(uuid, config_name), uuid)
+            for uuid, (_, config_name, _, _) in zip(uuids, users)
+        ]
+
+    def _current_flow(self) -> str:
+        return "" if config.xray_network in ["xhttp", "grpc"] else "xtls-rprx-vision"
+
+    def _make_client(self, uuid: str, flow: str) -> dict:
+        return {"id": uuid, "email": f"{uuid}@example.com", "flow": flow}
+
+    def _candidate_inbounds(self, cache: ConfigCache) -> list[int]:
+        """Inbounds with configured network, first inbound as fallback.
+
+        The first candidate is the primary inbound, its links use
+        XRAY_LINK_PORT and XRAY_PATH.
+        """
         target_network = config.xray_network
-        
-        if target_network in ["xhttp", "grpc"]:
-            credentials["flow"] = ""
-        else:
-            credentials["flow"] = "xtls-rprx-vision" 
+        candidates = [i for i in range(len(cache.inbounds)) if cache.inbound_network(i) == target_network]
+        if not candidates and cache.inbounds:
+            return [0]
+        return candidates
+
+    async def _commit_batch(self, mutations: list[Mutation]) -> list:
+        async with self._shared_state():
+            return await self._commit_locked(mutations)
+
+    async def _commit_locked(self, mutations: list[Mutation]) -> list:
+        """Fold all pending mutations into one edit, one write and one reload"""
+        cache = await self._load_cache()
+        await self._sync_store(cache)
+        COMMIT_BATCH_SIZE.observe(len(mutations))
 
-        # 2. Грузим конфиг
-        server_config_json = await self._load_server_config()
-        updated_config = deepcopy(server_config_json)
+        to_add: dict[str, dict] = {}
+        to_remove: set[str] = set()
+        expiry_changes: dict[str, float | None] = {}
+        owners: dict[str, tuple[int, str]] = {}
+        readds: set[str] = set()
+        results = []
 
-        # 3. ИЩЕМ НУЖНЫЙ INBOUND
-        user_added = False
-        
-        for inbound in updated_config.get("inbounds", []):
+        # Сворачиваем операции в итоговую дельту, сохраняя порядок поступления
+        for mutation in mutations:
+            if isinstance(mutation, AddClients):
+                for client in mutation.clients:
+                    uuid = client["id"]
+                    expiry_changes[uuid] = mutation.expires.get(uuid)
+                    if uuid in mutation.owners:
+                        owners[uuid] = mutation.owners[uuid]
+                    if uuid in to_remove:
+                        to_remove.discard(uuid)
+                    elif uuid not in cache.index and uuid not in to_add:
+                        to_add[uuid] = client
+                        if mutation.readd:
+                            readds.add(uuid)
+                results.append(True)
+            elif isinstance(mutation, SyncClients):
+                # Один линейный проход: текущее множество против желаемого
+                desired = mutation.uuids
+                removed_count = 0
+                for uuid in [u for u in to_add if u not in desired]:
+                    del to_add[uuid]
+                    removed_count += 1
+                for uuid in cache.index:
+                    if uuid not in desired and uuid not in to_remove and uuid not in self._pool:
+                        to_remove.add(uuid)
+                        removed_count += 1
+                added_count = 0
+                flow = self._current_flow()
+                for uuid in desired:
+                    if uuid in to_remove:
+                        to_remove.discard(uuid)
+                    elif uuid not in cache.index and uuid not in to_add:
+                        to_add[uuid] = self._make_client(uuid, flow)
+                        readds.add(uuid)
+                        added_count += 1
+                results.append({"added": added_count, "removed": removed_count})
+            else:
+                removed_count = 0
+                for uuid in mutation.uuids:
+                    expiry_changes[uuid] = None
+                    if to_add.pop(uuid, None) is not None:
+                        removed_count += 1
+                    elif uuid in cache.index and uuid not in to_remove:
+                        to_remove.add(uuid)
+                        removed_count += 1
+                results.append(removed_count)
+
+        for uuid in to_remove:
+            expiry_changes[uuid] = None
+
+        if not to_add and not to_remove:
+            self._update_expiry(cache, expiry_changes)
+            return results
+
+        # Правки копируют только затронутые списки клиентов, читатели видят кэш до коммита
+        edit = cache.edit()
+        for uuid in to_remove:
+            edit.remove(uuid)
+
+        if to_add:
+            candidates = self._candidate_inbounds(cache)
+            if not candidates:
+                raise CommitError()
+            if cache.inbound_network(candidates[0]) != config.xray_network:
+                logger.warning(f"Target network {config.xray_network} not found. Adding to first inbound.")
+            previous = await self._previous_inbounds(cache, [uuid for uuid in to_add if uuid in readds])
+            for uuid, client in to_add.items():
+                if uuid in previous:
+                    i = previous[uuid]
+                elif uuid in readds:
+                    # Без записи в хранилище: стабильный выбор по uuid, а не по загрузке
+                    i = self._sticky_placement.choose(edit, candidates, uuid)
+                else:
+                    i = self._placement.choose(edit, candidates, uuid)
+                edit.add(i, client)
+
+        logger.info(f"Committing {len(edit.added)} adds and {len(edit.removed)} removals in one write")
+        if not await self._apply_and_store(cache, edit, owners):
+            raise CommitError()
+        cache.apply(edit)
+        # Свободные слоты пула не светим в дельтах, они появятся там при выдаче
+        await self._record_changes(
+            [c["id"] for _, c in edit.added if c["id"] not in self._pool], [c["id"] for _, c in edit.removed]
+        )
+        self._update_expiry(cache, expiry_changes)
+        return results
+
+    async def _previous_inbounds(self, cache: ConfigCache, uuids: list[str]) -> dict[str, int]:
+        """Inbound positions re-added clients were placed on before, from the client store"""
+        if self._store is None or not uuids:
+            return {}
+        positions = {cache.inbound_tag(i) or str(i): i for i in range(len(cache.inbounds))}
+        recorded = await asyncio.to_thread(self._store.inbounds, uuids)
+        return {uuid: positions[tag] for uuid, tag in recorded.items() if tag in positions}
+
+    def _update_expiry(self, cache: ConfigCache, changes: dict[str, float | None]):
+        """Persist expiry changes of a committed batch, absent clients never expire"""
+        self._expiry.update({
+            uuid: expires_at if uuid in cache.index else None
+            for uuid, expires_at in changes.items()
+            if expires_at is not None or uuid in self._expiry
+        })
+
+    def _build_link_template(self, cache: ConfigCache, i: int | None, primary: bool, server_ip: str) -> LinkTemplate:
+        port, network, path = config.xray_link_port, config.xray_network, config.xray_path
+        if i is not None and not primary:
+            # Дополнительные инбаунды: порт и путь берём из самого инбаунда,
+            # публичный порт из XRAY_LINK_PORTS, если слушающий наружу не виден
+            inbound = cache.inbounds[i]
             stream = inbound.get("streamSettings", {})
-            network = stream.get("network", "tcp")
-            
-            if network == target_network:
-                if "settings" not in inbound:
-                    inbound["settings"] = {}
-                if "clients" not in inbound["settings"]:
-                    inbound["settings"]["clients"] = []
-                
-                inbound["settings"]["clients"].append(credentials)
-                user_added = True
-                break
-
-        # Fallback
-        if not user_added:
-            logger.warning(f"Target network {target_network} not found. Adding to first inbound.")
-            # Безопасное добавление в первый инбаунд
-            if updated_config["inbounds"]:
-                if "settings" not in updated_config["inbounds"][0]:
-                    updated_config["inbounds"][0]["settings"] = {}
-                if "clients" not in updated_config["inbounds"][0]["settings"]:
-                    updated_config["inbounds"][0]["settings"]["clients"] = []
-                updated_config["inbounds"][0]["settings"]["clients"].append(credentials)
-
-        # 4. Сохраняем
-        try:
-            await self._save_server_config(updated_config)
-            await self._restart_xray()
-        except Exception as e:
-            logger.error(f"Error adding user: {e}")
-            await self._save_server_config(server_config_json)
-            await self._restart_xray()
-            raise Exception("Failed to update server config")
+            network = cache.inbound_network(i)
+            port = config.xray_link_ports.get(cache.inbound_tag(i), inbound.get("port", port))
+            path = (
+                stream.get("xhttpSettings", {}).get("path")
+                or stream.get("grpcSettings", {}).get("serviceName")
+                or path
+            )
+        return LinkTemplate(
+            host=server_ip,
+            port=port,
+            network=network,
+            path=path,
+            sni=config.xray_sni,
+            public_key=config.xray_publickey,
+            short_id=config.xray_shortid,
+            prefix=self._config_prefix,
+        )
+
+    async def _get_link_templates(self) -> Callable[[str], LinkTemplate]:
+        """Lookup of the compiled link template for the inbound holding a uuid.
 
-        # 5. Ссылка
-        link = await self.create_user_config_as_link_string(credentials["id"], config_name=config_name)
-        return link, credentials["id"]
+        Unknown uuids get the template of the primary inbound. Templates are
+        compiled lazily and dropped when the server ip changes or the config
+        is re-read from disk.
+        """
+        cache = await self._load_cache()
+        server_ip = await config.resolve_server_ip()
+        if self._link_templates_for != (server_ip, cache.reloads):
+            self._link_templates = {}
+            self._link_templates_for = (server_ip, cache.reloads)
+            self._subscriptions.clear()
+        candidates = self._candidate_inbounds(cache)
+        primary = candidates[0] if candidates else None
+        templates = self._link_templates
+
+        def template_for(uuid: str) -> LinkTemplate:
+            ref = cache.index.get(uuid)
+            i = ref[0] if ref is not None else primary
+            template = templates.get(i)
+            if template is None:
+                template = templates[i] = self._build_link_template(cache, i, i == primary, server_ip)
+            return template
+
+        return template_for
 
     async def create_user_config_as_link_string(self, uuid: str, config_name: str) -> str:
-        target_port = config.xray_link_port
-        
-        link = (
-            f"vless://{uuid}@{config.server_ip}:{target_port}"
-            f"?security=reality"
-            f"&sni={config.xray_sni}"
-            f"&fp=chrome"
-            f"&pbk={config.xray_publickey}"
-            f"&sid={config.xray_shortid}"
-            f"&encryption=none"
-            f"&type={config.xray_network}" 
-        )
-        
-        if config.xray_network == "xhttp":
-            link += f"&path={config.xray_path}&mode=auto"
-        elif config.xray_network == "tcp":
-            link += "&flow=xtls-rprx-vision"
-        elif config.xray_network == "grpc":
-            link += f"&serviceName={config.xray_path}"
-            
-        link += f"#{self._config_prefix}_{config_name}"
-        return link
+        return (await self._get_link_templates())(uuid).render(uuid, config_name)
+
+    async def create_links(self, configs: list[tuple[str, str]]) -> list[str]:
+        """Render many links at once, configs: [(uuid, config_name)]"""
+        template_for = await self._get_link_templates()
+        return [template_for(uuid).render(uuid, config_name) for uuid, config_name in configs]
+
+    async def get_subscription(self, uuid: str, config_name: str) -> tuple[bytes, str, float] | None:
+        """Base64 subscription blob, its ETag and Last-Modified timestamp.
+
+        None if the uuid is not configured on this server.
+        """
+        cache = await self._load_cache()
+        if uuid not in cache.index or uuid in self._pool:
+            return None
+        template = (await self._get_link_templates())(uuid)
+        blob, etag = self._subscriptions.get(template, uuid, config_name)
+        return blob, etag, template.compiled_at
 
     async def get_all_uuids(self) -> list[str]:
-        conf = await self._load_server_config()
-        uuids = []
-        for inbound in conf.get("inbounds", []):
-            clients = inbound.get("settings", {}).get("clients", [])
-            for c in clients:
-                uuids.append(c["id"])
-        return list(set(uuids))
+        cache = await self._load_cache()
+        return [uuid for uuid in cache.index if uuid not in self._pool]
+
+    def _client_filter(self, cache: ConfigCache, network: str | None, tag: str | None, uuid_prefix: str | None):
+        """Predicate (inbound position, uuid) for client listings, free pool slots excluded"""
+        inbounds = {
+            i for i in range(len(cache.inbounds))
+            if (network is None or cache.inbound_network(i) == network)
+            and (tag is None or cache.inbound_tag(i) == tag)
+        }
+        prefix = uuid_prefix or ""
+        return lambda i, uuid: i in inbounds and uuid.startswith(prefix) and uuid not in self._pool
+
+    def _inbound_fields(self, cache: ConfigCache, i: int) -> dict:
+        return {
+            "inbound": cache.inbound_tag(i),
+            "network": cache.inbound_network(i),
+            "port": cache.inbounds[i].get("port"),
+        }
+
+    def _client_record(self, inbound_fields: dict, client: dict) -> dict:
+        return {
+            "uuid": client.get("id"),
+            "email": client.get("email"),
+            "flow": client.get("flow", ""),
+            **inbound_fields,
+        }
+
+    async def list_clients(
+        self,
+        cursor: str | None = None,
+        limit: int = 1000,
+        network: str | None = None,
+        tag: str | None = None,
+        uuid_prefix: str | None = None,
+    ) -> dict:
+        """Page of clients ordered by uuid, cursor is the last uuid of the previous page.
+
+        Ordering by uuid keeps pages stable while clients are added and
+        removed; a page costs one pass over the index, not a full sort.
+        """
+        cache = await self._load_cache()
+        matches = self._client_filter(cache, network, tag, uuid_prefix)
+        page = heapq.nsmallest(
+            limit,
+            (
+                (uuid, ref) for uuid, ref in cache.index.items()
+                if (cursor is None or uuid > cursor) and matches(ref[0], uuid)
+            ),
+            key=lambda item: item[0],
+        )
+        clients = [
+            self._client_record(self._inbound_fields(cache, i), cache.clients(i)[position])
+            for _, (i, position) in page
+        ]
+        return {
+            "clients": clients,
+            "next_cursor": page[-1][0] if len(page) == limit else None,
+        }
+
+    async def iter_clients_ndjson(
+        self,
+        network: str | None = None,
+        tag: str | None = None,
+        uuid_prefix: str | None = None,
+        chunk_size: int = 1000,
+    ) -> AsyncIterator[bytes]:
+        """Clients as NDJSON chunks straight from the cached config.
+
+        Lists the config as it was when the stream started: commits and
+        reloads during the export are not seen, nothing is missed or
+        repeated. The snapshot copies client lists, not the clients, and
+        records are rendered chunk by chunk.
+        """
+        cache = await self._load_cache()
+        matches = self._client_filter(cache, network, tag, uuid_prefix)
+        # Снимок до первого await: позиции в кэше могут съехать между кусками
+        snapshot = [(i, self._inbound_fields(cache, i), list(cache.clients(i))) for i in range(len(cache.inbounds))]
+        lines = []
+        for i, inbound_fields, clients in snapshot:
+            for client in clients:
+                if not matches(i, client.get("id", "")):
+                    continue
+                lines.append(json.dumps(self._client_record(inbound_fields, client)))
+                if len(lines) >= chunk_size:
+                    yield ("\n".join(lines) + "\n").encode()
+                    lines = []
+                    await asyncio.sleep(0)  # Отдаём цикл событий между кусками
+        if lines:
+            yield ("\n".join(lines) + "\n").encode()
+
+    async def _submit_chunks(self, make_mutation: Callable[[list[str]], Mutation], uuids: list[str]) -> list:
+        """Submit a bulk operation in chunks of XRAY_BULK_CHUNK uuids.
+
+        Each chunk is its own commit at BULK priority, interactive
+        mutations get in between; a single chunk is a small operation and
+        goes at INTERACTIVE priority. Waits for every chunk. Raises
+        CommitError if nothing was committed, PartialCommitError if only
+        some chunks were.
+        """
+        size = config.xray_bulk_chunk
+        chunks = [uuids[n : n + size] for n in range(0, len(uuids), size)]
+        priority = BULK if len(chunks) > 1 else INTERACTIVE
+        results = await asyncio.gather(
+            *(self._mutations.submit(make_mutation(chunk), priority=priority) for chunk in chunks),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if not errors:
+            return results
+        unexpected = [error for error in errors if not isinstance(error, CommitError)]
+        if unexpected or len(errors) == len(results):
+            raise (unexpected or errors)[0]
+        # Закоммиченные куски уже в конфиге: сообщаем, что применено, а не общий провал
+        outcomes = list(zip(chunks, results))
+        raise PartialCommitError(
+            [uuid for chunk, result in outcomes if not isinstance(result, BaseException) for uuid in chunk],
+            [uuid for chunk, result in outcomes if isinstance(result, BaseException) for uuid in chunk],
+            [result for result in results if not isinstance(result, BaseException)],
+        )
+
+    def get_queue_stats(self) -> dict:
+        return self._mutations.stats()
 
     # --- БЕЗОПАСНОЕ УДАЛЕНИЕ ---
     async def disconnect_user_by_uuid(self, uuid: str) -> bool:
-        conf = await self._load_server_config()
-        updated = deepcopy(conf)
-        
-        modified = False
-        for inbound in updated.get("inbounds", []):
-            # Безопасное получение settings, чтобы не словить KeyError
-            settings = inbound.get("settings", {})
-            if "clients" in settings:
-                original_len = len(settings["clients"])
-                settings["clients"] = [
-                    c for c in settings["clients"] if c.get("id") != uuid
-                ]
-                # Если длина изменилась, значит кого-то удалили
-                if len(settings["clients"]) < original_len:
-                    modified = True
-                    # Важно: обновляем словарь в инбаунде (хотя он и так по ссылке, но для надежности)
-                    inbound["settings"] = settings
-
-        if modified:
-            return await self._apply_changes(updated, conf)
-        else:
+        try:
+            removed_count = await self._mutations.submit(RemoveClients({uuid}))
+        except CommitError:
+            return False
+        if not removed_count:
             logger.info(f"User {uuid} not found, skipping restart.")
-            return True # Юзера и так нет, считаем что успех
+        return True # Юзера и так нет, считаем что успех
 
     async def disconnect_many_uuids(self, uuids: list[str]) -> bool:
-        conf = await self._load_server_config()
-        updated = deepcopy(conf)
-        
-        modified = False
-        for inbound in updated.get("inbounds", []):
-            settings = inbound.get("settings", {})
-            if "clients" in settings:
-                original_len = len(settings["clients"])
-                settings["clients"] = [
-                    c for c in settings["clients"] if c.get("id") not in uuids
-                ]
-                if len(settings["clients"]) < original_len:
-                    modified = True
-                    inbound["settings"] = settings
-
-        if modified:
-            return await self._apply_changes(updated, conf)
-        else:
-            return True
+        try:
+            await self._submit_chunks(lambda chunk: RemoveClients(set(chunk)), list(dict.fromkeys(uuids)))
+        except CommitError:
+            return False
+        return True
 
     async def deactivate_user_configs_in_xray(self, uuids: list[str]) -> bool:
         return await self.disconnect_many_uuids(uuids)
 
-    async def reactivate_user_configs_in_xray(self, config_uuids: list[str]) -> bool:
+    async def reactivate_user_configs_in_xray(self, config_uuids: list[str], expires_at: float | None = None) -> bool:
         if not config_uuids: return False
 
-        server_config = await self._load_server_config()
-        updated_config = deepcopy(server_config)
+        current_flow = self._current_flow()
 
-        target_net = config.xray_network
-        current_flow = "" if target_net in ["xhttp", "grpc"] else "xtls-rprx-vision"
+        def reactivate(chunk: list[str]) -> AddClients:
+            return AddClients(
+                [self._make_client(uuid, current_flow) for uuid in chunk],
+                expires=dict.fromkeys(chunk, expires_at) if expires_at is not None else {},
+                readd=True,
+            )
 
-        target_inbound = None
-        for inbound in updated_config.get("inbounds", []):
-            if inbound.get("streamSettings", {}).get("network", "tcp") == target_net:
-                target_inbound = inbound
-                break
-        
-        if not target_inbound and updated_config.get("inbounds"):
-            target_inbound = updated_config["inbounds"][0]
+        try:
+            await self._submit_chunks(reactivate, list(dict.fromkeys(config_uuids)))
+        except CommitError:
+            return False
+        return True
+
+    async def reconcile_clients(self, desired_uuids: list[str], add_missing: bool = True) -> dict | None:
+        """Converge configured clients to the desired set.
 
-        if target_inbound:
-            if "settings" not in target_inbound: target_inbound["settings"] = {}
-            if "clients" not in target_inbound["settings"]: target_inbound["settings"]["clients"] = []
+        With add_missing the convergence is one commit. Without it (cleanup)
+        the stale clients are removed in bulk chunks. Returns
+        {"added": n, "removed": m}, or None if a commit failed; raises
+        PartialCommitError if only some of the chunks were committed.
+        """
+        desired = set(desired_uuids)
+        try:
+            if add_missing:
+                return await self._mutations.submit(SyncClients(desired), priority=BULK)
+            cache = await self._load_cache()
+            stale = [uuid for uuid in cache.index if uuid not in desired and uuid not in self._pool]
+            removed = await self._submit_chunks(lambda chunk: RemoveClients(set(chunk)), stale)
+        except CommitError:
+            return None
+        return {"added": 0, "removed": sum(removed)}
 
-            for uuid in config_uuids:
-                existing_ids = [c["id"] for c in target_inbound["settings"]["clients"]]
-                if uuid not in existing_ids:
-                    target_inbound["settings"]["clients"].append({
-                        "id": uuid,
-                        "email": f"{uuid}@example.com",
-                        "flow": current_flow
-                    })
+    async def get_user_configs(self, telegram_id: int) -> list[dict] | None:
+        """Configs of a telegram user from the client store, None without the store.
 
-        return await self._apply_changes(updated_config, server_config)
+        Active configs come with their link, deactivated ones with None.
+        """
+        if self._store is None:
+            return None
+        configs = await asyncio.to_thread(self._store.by_telegram_id, telegram_id)
+        template_for = await self._get_link_templates()
+        for item in configs:
+            uuid = item["uuid"]
+            item["link"] = template_for(uuid).render(uuid, item["config_name"] or "") if item["active"] else None
+        return configs
+
+    def get_pool_stats(self) -> dict:
+        return {
+            "size": self._pool.size,
+            "free": len(self._pool),
+            "low_watermark": self._pool.low_watermark,
+        }
+
+    async def run_pool_refiller(self):
+        """Top the slot pool up in one batched commit whenever it runs low"""
+        await self._wait_for_leadership()
+        while True:
+            # Сбрасываем сигнал до чтения дефицита: выдача во время пополнения разбудит снова
+            self._pool_wanted.clear()
+            async with self._shared_state():
+                deficit = self._pool.deficit
+            if deficit:
+                generator = CredentialsGenerator()
+                flow = self._current_flow()
+                uuids = [generator.generate_uuid() for _ in range(deficit)]
+                self._pool.reserve(uuids)
+                try:
+                    await self._mutations.submit(
+                        AddClients([self._make_client(uuid, flow) for uuid in uuids]), priority=BULK
+                    )
+                except CommitError:
+                    self._pool.release(uuids)
+                    await asyncio.sleep(5)
+                    continue
+                async with self._shared_state():
+                    cache = await self._load_cache()
+                    self._pool.commit([uuid for uuid in uuids if uuid in cache.index])
+                    self._pool.release([uuid for uuid in uuids if uuid not in cache.index])
+                logger.info(f"Slot pool refilled with {deficit} clients")
+            if self._store is None:
+                await self._pool_wanted.wait()
+            else:
+                # Слоты раздают и другие воркеры, их сигнал сюда не дойдёт
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._pool_wanted.wait(), timeout=5)
+
+    def get_upcoming_expiries(self, limit: int) -> dict:
+        return {"total": len(self._expiry), "upcoming": self._expiry.upcoming(limit)}
+
+    async def run_expiry_scheduler(self):
+        """Remove expired clients in bounded batches through the mutation queue"""
+        await self._wait_for_leadership()
+        while True:
+            await asyncio.sleep(config.xray_expiry_interval)
+            async with self._shared_state():
+                due = self._expiry.pop_due(time.time(), config.xray_expiry_batch)
+            if not due:
+                continue
+            logger.info(f"Removing {len(due)} expired clients")
+            try:
+                await self._mutations.submit(RemoveClients(set(due)), priority=BULK)
+            except CommitError:
+                # Вернём в индекс, попробуем на следующем тике
+                now = time.time()
+                async with self._shared_state():
+                    self._expiry.update({uuid: now for uuid in due})
+                continue
+            # Снятые с таймера фиксируем в журнале, если им не назначили новый срок
+            async with self._shared_state():
+                self._expiry.update({uuid: None for uuid in due if uuid not in self._expiry})
+
+    def list_snapshots(self) -> list[dict]:
+        return self._snapshots.list()
+
+    async def restore_snapshot(self, snapshot_id: str) -> bool:
+        """Roll config back to a stored snapshot and restart xray.
+
+        Runs under the mutation queue lock, so no batch commits meanwhile.
+        Raises SnapshotNotFound for an unknown id and ValueError if the
+        snapshot does not fit the storage layout.
+        """
+        content = await asyncio.to_thread(self._snapshots.read, snapshot_id)
+        path = self._cache.document_path(json.loads(content))
+        async with self._mutations.exclusive(), self._shared_state():
+            await self._load_cache()
+            previous = await asyncio.to_thread(_read_file, path)
+            try:
+                await self._save_server_config([(path, content)], validate=True, cached=False)
+                self._cache.invalidate()
+                await self._replace_store(await self._load_cache())
+                await self._restart_xray()
+            except XrayConfigInvalid as e:
+                logger.error(e)
+                return False
+            except Exception as e:
+                logger.error(e)
+                CONFIG_ROLLBACKS.inc()
+                try:
+                    if previous is None:
+                        os.remove(path)
+                    else:
+                        await self._save_server_config([(path, previous)], cached=False)
+                    self._cache.invalidate()
+                    await self._replace_store(await self._load_cache())
+                    await self._restart_xray()
+                except Exception as rollback_error:
+                    logger.critical(f"Rollback failed, xray may be down: {rollback_error}")
+                return False
+        logger.info(f"Config restored from snapshot {snapshot_id}")
+        return True
+
+    async def get_generation(self) -> int:
+        """Current config generation (revalidates the cache first)"""
+        await self._load_cache()
+        if self._store is not None:
+            await asyncio.to_thread(self._changelog.refresh)
+        return self._changelog.generation
+
+    async def get_inbound_stats(self) -> list[dict]:
+        """Configured clients per inbound"""
+        cache = await self._load_cache()
+        return [
+            {
+                "tag": cache.inbound_tag(i),
+                "network": cache.inbound_network(i),
+                "port": inbound.get("port"),
+                "clients": len(cache.clients(i)),
+            }
+            for i, inbound in enumerate(cache.inbounds)
+        ]
 
     async def get_active_client_count(self) -> int:
         try:
-            server_config = await self._load_server_config()
-            target_net = config.xray_network
-            
-            for inbound in server_config.get("inbounds", []):
-                network = inbound.get("streamSettings", {}).get("network", "tcp")
-                if network == target_net:
-                    clients = inbound.get("settings", {}).get("clients", [])
-                    return len(clients)
-            return 0
+            cache = await self._load_cache()
+            # Слоты пула (свободные и ещё не переданные в пул после коммита) - не пользователи
+            slots = len(self._pool) + self._pool.reserved_count(lambda uuid: uuid in cache.index)
+            return max(0, cache.network_counts[config.xray_network] - slots)
         except Exception as e:
             logger.error(f"Stat error: {e}")
             return 0
             
-    async def _apply_changes(self, new_conf, old_conf) -> bool:
+    async def _apply_changes(self, edit: ConfigEdit) -> bool:
+        """Persist a staged edit and apply its delta to running xray.
+
+        In api mode the changes are pushed live, restart is only a
+        fallback. The cache is not touched: the caller applies the edit
+        once this returns True. On failure the files are restored from it.
+        """
+        cache = self._cache
+        # Переписываем только файлы затронутых инбаундов (в confdir-раскладке)
+        positions = edit.positions
         try:
-            await self._save_server_config(new_conf)
-            await self._restart_xray()
+            await self._save_server_config(self._dirty_documents(positions, edit.inbounds()), validate=True)
+            live_added = [(cache.inbound_tag(i), c) for i, c in edit.added]
+            live_removed = [(cache.inbound_tag(i), c.get("email")) for i, c in edit.removed]
+            if not await self._apply_live(live_added, live_removed):
+                await self._restart_xray()
             return True
+        except XrayConfigInvalid as e:
+            # Кандидат не прошёл проверку: файл и xray не тронуты
+            logger.error(e)
+            return False
         except Exception as e:
             logger.error(e)
-            await self._save_server_config(old_conf)
-            await self._restart_xray()
-            return False
\ No newline at end of file
+            CONFIG_ROLLBACKS.inc()
+            try:
+                await self._save_server_config(self._dirty_documents(positions))
+                await self._restart_xray()
+            except Exception as rollback_error:
+                self._cache.invalidate()
+                logger.critical(f"Rollback failed, xray may be down: {rollback_error}")
+            return False
@@ -248,6 +248,24 @@ sudo cat <<EOF > /usr/local/etc/xray/config.json
         "access": "/var/log/xray/access.log",
         "error": "/var/log/xray/error.log"
     },
+    "api": {
+        "tag": "api",
+        "listen": "127.0.0.1:10085",
+        "services": ["HandlerService", "StatsService"]
+    },
+    "stats": {},
+    "policy": {
+        "levels": {
+            "0": {
+                "statsUserUplink": true,
+                "statsUserDownlink": true
+            }
+        },
+        "system": {
+            "statsInboundUplink": true,
+            "statsInboundDownlink": true
+        }
+    },
     "inbounds": [
         {
             "port": 443,
@@ -322,6 +340,10 @@ XRAY_SHORTID = "$short_id"
 XRAY_SNI = "$site_url"
 XRAY_NETWORK = "xhttp"
 XRAY_PATH = "/update"
+XRAY_APPLY_MODE = "api"
+XRAY_API_ADDRESS = "127.0.0.1:10085"
+XRAY_STATS_INTERVAL = "60"
+XRAY_ACCESS_LOG = "/var/log/xray/access.log"
 EOF
 
 echo "Установка завершена! Сервер настроен на XHTTP + Microsoft."
\ No newline at end of file
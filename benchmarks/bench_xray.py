@@ -0,0 +1,273 @@
+"""Benchmark XrayConfiguration through the FastAPI app.
+
+Generates synthetic config.json files with many clients spread over
+xhttp/grpc/tcp inbounds, replaces the xray restart and uuid generation
+with in-process fakes and measures throughput and p50/p99 latency of the
+public routes at several concurrency levels. Every worker is its own
+caller (X-Caller-Id) and admission limits default to the highest
+concurrency, so the numbers describe commits rather than 429s; requests
+rejected by admission control are counted apart from errors.
+
+    python -m benchmarks.bench_xray --sizes 1000 10000 --output bench.json
+    python -m benchmarks.bench_xray --compare bench.json
+
+Results are JSON so runs from different commits can be compared; with
+--compare the process exits with code 1 if any case regressed by more
+than --threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+NETWORKS = ("xhttp", "grpc", "tcp")
+
+
+def generate_config(path: str, clients: int, inbounds: int = 3):
+    """Write config.json with `clients` spread evenly over `inbounds`"""
+    config = {"log": {"loglevel": "warning"}, "inbounds": [], "outbounds": [{"protocol": "freedom", "tag": "direct"}]}
+    for i in range(inbounds):
+        network = NETWORKS[i % len(NETWORKS)]
+        config["inbounds"].append({
+            "port": 443 + i,
+            "protocol": "vless",
+            "tag": f"bench_{network}_{i}",
+            "settings": {"clients": [], "decryption": "none"},
+            "streamSettings": {"network": network, "security": "reality"},
+        })
+    for n in range(clients):
+        client_uuid = str(uuid.UUID(int=n))
+        inbound = config["inbounds"][n % inbounds]
+        flow = "xtls-rprx-vision" if inbound["streamSettings"]["network"] == "tcp" else ""
+        inbound["settings"]["clients"].append(
+            {"id": client_uuid, "email": f"{client_uuid}@example.com", "flow": flow}
+        )
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+    return [str(uuid.UUID(int=n)) for n in range(clients)]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_case(client, make_request, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    rejected = 0
+    counter = iter(range(requests))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(caller: int):
+        nonlocal errors, rejected
+        headers = {"X-Caller-Id": f"bench{caller}"}
+        for n in counter:
+            async with semaphore:
+                started = time.perf_counter()
+                response = await make_request(client, n, headers)
+                # 429 - отказ допуска, в латентность и ошибки не идёт
+                if response.status_code == 429:
+                    rejected += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(caller) for caller in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "errors": errors,
+        "rejected": rejected,
+    }
+
+
+def build_cases(uuids: list[str]) -> dict:
+    """Request factories per operation, each gets the request number and caller headers"""
+
+    async def add_user(client, n, headers):
+        return await client.post("/add_user/BENCH/", params={"user_id": n, "config_name": f"bench{n}"}, headers=headers)
+
+    async def delete_config(client, n, headers):
+        return await client.delete("/delete_config/bench/", params={"config_uuid": uuids[n % len(uuids)]}, headers=headers)
+
+    async def deactivate(client, n, headers):
+        batch = uuids[(n * 10) % len(uuids):][:10]
+        return await client.request("DELETE", "/deactivate_configs/bench/", json={"config_uuids": batch}, headers=headers)
+
+    async def reactivate(client, n, headers):
+        batch = uuids[(n * 10) % len(uuids):][:10]
+        return await client.post("/reactivate_configs/bench/", json={"config_uuids": batch}, headers=headers)
+
+    async def cleanup_configs(client, n, headers):
+        # Каждый запрос выкидывает небольшую порцию клиентов
+        valid = uuids[(n + 1) * 10:]
+        return await client.request("DELETE", "/cleanup_configs/bench/", json={"valid_uuids": valid}, headers=headers)
+
+    async def server_stats(client, n, headers):
+        return await client.get("/server_stats/", headers=headers)
+
+    return {
+        "add_user": add_user,
+        "delete_config": delete_config,
+        "deactivate": deactivate,
+        "reactivate": reactivate,
+        "cleanup_configs": cleanup_configs,
+        "server_stats": server_stats,
+    }
+
+
+async def run_benchmarks(args, config_path: str) -> list[dict]:
+    import httpx
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    from app.main import app
+    from app.xray import xray_configuration
+
+    reload_delay = args.reload_delay_ms / 1000
+    reloads = 0
+
+    async def fake_restart(self):
+        nonlocal reloads
+        reloads += 1
+        if reload_delay:
+            await asyncio.sleep(reload_delay)
+
+    uuid_counter = iter(range(10**12, 10**13))
+    xray_configuration.XrayConfiguration._restart_xray = fake_restart
+    xray_configuration.CredentialsGenerator.generate_uuid = (
+        lambda self, seed=None: str(uuid.UUID(int=next(uuid_counter)))
+    )
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for size in args.sizes:
+            for operation in args.operations:
+                for concurrency in args.concurrency:
+                    uuids = generate_config(config_path, size, args.inbounds)
+                    make_request = build_cases(uuids)[operation]
+                    requests = args.requests if operation != "cleanup_configs" else max(1, args.requests // 10)
+                    reloads = 0
+                    result = await run_case(client, make_request, requests, concurrency)
+                    result.update(clients=size, operation=operation, reloads=reloads)
+                    results.append(result)
+                    print(
+                        f"{operation:>16} clients={size:<7} c={concurrency:<4} "
+                        f"{result['throughput_rps']:>9} rps  p50={result['p50_ms']}ms "
+                        f"p99={result['p99_ms']}ms reloads={reloads} errors={result['errors']} rejected={result['rejected']}",
+                        file=sys.stderr,
+                    )
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """Cases where throughput dropped or p50 grew by more than threshold"""
+    key = lambda r: (r["operation"], r["clients"], r["concurrency"])
+    baseline_by_key = {key(r): r for r in baseline}
+    regressions = []
+    for result in current:
+        old = baseline_by_key.get(key(result))
+        if old is None:
+            continue
+        if result["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{key(result)} throughput {old['throughput_rps']} -> {result['throughput_rps']} rps")
+        if result.get("rejected", 0) > old.get("rejected", 0):
+            regressions.append(f"{key(result)} rejected {old.get('rejected', 0)} -> {result['rejected']}")
+        if result["p50_ms"] and old["p50_ms"] and result["p50_ms"] > old["p50_ms"] * (1 + threshold):
+            regressions.append(f"{key(result)} p50 {old['p50_ms']} -> {result['p50_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--inbounds", type=int, default=3)
+    parser.add_argument("--operations", nargs="+", default=list(build_cases(["x"])))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--reload-delay-ms", type=float, default=0, help="simulated xray restart time")
+    parser.add_argument("--batch-window-ms", type=int, default=50)
+    parser.add_argument(
+        "--admission-limit", type=int, help="interactive and bulk admission limits (default: highest concurrency)"
+    )
+    parser.add_argument("--output", help="write JSON results to file instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="xray_bench_")
+    config_path = os.path.join(workdir, "config.json")
+    generate_config(config_path, 0, args.inbounds)
+    admission_limit = args.admission_limit or max(args.concurrency)
+    # Конфигурация читается при импорте app, поэтому env выставляем заранее
+    os.environ.update(
+        XRAY_CONFIG_PATH=config_path,
+        XRAY_PRIVATEKEY=os.environ.get("XRAY_PRIVATEKEY", "bench"),
+        XRAY_PUBLICKEY=os.environ.get("XRAY_PUBLICKEY", "bench"),
+        XRAY_SHORTID=os.environ.get("XRAY_SHORTID", "bench"),
+        SERVER_IP="127.0.0.1",
+        SERVER_COUNTRY="Bench",
+        SERVER_COUNTRY_CODE="BN",
+        SERVER_INFO_CACHE_PATH=os.path.join(workdir, "server_info.json"),
+        XRAY_APPLY_MODE="restart",
+        XRAY_TEST_COMMAND="",
+        XRAY_BATCH_WINDOW_MS=str(args.batch_window_ms),
+        ADMISSION_INTERACTIVE_LIMIT=str(admission_limit),
+        ADMISSION_BULK_LIMIT=str(admission_limit),
+    )
+
+    results = asyncio.run(run_benchmarks(args, config_path))
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "timestamp": time.time(),
+            "reload_delay_ms": args.reload_delay_ms,
+            "batch_window_ms": args.batch_window_ms,
+            "admission_limit": admission_limit,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Конфигурация читается при импорте app, поэтому окружение задаём до него
+_ENV_DIR = tempfile.mkdtemp(prefix="xray_api_tests_")
+os.environ.update(
+    XRAY_CONFIG_PATH=os.path.join(_ENV_DIR, "config.json"),
+    XRAY_PRIVATEKEY="test-private-key",
+    XRAY_PUBLICKEY="test-public-key",
+    XRAY_SHORTID="test-short-id",
+    XRAY_TEST_COMMAND="",
+    SERVER_IP="127.0.0.1",
+    SERVER_COUNTRY="Testland",
+    SERVER_COUNTRY_CODE="TL",
+    SERVER_INFO_CACHE_PATH=os.path.join(_ENV_DIR, "server_info.json"),
+    IDEMPOTENCY_STORE_PATH=os.path.join(_ENV_DIR, "idempotency.jsonl"),
+    XRAY_ACCESS_LOG_STATE_PATH=os.path.join(_ENV_DIR, "access_log_state.json"),
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_config(clients: int = 3) -> dict:
+    return {
+        "inbounds": [{
+            "port": 443,
+            "protocol": "vless",
+            "tag": "vless_tls",
+            "settings": {
+                "clients": [
+                    {"id": f"00000000-0000-0000-0000-{i:012d}", "email": f"{i}@example.com", "flow": ""}
+                    for i in range(clients)
+                ],
+                "decryption": "none",
+            },
+            "streamSettings": {"network": "xhttp", "xhttpSettings": {"path": "/update"}},
+        }],
+        "outbounds": [],
+    }
+
+
+@pytest.fixture
+def xray_configuration(tmp_path, monkeypatch):
+    """XrayConfiguration over a temp config.json, restarts are only counted"""
+    from app.data import config
+    from app.xray.xray_configuration import XrayConfiguration
+
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps(make_config()))
+    monkeypatch.setattr(config, "_xray_config_path", str(config_path))
+    monkeypatch.setattr(config, "_xray_snapshot_dir", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(config, "_xray_expiry_path", str(tmp_path / "expiry.jsonl"))
+    monkeypatch.setattr(config, "_xray_pool_path", str(tmp_path / "pool.json"))
+    monkeypatch.setattr(config, "_xray_batch_window", 0)
+
+    xray = XrayConfiguration()
+    xray.restarts = 0
+
+    async def restart():
+        xray.restarts += 1
+
+    monkeypatch.setattr(xray, "_restart_xray", restart)
+    return xray
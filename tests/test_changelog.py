@@ -0,0 +1,37 @@
+from app.xray.changelog import ChangeLog
+
+
+def test_since_returns_net_changes():
+    changelog = ChangeLog()
+    changelog.record(["a", "b"], [])
+    changelog.record(["c"], ["a"])
+    changelog.record(["a"], ["b"])
+
+    changes = changelog.since(1)
+    assert (changes["resync"], changes["generation"]) == (False, 3)
+    assert sorted(changes["added"]) == ["a", "c"] and changes["removed"] == ["b"]
+    assert changelog.since(3)["added"] == changelog.since(3)["removed"] == []
+
+
+def test_resync_bounds_after_eviction():
+    changelog = ChangeLog(max_changes=3)
+    changelog.record(["a", "b"], [])
+    changelog.record(["c", "d"], [])
+
+    # Первое поколение вытеснено целиком: с него дельту уже не собрать
+    assert changelog.since(0)["resync"] is True
+    assert changelog.since(1) == {"epoch": changelog.epoch, "generation": 2, "resync": False, "added": ["c", "d"], "removed": []}
+    assert changelog.since(2)["resync"] is False
+    assert changelog.since(3)["resync"] is True
+
+
+def test_epoch_mismatch_and_reset_force_resync():
+    changelog = ChangeLog()
+    changelog.record(["a"], [])
+    epoch = changelog.epoch
+
+    assert changelog.since(0, epoch="other")["resync"] is True
+    changelog.reset()
+    assert changelog.epoch != epoch
+    assert changelog.since(1, epoch=epoch)["resync"] is True
+    assert changelog.since(changelog.generation, epoch=changelog.epoch)["resync"] is False
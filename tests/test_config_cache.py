@@ -0,0 +1,150 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from app.xray.config_cache import ConfigCache
+from conftest import make_config
+
+
+@pytest.fixture
+def cache(tmp_path) -> ConfigCache:
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(make_config(clients=4)))
+    return asyncio.run(ConfigCache(str(path)).load())
+
+
+def uuid(n: int) -> str:
+    return f"00000000-0000-0000-0000-{n:012d}"
+
+
+def test_edit_is_invisible_until_applied(cache):
+    edit = cache.edit()
+    edit.remove(uuid(0))
+    edit.add(0, {"id": "new", "email": "new@example.com", "flow": ""})
+
+    assert uuid(0) in cache.index and "new" not in cache.index
+    assert [c["id"] for c in cache.clients(0)] == [uuid(n) for n in range(4)]
+    assert cache.network_counts["xhttp"] == 4
+
+    cache.apply(edit)
+    assert uuid(0) not in cache.index
+    assert cache.network_counts["xhttp"] == 4
+    for key, (i, position) in cache.index.items():
+        assert cache.clients(i)[position]["id"] == key
+
+
+def test_remove_swaps_last_client_into_place(cache):
+    edit = cache.edit()
+    assert edit.remove(uuid(1)) == [(0, {"id": uuid(1), "email": "1@example.com", "flow": ""})]
+    assert edit.remove("missing") == []
+    cache.apply(edit)
+
+    assert [c["id"] for c in cache.clients(0)] == [uuid(0), uuid(3), uuid(2)]
+    assert cache.index[uuid(3)] == (0, 1)
+    assert cache.network_counts["xhttp"] == 3
+
+
+def test_staged_documents_leave_cached_data_alone(cache):
+    edit = cache.edit()
+    edit.add(0, {"id": "new", "email": "new@example.com", "flow": ""})
+    [(_, document)] = cache.documents(edit.positions, edit.inbounds())
+
+    assert len(document["inbounds"][0]["settings"]["clients"]) == 5
+    assert len(cache.data["inbounds"][0]["settings"]["clients"]) == 4
+
+
+def test_edit_of_a_reloaded_cache_is_dropped(cache, tmp_path):
+    edit = cache.edit()
+    edit.add(0, {"id": "new", "email": "new@example.com", "flow": ""})
+    (tmp_path / "config.json").write_text(json.dumps(make_config(clients=2)))
+    asyncio.run(cache.load())
+
+    cache.apply(edit)
+    assert "new" not in asyncio.run(cache.load()).index
+
+
+def test_duplicated_uuid_is_removed_everywhere(tmp_path):
+    document = make_config(clients=3)
+    document["inbounds"][0]["settings"]["clients"].append({"id": uuid(0), "email": "dup", "flow": ""})
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(document))
+    cache = asyncio.run(ConfigCache(str(path)).load())
+
+    edit = cache.edit()
+    assert len(edit.remove(uuid(0))) == 2
+    cache.apply(edit)
+    assert [c["id"] for c in cache.clients(0)] == [uuid(1), uuid(2)]
+    assert cache.index == {uuid(1): (0, 0), uuid(2): (0, 1)}
+
+
+def test_index_matches_a_rebuild_after_random_edits(cache):
+    rng = random.Random(7)
+    present = [uuid(n) for n in range(4)]
+    added = 0
+    for _ in range(50):
+        edit = cache.edit()
+        for _ in range(rng.randint(1, 5)):
+            if present and rng.random() < 0.5:
+                edit.remove(present.pop(rng.randrange(len(present))))
+            else:
+                added += 1
+                present.append(f"new-{added}")
+                edit.add(0, {"id": present[-1], "email": "", "flow": ""})
+        cache.apply(edit)
+
+    index, counts = dict(cache.index), dict(cache.network_counts)
+    cache._rebuild_index()
+    assert index == cache.index and counts == dict(cache.network_counts)
+    assert sorted(index) == sorted(present)
+
+def test_readers_do_not_see_a_commit_in_flight(xray_configuration, monkeypatch):
+    seen_during_restart = []
+
+    async def restart():
+        seen_during_restart.append(len(await xray_configuration.get_all_uuids()))
+
+    monkeypatch.setattr(xray_configuration, "_restart_xray", restart)
+    _, added = asyncio.run(xray_configuration.add_new_user("phone", 42))
+
+    assert seen_during_restart == [3]
+    assert added in asyncio.run(xray_configuration.get_all_uuids())
+
+
+def test_failed_commit_is_never_visible(xray_configuration, monkeypatch):
+    seen = []
+
+    async def restart():
+        seen.append(len(await xray_configuration.get_all_uuids()))
+        if len(seen) == 1:
+            raise RuntimeError("xray did not come back")
+
+    monkeypatch.setattr(xray_configuration, "_restart_xray", restart)
+    with pytest.raises(Exception, match="Failed to update server config"):
+        asyncio.run(xray_configuration.add_new_user("phone", 42))
+
+    assert seen == [3, 3]
+    assert len(asyncio.run(xray_configuration.get_all_uuids())) == 3
+    with open(xray_configuration._config_path) as f:
+        assert len(json.load(f)["inbounds"][0]["settings"]["clients"]) == 3
+
+
+def test_ndjson_export_lists_config_as_of_its_start(xray_configuration):
+    async def main():
+        exported = []
+        stream = xray_configuration.iter_clients_ndjson(chunk_size=1)
+        exported.append(await anext(stream))
+        # Удаление с переносом последнего клиента посреди выгрузки, затем правка файла руками
+        await xray_configuration.disconnect_user_by_uuid(uuid(0))
+        document = make_config(clients=1)
+        document["inbounds"][0]["tag"] = "renamed"
+        with open(xray_configuration._config_path, "w") as f:
+            json.dump(document, f)
+        await xray_configuration.get_all_uuids()
+        exported.extend([chunk async for chunk in stream])
+        return [json.loads(chunk) for chunk in exported]
+
+    records = asyncio.run(main())
+    assert [record["uuid"] for record in records] == [uuid(0), uuid(1), uuid(2)]
+    assert {record["inbound"] for record in records} == {"vless_tls"}
@@ -0,0 +1,133 @@
+import asyncio
+
+import httpx
+
+import app.controller
+from app.controller.fleet import Fleet, Node
+from app.controller.routes import _fanned_out, _forwarded
+
+
+def _fleet(handler) -> Fleet:
+    nodes = [Node("ee1", "http://ee1", "EE"), Node("ee2", "http://ee2", "EE")]
+    return Fleet(nodes, transport=httpx.MockTransport(handler))
+
+
+def test_registry_does_not_shadow_fleet_module():
+    import app.controller.fleet
+
+    assert app.controller.fleet.Fleet is Fleet
+    assert hasattr(app.controller, "registry")
+
+
+def test_forward_keeps_upstream_headers():
+    def handler(request):
+        return httpx.Response(
+            429, json={"detail": "busy"}, headers={"Retry-After": "3", "ETag": '"abc"', "X-Internal": "1"}
+        )
+
+    fleet = _fleet(handler)
+    result = asyncio.run(fleet.forward(fleet.select("EE"), "POST", "/add_user/EE/"))
+    response = _forwarded(result)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert response.headers["ETag"] == '"abc"'
+    assert "X-Internal" not in response.headers
+
+
+def test_fan_out_reports_longest_retry_after():
+    def handler(request):
+        retry_after = "2" if request.url.host == "ee1" else "5"
+        return httpx.Response(429, json={"detail": "busy"}, headers={"Retry-After": retry_after})
+
+    fleet = _fleet(handler)
+    result = asyncio.run(fleet.fan_out(fleet.select("all"), "DELETE", "/cleanup_configs/{node}/"))
+    response = _fanned_out(result)
+
+    assert response.status_code == 502
+    assert response.headers["Retry-After"] == "5"
+
+
+def _call(fleet: Fleet, monkeypatch, method: str, path: str, **kwargs) -> httpx.Response:
+    """Request to the controller routes with the registry replaced by fleet"""
+    from fastapi import FastAPI
+
+    import app.controller.routes
+
+    monkeypatch.setattr(app.controller.routes, "registry", fleet)
+    controller = FastAPI()
+    controller.include_router(app.controller.routes.router, prefix="/fleet")
+
+    async def main():
+        transport = httpx.ASGITransport(app=controller)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.request(method, path, **kwargs)
+
+    return asyncio.run(main())
+
+
+def test_fan_out_reports_partial_failure():
+    def handler(request):
+        if request.url.host == "ee2":
+            return httpx.Response(500, json={"detail": "boom"})
+        return httpx.Response(200, json={"status": "success"})
+
+    fleet = _fleet(handler)
+    result = asyncio.run(fleet.fan_out(fleet.select("EE"), "DELETE", "/deactivate_configs/{node}/"))
+
+    assert (result["status"], result["failed"]) == ("partial", ["ee2"])
+    assert _fanned_out(result).status_code == 200
+
+
+def test_forward_fails_over_only_on_connect_error():
+    seen = []
+
+    def handler(request):
+        seen.append(request.url.host)
+        if request.url.host == "ee1":
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, json={"link": "vless://x"})
+
+    fleet = _fleet(handler)
+    result = asyncio.run(fleet.forward(fleet.select("EE"), "POST", "/add_user/EE/"))
+    assert (result["node"], result["ok"], seen) == ("ee2", True, ["ee1", "ee2"])
+
+    def timeout(request):
+        seen.append(request.url.host)
+        raise httpx.ReadTimeout("slow", request=request)
+
+    seen.clear()
+    fleet = _fleet(timeout)
+    result = asyncio.run(fleet.forward(fleet.select("EE"), "POST", "/add_user/EE/"))
+    # Запрос мог выполниться: на другую ноду не повторяем
+    assert (result["status_code"], seen) == (None, ["ee1"])
+
+
+def test_forward_spreads_round_robin():
+    fleet = _fleet(lambda request: httpx.Response(200, json={}))
+
+    async def main():
+        return [(await fleet.forward(fleet.select("EE"), "POST", "/add_user/EE/"))["node"] for _ in range(4)]
+
+    assert asyncio.run(main()) == ["ee1", "ee2", "ee1", "ee2"]
+
+
+def test_idempotency_key_is_forwarded_to_nodes(monkeypatch):
+    keys = []
+
+    def handler(request):
+        keys.append((request.url.host, request.headers.get("Idempotency-Key")))
+        return httpx.Response(200, json={"status": "success"})
+
+    response = _call(
+        _fleet(handler), monkeypatch, "POST", "/fleet/reactivate_configs/EE/",
+        json={"config_uuids": ["u1"]}, headers={"Idempotency-Key": "k1"},
+    )
+    assert response.status_code == 200
+    assert sorted(keys) == [("ee1", "k1"), ("ee2", "k1")]
+
+
+def test_malformed_json_is_rejected(monkeypatch):
+    fleet = _fleet(lambda request: httpx.Response(200, json={}))
+    response = _call(fleet, monkeypatch, "POST", "/fleet/add_users/EE/", content=b"{not json")
+    assert response.status_code == 400
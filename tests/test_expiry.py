@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from app.xray.expiry import ExpiryIndex
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / "expiry.jsonl")
+
+
+def test_journal_is_replayed_on_start(path):
+    index = ExpiryIndex(path)
+    index.update({"a": 100.0, "b": 200.0})
+    index.update({"a": 300.0, "b": None})
+
+    reopened = ExpiryIndex(path)
+    assert len(reopened) == 1 and "b" not in reopened
+    assert reopened.upcoming(10) == [{"uuid": "a", "expires_at": 300.0}]
+
+
+def test_torn_last_line_is_ignored(path):
+    ExpiryIndex(path).update({"a": 100.0})
+    with open(path, "a") as f:
+        f.write('["b", 2')
+
+    assert ExpiryIndex(path).upcoming(10) == [{"uuid": "a", "expires_at": 100.0}]
+
+
+def test_pop_due_skips_moved_expiries(path):
+    index = ExpiryIndex(path)
+    index.update({"a": 10.0, "b": 20.0, "c": 30.0})
+    index.update({"a": 50.0})
+
+    assert index.pop_due(now=35.0, limit=10) == ["b", "c"]
+    assert index.pop_due(now=35.0, limit=10) == []
+    assert index.pop_due(now=60.0, limit=10) == ["a"]
+
+
+def test_compaction_keeps_live_expiries(path):
+    index = ExpiryIndex(path)
+    for n in range(1200):
+        index.update({"moving": float(n)})
+
+    with open(path) as f:
+        assert len(f.readlines()) < 1200
+    assert ExpiryIndex(path).upcoming(10) == [{"uuid": "moving", "expires_at": 1199.0}]
+
+
+def test_refresh_picks_up_other_workers(path):
+    mine, theirs = ExpiryIndex(path), ExpiryIndex(path)
+    theirs.update({"a": 100.0})
+    mine.refresh()
+    assert "a" in mine
+
+    # Другой воркер сжал журнал: читаем заново с начала
+    theirs.update({"a": None, "b": 200.0})
+    theirs._compact()
+    mine.refresh()
+    assert "a" not in mine and "b" in mine
+    with open(path) as f:
+        assert [json.loads(line) for line in f] == [["b", 200.0]]
@@ -0,0 +1,74 @@
+import asyncio
+import json
+
+import pytest
+
+from app.utils.idempotency import IdempotencyKeyReused, IdempotencyStore
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / "idempotency.jsonl")
+
+
+def responder(*statuses: int, delay: float = 0):
+    """execute() answering with the given statuses in turn, counts calls"""
+    statuses = iter(statuses)
+
+    async def execute():
+        execute.calls += 1
+        await asyncio.sleep(delay)
+        return next(statuses), "application/json", b'{"ok": true}'
+
+    execute.calls = 0
+    return execute
+
+
+def test_completed_request_is_replayed_after_restart(path):
+    execute = responder(200)
+    assert asyncio.run(IdempotencyStore(path).run("k", "f", execute)) == (200, "application/json", b'{"ok": true}', False)
+
+    assert asyncio.run(IdempotencyStore(path).run("k", "f", execute)) == (200, "application/json", b'{"ok": true}', True)
+    assert execute.calls == 1
+
+
+def test_duplicate_in_flight_waits_for_the_first(path):
+    store, execute = IdempotencyStore(path), responder(200, delay=0.01)
+
+    async def main():
+        return await asyncio.gather(store.run("k", "f", execute), store.run("k", "f", execute))
+
+    assert [replayed for *_, replayed in asyncio.run(main())] == [False, True]
+    assert execute.calls == 1
+
+
+def test_fingerprint_mismatch_is_rejected(path):
+    store = IdempotencyStore(path)
+    asyncio.run(store.run("k", "f", responder(200)))
+
+    with pytest.raises(IdempotencyKeyReused):
+        asyncio.run(store.run("k", "other", responder(200)))
+
+
+def test_server_errors_are_not_stored(path):
+    store, execute = IdempotencyStore(path), responder(503, 429, 200)
+
+    assert [asyncio.run(store.run("k", "f", execute))[0] for _ in range(4)] == [503, 429, 200, 200]
+    assert execute.calls == 3
+
+
+def test_compaction_and_eviction_keep_newest_keys(path):
+    store = IdempotencyStore(path, max_items=2)
+
+    async def main():
+        for n in range(2100):
+            await store.run(f"k{n}", "f", responder(200))
+
+    asyncio.run(main())
+
+    with open(path) as f:
+        keys = [json.loads(line)[0] for line in f]
+    assert len(keys) < 2100 and keys[-1] == "k2099"
+    reopened = IdempotencyStore(path, max_items=2)
+    reopened._load()
+    assert list(reopened._results) == ["k2098", "k2099"]
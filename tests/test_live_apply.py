@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from app.xray.fake_api import FakeXrayApiServer
+
+
+@pytest.fixture
+def api_mode(xray_configuration, monkeypatch):
+    """Run scenario(xray, server) with XRAY_APPLY_MODE=api against a fake Xray API"""
+    from app.data import config
+    from app.xray.xray_configuration import XrayConfiguration
+
+    monkeypatch.setattr(config, "_xray_apply_mode", "api")
+
+    def run(scenario):
+        async def main():
+            server = FakeXrayApiServer()
+            await server.start()
+            monkeypatch.setattr(config, "_xray_api_address", server.address)
+            xray = XrayConfiguration()
+            xray.restarts = 0
+
+            async def restart():
+                xray.restarts += 1
+
+            monkeypatch.setattr(xray, "_restart_xray", restart)
+            try:
+                await scenario(xray, server)
+            finally:
+                await xray._api_client.close()
+                await server.stop()
+
+        asyncio.run(main())
+
+    return run
+
+
+def test_add_and_remove_without_restart(api_mode):
+    async def scenario(xray, server):
+        _, uuid = await xray.add_new_user("phone", 42)
+        assert server.users["vless_tls"][f"{uuid}@example.com"]["id"] == uuid
+
+        assert await xray.disconnect_user_by_uuid(uuid)
+        assert server.users["vless_tls"] == {}
+        assert (xray.restarts, xray.restarts_avoided) == (0, 2)
+
+    api_mode(scenario)
+
+
+def test_removing_user_unknown_to_xray_counts_as_applied(api_mode):
+    async def scenario(xray, server):
+        # Клиенты из config.json в фейковый API не загружены
+        assert await xray.disconnect_user_by_uuid("00000000-0000-0000-0000-000000000000")
+        assert (xray.restarts, xray.restarts_avoided) == (0, 1)
+
+    api_mode(scenario)
+
+
+def test_api_error_falls_back_to_restart(api_mode):
+    async def scenario(xray, server):
+        server.fail_next = 1
+        _, uuid = await xray.add_new_user("phone", 42)
+        assert (xray.restarts, xray.restarts_avoided) == (1, 0)
+        assert uuid in await xray.get_all_uuids()
+
+    api_mode(scenario)
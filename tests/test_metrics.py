@@ -0,0 +1,33 @@
+import asyncio
+
+import httpx
+
+
+def test_rejected_requests_are_labelled_with_route_template(monkeypatch):
+    import app.main
+    from app.utils.admission import admission
+    from app.utils.metrics import metrics
+
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setitem(admission._limits, "interactive", 0)
+    monkeypatch.setattr(app.main.REQUEST_SECONDS, "_values", {})
+
+    async def main():
+        transport = httpx.ASGITransport(app=app.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/add_user/EE/", params={"config_name": "phone", "user_telegram_id": 1})
+
+    assert asyncio.run(main()).status_code == 429
+    assert list(app.main.REQUEST_SECONDS._values) == [("POST", "/add_user/{country}/", "429")]
+
+
+def test_config_size_gauge_skips_missing_files(xray_configuration, tmp_path, monkeypatch):
+    assert xray_configuration._config_file_bytes()[()] > 0
+
+    (tmp_path / "config.json").unlink()
+    assert xray_configuration._config_file_bytes() == {(): 0}
+
+    from app.xray.config_cache import ConfdirCache
+
+    monkeypatch.setattr(xray_configuration, "_cache", ConfdirCache(str(tmp_path / "missing")))
+    assert xray_configuration._config_file_bytes() == {(): 0}
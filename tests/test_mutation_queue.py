@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from app.xray.mutation_queue import BULK, INTERACTIVE, AddClients, MutationQueue, PartialCommitError, RemoveClients
+
+
+def run_batches(submissions: list[tuple[str, int]]) -> list[list[str]]:
+    """Submit all at once, returns names of the mutations in each commit"""
+    batches = []
+
+    async def commit(mutations):
+        batches.append([next(iter(mutation.uuids)) for mutation in mutations])
+        return [None] * len(mutations)
+
+    async def main():
+        queue = MutationQueue(commit, window=0)
+        await asyncio.gather(*(queue.submit(RemoveClients({name}), priority) for name, priority in submissions))
+
+    asyncio.run(main())
+    return batches
+
+
+def test_bulk_chunks_fold_when_nothing_interactive_waits():
+    assert run_batches([("b1", BULK), ("b2", BULK), ("b3", BULK)]) == [["b1", "b2", "b3"]]
+
+
+def test_bulk_chunks_are_held_back_for_interactive():
+    batches = run_batches([("b1", BULK), ("b2", BULK), ("i1", INTERACTIVE), ("i2", INTERACTIVE)])
+    assert batches == [["i1", "i2", "b1"], ["b2"]]
+
+
+def test_partially_committed_bulk_operation_reports_applied_chunks(xray_configuration, monkeypatch):
+    from app.data import config
+
+    monkeypatch.setattr(config, "_xray_bulk_chunk", 2)
+    monkeypatch.setattr(xray_configuration._mutations, "_max_batch", 1)
+    uuids = asyncio.run(xray_configuration.get_all_uuids())
+
+    async def restart():
+        xray_configuration.restarts += 1
+        if xray_configuration.restarts == 2:
+            raise RuntimeError("xray did not come back")
+
+    monkeypatch.setattr(xray_configuration, "_restart_xray", restart)
+    with pytest.raises(PartialCommitError) as e:
+        asyncio.run(xray_configuration.deactivate_user_configs_in_xray(uuids))
+
+    assert (e.value.applied, e.value.failed, e.value.results) == (uuids[:2], uuids[2:], [2])
+    assert asyncio.run(xray_configuration.get_all_uuids()) == uuids[2:]
+
+
+def test_single_chunk_bulk_operation_is_interactive(xray_configuration, monkeypatch):
+    from app.data import config
+
+    monkeypatch.setattr(config, "_xray_bulk_chunk", 2)
+    submit = xray_configuration._mutations.submit
+    priorities = []
+
+    async def recording_submit(mutation, priority=INTERACTIVE):
+        priorities.append(priority)
+        return await submit(mutation, priority)
+
+    monkeypatch.setattr(xray_configuration._mutations, "submit", recording_submit)
+    asyncio.run(xray_configuration.reactivate_user_configs_in_xray(["r1"]))
+    assert priorities == [INTERACTIVE]
+
+    priorities.clear()
+    asyncio.run(xray_configuration.reactivate_user_configs_in_xray(["r1", "r2", "r3"]))
+    assert priorities == [BULK, BULK]
+
+
+def test_concurrent_mutations_share_one_commit(xray_configuration):
+    async def main():
+        return await asyncio.gather(*(xray_configuration.add_new_user("phone", n) for n in range(5)))
+
+    added = [uuid for _, uuid in asyncio.run(main())]
+    assert xray_configuration.restarts == 1
+    assert set(added) <= set(asyncio.run(xray_configuration.get_all_uuids()))
+
+
+def test_add_and_remove_of_one_uuid_cancel_out(xray_configuration):
+    client = xray_configuration._make_client("transient", "")
+
+    async def main():
+        return await asyncio.gather(
+            xray_configuration._mutations.submit(AddClients([client])),
+            xray_configuration._mutations.submit(RemoveClients({"transient"})),
+        )
+
+    assert asyncio.run(main()) == [True, 1]
+    assert xray_configuration.restarts == 0
+    assert "transient" not in asyncio.run(xray_configuration.get_all_uuids())
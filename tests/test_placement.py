@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+
+from app.xray.placement import HashByUuid
+from conftest import make_config
+
+READDED = "00000000-0000-0000-0000-00000000abcd"
+
+
+@pytest.fixture
+def two_inbounds(tmp_path, monkeypatch):
+    """Config with two inbounds serving xhttp, the second one empty"""
+    from app.data import config
+
+    document = make_config(clients=2)
+    document["inbounds"].append({**document["inbounds"][0], "tag": "vless_second", "port": 8443})
+    document["inbounds"][1]["settings"] = {"clients": [], "decryption": "none"}
+    (tmp_path / "config.json").write_text(json.dumps(document))
+    monkeypatch.setattr(config, "_xray_placement", "least_clients")
+
+
+def make_xray(monkeypatch):
+    from app.xray.xray_configuration import XrayConfiguration
+
+    xray = XrayConfiguration()
+
+    async def restart():
+        pass
+
+    monkeypatch.setattr(xray, "_restart_xray", restart)
+    return xray
+
+
+def inbound_of(xray, uuid: str) -> str:
+    cache = asyncio.run(xray._load_cache())
+    return cache.inbound_tag(cache.index[uuid][0])
+
+
+def test_reactivated_client_returns_to_recorded_inbound(xray_configuration, two_inbounds, tmp_path, monkeypatch):
+    from app.data import config
+
+    monkeypatch.setattr(config, "_xray_store_path", str(tmp_path / "clients.db"))
+    xray = make_xray(monkeypatch)
+
+    # Хэш uuid этого seed указывает на первый инбаунд
+    _, uuid = asyncio.run(xray.add_new_user("phone", 1, seed="a"))
+    assert inbound_of(xray, uuid) == "vless_second"
+    asyncio.run(xray.deactivate_user_configs_in_xray([uuid]))
+    asyncio.run(xray.add_new_users([(2, "phone", None, None), (3, "phone", None, None)]))
+
+    # И least_clients, и хэш выбрали бы теперь первый инбаунд
+    assert asyncio.run(xray.reactivate_user_configs_in_xray([uuid]))
+    assert inbound_of(xray, uuid) == "vless_second"
+
+
+def test_readds_without_store_use_stable_choice(xray_configuration, two_inbounds, monkeypatch):
+    xray = make_xray(monkeypatch)
+    cache = asyncio.run(xray._load_cache())
+    expected = cache.inbound_tag(HashByUuid().choose(cache.edit(), [0, 1], READDED))
+
+    assert asyncio.run(xray.reactivate_user_configs_in_xray([READDED]))
+    assert inbound_of(xray, READDED) == expected
+
+    asyncio.run(xray.deactivate_user_configs_in_xray([READDED]))
+    uuids = asyncio.run(xray.get_all_uuids())
+    assert asyncio.run(xray.reconcile_clients([*uuids, READDED])) == {"added": 1, "removed": 0}
+    assert inbound_of(xray, READDED) == expected
+
+
+def test_secondary_inbound_links_use_public_port(xray_configuration, two_inbounds, monkeypatch):
+    from app.data import config
+
+    xray = make_xray(monkeypatch)
+    link, uuid = asyncio.run(xray.add_new_user("phone", 1))
+    assert inbound_of(xray, uuid) == "vless_second"
+    assert "@127.0.0.1:8443?" in link
+
+    monkeypatch.setattr(config, "_xray_link_ports", {"vless_second": "2053"})
+    xray._link_templates_for = None
+    assert "@127.0.0.1:2053?" in asyncio.run(xray.create_user_config_as_link_string(uuid, "phone"))
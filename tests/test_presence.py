@@ -0,0 +1,92 @@
+import os
+import time
+
+import pytest
+
+from app.xray.presence import AccessLogPresence
+
+
+def line(uuid: str, accepted: bool = True) -> str:
+    stamp = time.strftime("%Y/%m/%d %H:%M:%S")
+    verb = "accepted" if accepted else "rejected"
+    return f"{stamp}.123456 from 1.2.3.4:5555 {verb} tcp:www.google.com:443 [vless_tls >> direct] email: {uuid}@example.com\n"
+
+
+def append(path, *lines: str):
+    with open(path, "a") as f:
+        f.write("".join(lines))
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = tmp_path / "access.log"
+    path.write_text(line("history"))
+    return path
+
+
+def presence(log_path) -> AccessLogPresence:
+    return AccessLogPresence(str(log_path), state_path=str(log_path.parent / "state.json"))
+
+
+def test_first_start_skips_history(log_path):
+    tail = presence(log_path)
+    assert tail._read_new_lines() == {}
+
+    append(log_path, line("u1"), line("u2", accepted=False), line("u3"))
+    assert list(tail._read_new_lines()) == ["u1", "u3"]
+
+
+def test_partial_line_waits_for_the_rest(log_path):
+    tail = presence(log_path)
+    tail._read_new_lines()
+
+    half = line("u1")
+    append(log_path, half[:40])
+    assert tail._read_new_lines() == {}
+    append(log_path, half[40:])
+    assert list(tail._read_new_lines()) == ["u1"]
+
+
+def test_rotation_drains_old_file_then_reads_new(log_path):
+    tail = presence(log_path)
+    tail._read_new_lines()
+
+    append(log_path, line("u1"))
+    os.rename(log_path, f"{log_path}.1")
+    append(f"{log_path}.1", line("u2"))
+    log_path.write_text(line("u3"))
+
+    assert list(tail._read_new_lines()) == ["u1", "u2", "u3"]
+    append(log_path, line("u4"))
+    assert list(tail._read_new_lines()) == ["u4"]
+
+
+def test_copytruncate_reads_from_start(log_path):
+    tail = presence(log_path)
+    tail._read_new_lines()
+    append(log_path, line("u1"), line("u2"))
+    tail._read_new_lines()
+
+    with open(log_path, "w") as f:
+        f.write(line("u3"))
+
+    assert list(tail._read_new_lines()) == ["u3"]
+
+
+def test_restart_resumes_from_saved_offset(log_path):
+    tail = presence(log_path)
+    tail._read_new_lines()
+    append(log_path, line("u1"))
+    assert list(tail._read_new_lines()) == ["u1"]
+
+    append(log_path, line("u2"))
+    restarted = presence(log_path)
+    assert list(restarted._read_new_lines()) == ["u2"]
+
+
+def test_offset_of_another_file_is_ignored(log_path):
+    presence(log_path)._read_new_lines()
+
+    os.rename(log_path, f"{log_path}.1")
+    log_path.write_text(line("u1"))
+    assert list(presence(log_path)._read_new_lines()) == ["u1"]
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from app.data.configuration import Configuration
+from app.utils.ip_info import IPInfo, IPInfoError
+
+
+@pytest.fixture
+def configuration(tmp_path, monkeypatch):
+    """Configuration that discovers ip and country itself"""
+    monkeypatch.delenv("SERVER_IP")
+    monkeypatch.delenv("SERVER_COUNTRY")
+    monkeypatch.delenv("SERVER_COUNTRY_CODE")
+    monkeypatch.setenv("SERVER_INFO_CACHE_PATH", str(tmp_path / "server_info.json"))
+    return Configuration()
+
+
+def test_failed_location_is_retried(configuration, monkeypatch):
+    async def server_ip(self):
+        return "203.0.113.7"
+
+    async def no_location(self, server_ip=None):
+        raise IPInfoError("down")
+
+    async def location(self, server_ip=None):
+        return {"country": "Testland", "country_code": "TL"}
+
+    monkeypatch.setattr(IPInfo, "get_server_ip", server_ip)
+    monkeypatch.setattr(IPInfo, "get_server_location", no_location)
+    asyncio.run(configuration.refresh_server_info())
+    assert configuration.server_ip == "203.0.113.7"
+    assert configuration.server_country == "Unknown"
+    assert not configuration._server_info_is_fresh()
+
+    # Повтор после паузы на неудачу подхватывает страну
+    configuration._server_info_failed_at = 0
+    monkeypatch.setattr(IPInfo, "get_server_location", location)
+    asyncio.run(configuration.refresh_server_info())
+    assert configuration.server_country == "Testland"
+    assert configuration._server_info_is_fresh()
+
+
+def test_stale_cache_is_refreshed(configuration, monkeypatch):
+    async def server_ip(self):
+        return "203.0.113.8"
+
+    async def location(self, server_ip=None):
+        return {"country": "Newland", "country_code": "NL"}
+
+    configuration._server_info = {"ip": "203.0.113.7", "country": "Testland", "country_code": "TL", "updated_at": 0}
+    monkeypatch.setattr(IPInfo, "get_server_ip", server_ip)
+    monkeypatch.setattr(IPInfo, "get_server_location", location)
+    asyncio.run(configuration.refresh_server_info())
+    assert configuration.server_ip == "203.0.113.8"
+    assert configuration.server_country == "Newland"
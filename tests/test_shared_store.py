@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from app.utils.idempotency import IdempotencyKeyReused, SharedIdempotencyStore
+from app.xray.changelog import SharedChangeLog
+
+
+@pytest.fixture
+def store_path(tmp_path) -> str:
+    return str(tmp_path / "clients.db")
+
+
+def test_changelog_is_shared_between_workers(store_path):
+    first, second = SharedChangeLog(store_path), SharedChangeLog(store_path)
+    first.record(["a", "b"], [])
+    first.record([], ["a"])
+
+    assert second.since(0) == {"epoch": first.epoch, "generation": 2, "resync": False, "added": ["b"], "removed": ["a"]}
+    second.refresh()
+    assert (second.epoch, second.generation) == (first.epoch, 2)
+
+
+def test_changelog_evicts_whole_generations(store_path):
+    changelog = SharedChangeLog(store_path, max_changes=3)
+    changelog.record(["a", "b"], [])
+    changelog.record(["c", "d"], [])
+
+    assert changelog.since(0)["resync"] is True
+    assert changelog.since(1)["added"] == ["c", "d"]
+
+
+def test_changelog_reset_changes_epoch(store_path):
+    changelog = SharedChangeLog(store_path)
+    changelog.record(["a"], [])
+    epoch = changelog.epoch
+    changelog.reset()
+
+    assert changelog.epoch != epoch
+    assert changelog.since(1, epoch=epoch)["resync"] is True
+
+
+def test_idempotency_key_is_shared_between_workers(store_path):
+    first, second = SharedIdempotencyStore(store_path), SharedIdempotencyStore(store_path)
+    calls = []
+
+    async def execute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 200, "application/json", b'{"ok": true}'
+
+    async def main():
+        return await asyncio.gather(first.run("k", "f", execute), second.run("k", "f", execute))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    # Кто из воркеров захватит ключ первым, решает гонка потоков
+    assert sorted(replayed for *_, replayed in results) == [False, True]
+    assert {result[:3] for result in results} == {(200, "application/json", b'{"ok": true}')}
+    assert asyncio.run(second.run("k", "f", execute))[3] is True
+
+    with pytest.raises(IdempotencyKeyReused):
+        asyncio.run(second.run("k", "other", execute))
+
+
+def test_failed_request_releases_the_key(store_path):
+    store = SharedIdempotencyStore(store_path)
+    statuses = iter([503, 200])
+
+    async def execute():
+        return next(statuses), "application/json", b"{}"
+
+    assert asyncio.run(store.run("k", "f", execute))[0] == 503
+    assert asyncio.run(store.run("k", "f", execute))[::3] == (200, False)
+
+
+def test_peer_commit_does_not_reset_changes(tmp_path, monkeypatch, xray_configuration):
+    from app.data import config
+    from app.xray.xray_configuration import XrayConfiguration
+
+    monkeypatch.setattr(config, "_xray_store_path", str(tmp_path / "clients.db"))
+
+    async def restart():
+        pass
+
+    workers = []
+    for _ in range(2):
+        worker = XrayConfiguration()
+        monkeypatch.setattr(worker, "_restart_xray", restart)
+        workers.append(worker)
+
+    async def main():
+        await workers[0].add_new_user("phone", 41)
+        await workers[1].get_all_uuids()
+        generation = await workers[1].get_generation()
+        _, added = await workers[0].add_new_user("phone", 42)
+        # Второй воркер перечитывает изменённый конфиг, но историю не сбрасывает
+        await workers[1].get_all_uuids()
+        return added, await workers[1].get_changes(generation)
+
+    added, changes = asyncio.run(main())
+    assert changes["resync"] is False
+    assert changes["added"] == [added]
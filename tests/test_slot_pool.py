@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from app.xray.mutation_queue import AddClients
+from app.xray.slot_pool import SlotPool
+
+
+def uuid(n: int) -> str:
+    return f"00000000-0000-0000-0000-{n:012d}"
+
+
+def test_reserve_commit_release(tmp_path):
+    path = tmp_path / "pool.json"
+    pool = SlotPool(str(path), size=4, low_watermark=1)
+    assert pool.deficit == 4
+
+    pool.reserve(["a", "b", "c"])
+    assert "a" in pool and len(pool) == 0
+    assert pool.deficit == 0
+
+    pool.commit(["a", "b"])
+    pool.release(["c"])
+    assert len(pool) == 2 and "c" not in pool
+    assert json.loads(path.read_text()) == ["a", "b"]
+    assert SlotPool(str(path), size=4, low_watermark=1).deficit == 0
+
+
+def test_take_skips_slots_missing_from_config(tmp_path):
+    pool = SlotPool(str(tmp_path / "pool.json"), size=3, low_watermark=0)
+    pool.reserve(["a", "b", "c"])
+    pool.commit(["a", "b", "c"])
+
+    assert pool.take(2, lambda u: u != "a") == ["b", "c"]
+    assert len(pool) == 0 and "a" not in pool
+
+
+def test_active_count_excludes_slots_being_committed(xray_configuration):
+    async def main():
+        xray_configuration._pool.reserve(["slot"])
+        await xray_configuration._mutations.submit(AddClients([xray_configuration._make_client("slot", "")]))
+        # Коммит прошёл, но в свободный список пула слот ещё не перенесён
+        return await xray_configuration.get_active_client_count()
+
+    assert asyncio.run(main()) == 3
+
+
+def test_handout_during_refill_triggers_another_refill(xray_configuration, tmp_path, monkeypatch):
+    from app.data import config
+
+    # Клиент из конфига уже лежит в пуле: дефицит 1 при размере 2 и пороге 1
+    (tmp_path / "pool.json").write_text(json.dumps([uuid(0)]))
+    monkeypatch.setattr(config, "_xray_pool_size", 2)
+    monkeypatch.setattr(config, "_xray_pool_low_watermark", 1)
+    from app.xray.xray_configuration import XrayConfiguration
+
+    xray = XrayConfiguration()
+    commits = []
+
+    async def restart():
+        commits.append(1)
+        if len(commits) == 1:
+            # Слот выдали, пока идёт пополнение
+            xray._pool.take(1, lambda u: True)
+            xray._pool_wanted.set()
+
+    monkeypatch.setattr(xray, "_restart_xray", restart)
+
+    async def main():
+        refiller = asyncio.create_task(xray.run_pool_refiller())
+        try:
+            for _ in range(100):
+                if len(xray._pool) == 2:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            refiller.cancel()
+
+    asyncio.run(main())
+    assert len(commits) == 2
+    assert len(xray._pool) == 2
@@ -0,0 +1,44 @@
+import asyncio
+import json
+
+import pytest
+
+from app.xray.supervisor import XrayConfigInvalid, XraySupervisor
+
+
+def test_validate_raises_when_test_command_fails():
+    supervisor = XraySupervisor(restart_command="true", test_command="false")
+    with pytest.raises(XrayConfigInvalid):
+        asyncio.run(supervisor.validate("/tmp/config.json"))
+
+
+def test_validate_passes_when_test_command_succeeds():
+    supervisor = XraySupervisor(restart_command="true", test_command="true")
+    asyncio.run(supervisor.validate("/tmp/config.json"))
+
+
+def test_rejected_candidate_is_rolled_back(xray_configuration):
+    xray_configuration._supervisor = XraySupervisor(restart_command="true", test_command="false")
+    config_path = xray_configuration._config_path
+    with open(config_path, "rb") as f:
+        before = f.read()
+
+    with pytest.raises(Exception, match="Failed to update server config"):
+        asyncio.run(xray_configuration.add_new_user("phone", 42))
+
+    with open(config_path, "rb") as f:
+        assert f.read() == before
+    cache = xray_configuration._cache
+    assert len(cache.index) == 3
+    assert len(json.loads(before)["inbounds"][0]["settings"]["clients"]) == 3
+    assert xray_configuration.restarts == 0
+
+
+def test_candidate_has_json_extension(xray_configuration):
+    # xray выбирает загрузчик по расширению файла
+    xray_configuration._supervisor = XraySupervisor(
+        restart_command="true", test_command="sh -c 'case {config} in *.json) exit 0;; esac; exit 1'"
+    )
+    link, uuid = asyncio.run(xray_configuration.add_new_user("phone", 42))
+    assert uuid in xray_configuration._cache.index
+    assert xray_configuration.restarts == 1
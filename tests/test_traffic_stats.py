@@ -0,0 +1,99 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.xray.api_client import XrayApiClient
+from app.xray.fake_api import FakeXrayApiServer
+from app.xray.traffic_stats import TrafficStats
+
+
+@pytest.fixture
+def with_fake_api():
+    """Run scenario(server, stats) against a fake Xray StatsService"""
+
+    def run(scenario):
+        async def main():
+            server = FakeXrayApiServer()
+            await server.start()
+            client = XrayApiClient(server.address)
+            try:
+                return await scenario(server, TrafficStats(client))
+            finally:
+                await client.close()
+                await server.stop()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def test_polls_accumulate_deltas(with_fake_api):
+    async def scenario(server, stats):
+        server.add_traffic("u1@example.com", uplink=100, downlink=1000, inbound_tag="vless_tls")
+        await stats.poll_once()
+        server.add_traffic("u1@example.com", uplink=50, inbound_tag="vless_tls")
+        await stats.poll_once()
+
+        [user] = stats.top_users()
+        assert (user["config_uuid"], user["uplink"], user["downlink"], user["last_interval"]) == ("u1", 150, 1000, 50)
+        assert stats.summary()["inbounds"] == {"vless_tls": {"uplink": 150, "downlink": 1000}}
+
+    with_fake_api(scenario)
+
+
+def test_counter_reset_after_xray_restart(with_fake_api):
+    async def scenario(server, stats):
+        server.add_traffic("u1@example.com", uplink=500)
+        await stats.poll_once()
+        # Xray перезапущен: счётчики начались с нуля
+        server.stats = {}
+        server.add_traffic("u1@example.com", uplink=30)
+        await stats.poll_once()
+
+        [user] = stats.top_users()
+        assert (user["uplink"], user["last_interval"]) == (530, 30)
+
+    with_fake_api(scenario)
+
+
+def test_poller_survives_unexpected_errors(with_fake_api, monkeypatch):
+    async def scenario(server, stats):
+        polls = []
+
+        async def poll_once():
+            polls.append(1)
+            if len(polls) == 1:
+                raise ValueError("malformed response")
+            raise asyncio.CancelledError
+
+        monkeypatch.setattr(stats, "poll_once", poll_once)
+        monkeypatch.setattr(stats, "_interval", 0)
+        with pytest.raises(asyncio.CancelledError):
+            await stats.run()
+        assert len(polls) == 2
+        assert stats.last_error == "ValueError: malformed response"
+
+    with_fake_api(scenario)
+
+
+def test_users_endpoint_pages_by_total(with_fake_api, monkeypatch):
+    import app.main
+
+    async def scenario(server, stats):
+        for n in range(5):
+            server.add_traffic(f"u{n}@example.com", downlink=n * 100)
+        await stats.poll_once()
+        monkeypatch.setattr(app.main, "traffic_stats", stats)
+
+        transport = httpx.ASGITransport(app=app.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = (await client.get("/stats/users", params={"limit": 2})).json()["users"]
+            second = (await client.get("/stats/users", params={"offset": 2, "limit": 2})).json()["users"]
+            rejected = await client.get("/stats/users", params={"limit": 0})
+        return first, second, rejected.status_code
+
+    first, second, rejected = with_fake_api(scenario)
+    assert [u["config_uuid"] for u in first] == ["u4", "u3"]
+    assert [u["config_uuid"] for u in second] == ["u2", "u1"]
+    assert rejected == 400